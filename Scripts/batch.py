@@ -0,0 +1,106 @@
+import os, csv, json, threading
+from Scripts import recovery_index
+try:
+    import queue as q
+except ImportError:
+    import Queue as q
+
+DEFAULT_MLB = "00000000000000000"
+
+def load_manifest(path):
+    # Returns a list of target dicts from either a .csv file with a header row, or
+    # a .json file holding a list of objects (or an object with a "targets" list)
+    with open(path,"r") as f:
+        if path.lower().endswith(".csv"):
+            targets = [dict((k.strip().lower(),(v or "").strip()) for k,v in row.items() if k) for row in csv.DictReader(f)]
+        else:
+            targets = json.load(f)
+            if isinstance(targets,dict):
+                targets = targets.get("targets",[])
+    if not isinstance(targets,list) or not all(isinstance(x,dict) for x in targets):
+        raise ValueError("Manifest must contain a list of targets")
+    return targets
+
+def resolve_target(target, index, output_root = None):
+    # Normalizes a single manifest entry against a RecoveryIndex.  Either a board_id
+    # or a macos name (from boards.json or recovery_urls.txt) is required - the
+    # rest is filled in from the index where possible.  Unknown keys are passed
+    # through untouched.  Raises ValueError when the target can't be resolved.
+    board_id = (target.get("board_id") or "").strip()
+    macos = (target.get("macos") or "").strip()
+    mlb = (target.get("mlb") or "").strip()
+    os_type = (target.get("os_type") or "").strip().lower()
+    if not board_id and not macos:
+        raise ValueError("Either board_id or macos is required")
+    if not board_id:
+        # Look the macOS name up - boards.json first, then recovery_urls.txt
+        boards = index.boards_for_os(macos)
+        entries = index.entries_for_os(macos)
+        if boards:
+            board_id = boards[0]
+        elif entries:
+            board_id = entries[0].board_id
+            mlb = mlb or entries[0].mlb
+        else:
+            raise ValueError("Unknown macOS version: {}".format(macos))
+    board_id = recovery_index.normalize_board_id(board_id)
+    if not len(board_id) in (12,20) or not all((x in "0123456789ABCDEF" for x in board_id[4:])):
+        raise ValueError("Invalid board id: {}".format(board_id))
+    macos = macos or index.os_for_board(board_id,"Unknown")
+    if not mlb:
+        # Use the MLB the newest recovery_urls.txt section pairs with this board, if any
+        mlbs = index.mlbs_for_board(board_id)
+        mlb = mlbs[-1] if mlbs else DEFAULT_MLB
+    if not mlb.isalnum():
+        raise ValueError("Invalid MLB: {}".format(mlb))
+    mlb = mlb.upper().rjust(17,"0")
+    if not os_type:
+        os_type = "latest" if recovery_index.is_latest(macos) else "default"
+    if not os_type in ("default","latest"):
+        raise ValueError("Invalid os_type: {}".format(os_type))
+    output = target.get("output") or os.path.join(output_root or os.getcwd(),"{}_{}".format(board_id,os_type))
+    resolved = dict(target)
+    resolved.update({
+        "board_id":board_id,
+        "mlb":mlb,
+        "os_type":os_type,
+        "macos":macos,
+        "output":os.path.abspath(output)
+    })
+    return resolved
+
+def run_pool(items, worker, jobs = 1):
+    # Runs worker(item) on up to jobs threads and yields (item, result) pairs as
+    # they finish.  Anything raised by the worker is yielded as the result.
+    items = list(items)
+    todo = q.Queue()
+    done = q.Queue()
+    for item in items:
+        todo.put(item)
+    def _work():
+        while True:
+            try:
+                item = todo.get_nowait()
+            except q.Empty:
+                return
+            try:
+                result = worker(item)
+            except BaseException as e:
+                # Even SystemExit - a worker that dies without reporting back would
+                # leave us waiting on done forever
+                result = e
+            done.put((item,result))
+    threads = []
+    for _ in range(max(1,min(jobs,len(items)))):
+        t = threading.Thread(target=_work)
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    for _ in range(len(items)):
+        # Poll so KeyboardInterrupt still gets through on python 2
+        while True:
+            try:
+                yield done.get(timeout=0.5)
+                break
+            except q.Empty:
+                continue
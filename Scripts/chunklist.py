@@ -0,0 +1,105 @@
+import os, mmap, struct, hashlib, threading
+
+# Apple's chunklist format - a small header, then one (size, sha256) entry per
+# chunk of the image, then either an RSA signature or a plain sha256 of the rest
+CHUNKLIST_MAGIC       = 0x4C4B4E43 # "CNKL"
+CHUNKLIST_HEADER      = "<IIBBBxQQQ"
+CHUNKLIST_HEADER_SIZE = 0x24
+CHUNKLIST_ENTRY       = "<I32s"
+CHUNKLIST_ENTRY_SIZE  = 0x24
+
+class ChunklistError(Exception):
+    pass
+
+def parse(data):
+    # Takes the raw bytes of a .chunklist (or a path to one) and returns a list of
+    # (chunk size, sha256 digest) tuples.  Raises ChunklistError if it's malformed.
+    # This only checks the structure - the RSA signature is left to macrecovery.py.
+    if not isinstance(data,(bytes,bytearray)):
+        with open(data,"rb") as f:
+            data = f.read()
+    if len(data) < CHUNKLIST_HEADER_SIZE:
+        raise ChunklistError("Chunklist is too small")
+    magic,header_size,file_version,chunk_method,signature_method,chunk_count,chunk_offset,signature_offset = \
+        struct.unpack(CHUNKLIST_HEADER,bytes(data[:CHUNKLIST_HEADER_SIZE]))
+    if magic != CHUNKLIST_MAGIC or header_size != CHUNKLIST_HEADER_SIZE:
+        raise ChunklistError("Invalid chunklist header")
+    if file_version != 1 or chunk_method != 1:
+        raise ChunklistError("Unsupported chunklist version")
+    if chunk_offset + chunk_count*CHUNKLIST_ENTRY_SIZE > len(data):
+        raise ChunklistError("Chunklist is truncated")
+    chunks = []
+    for i in range(chunk_count):
+        start = chunk_offset+i*CHUNKLIST_ENTRY_SIZE
+        chunks.append(struct.unpack(CHUNKLIST_ENTRY,bytes(data[start:start+CHUNKLIST_ENTRY_SIZE])))
+    if signature_method == 2:
+        # No signature - just a sha256 of everything before it
+        if bytes(data[signature_offset:signature_offset+32]) != hashlib.sha256(bytes(data[:signature_offset])).digest():
+            raise ChunklistError("Chunklist digest mismatch")
+    return chunks
+
+def get_total_size(chunks):
+    return sum(x[0] for x in chunks)
+
+def get_offsets(chunks):
+    # Returns the starting byte offset of each chunk
+    offsets = []
+    offset = 0
+    for size,digest in chunks:
+        offsets.append(offset)
+        offset += size
+    return offsets
+
+def _hash_chunk(mm, offset, size):
+    try:
+        # Hash straight out of the mapping - no copy
+        view = memoryview(mm)
+    except TypeError:
+        # Python 2 can't take a memoryview of an mmap
+        return hashlib.sha256(mm[offset:offset+size]).digest()
+    try:
+        return hashlib.sha256(view[offset:offset+size]).digest()
+    finally:
+        # Let go of the mapping so it can be closed
+        view.release()
+
+def verify_file(path, chunks, threads = None):
+    # Checks every chunk of the file at path against the chunklist entries using a
+    # pool of threads over a memory-mapped view of the file - hashlib drops the GIL
+    # while hashing, so this scales with cores.  Returns a tuple of (valid, error).
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return (False,"{} does not exist".format(os.path.basename(path)))
+    if size != get_total_size(chunks):
+        return (False,"Size doesn't match the chunklist")
+    if not chunks:
+        return (True,None)
+    if threads is None:
+        try: threads = os.cpu_count() or 1
+        except AttributeError: threads = 2
+    threads = max(1,min(threads,len(chunks)))
+    offsets = get_offsets(chunks)
+    errors = []
+    lock = threading.Lock()
+    state = {"next":0}
+    with open(path,"rb") as f:
+        mm = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+        try:
+            def _work():
+                while not errors:
+                    with lock:
+                        i = state["next"]
+                        state["next"] += 1
+                    if i >= len(chunks): return
+                    if _hash_chunk(mm,offsets[i],chunks[i][0]) != chunks[i][1]:
+                        errors.append("Chunk {:,} at offset {:,} is invalid".format(i+1,offsets[i]))
+            workers = [threading.Thread(target=_work) for _ in range(threads)]
+            for t in workers:
+                t.daemon = True
+                t.start()
+            for t in workers:
+                t.join()
+        finally:
+            mm.close()
+    return (not errors,errors[0] if errors else None)
@@ -1,17 +1,47 @@
-import sys, os, time, ssl, gzip, multiprocessing
-from io import BytesIO
+import sys, os, time, ssl, zlib, json, mmap, errno, random, socket, hashlib, tempfile, threading
 # Python-aware urllib stuff
 try:
-    from urllib.request import urlopen, Request
+    from urllib.request import urlopen, Request, getproxies
+    from urllib.error import HTTPError
+    from urllib.parse import urlparse, urljoin
+    import http.client as httplib
     import queue as q
 except ImportError:
     # Import urllib2 to catch errors
     import urllib2
-    from urllib2 import urlopen, Request
+    from urllib2 import urlopen, Request, HTTPError
+    from urllib import getproxies
+    from urlparse import urlparse, urljoin
+    import httplib
     import Queue as q
 
 TERMINAL_WIDTH = 120 if os.name=="nt" else 80
 
+# Sidecar journals sit next to the file they describe
+JOURNAL_SUFFIX  = ".journal"
+JOURNAL_VERSION = 1
+
+# Priority classes for the Scheduler - lower goes first
+PRIORITY_METADATA = 0
+PRIORITY_BULK     = 1
+
+# Events a Downloader hands to its hooks
+EVENT_CONNECT    = "connect"
+EVENT_TLS        = "tls"
+EVENT_FIRST_BYTE = "first_byte"
+EVENT_CHUNK      = "chunk"
+EVENT_RETRY      = "retry"
+EVENT_COMPLETE   = "complete"
+EVENTS = (EVENT_CONNECT,EVENT_TLS,EVENT_FIRST_BYTE,EVENT_CHUNK,EVENT_RETRY,EVENT_COMPLETE)
+
+# How a failure is classified in info["error_class"] - transient ones are retried
+ERROR_TRANSIENT = "transient"
+ERROR_FATAL     = "fatal"
+TRANSIENT_STATUSES = (408,425,429,500,502,503,504)
+TRANSIENT_ERRNOS = tuple(getattr(errno,x) for x in (
+    "ECONNRESET","ECONNREFUSED","ECONNABORTED","EPIPE","ETIMEDOUT","EHOSTUNREACH","ENETUNREACH","ENETDOWN","ENETRESET","EAGAIN"
+) if hasattr(errno,x))
+
 def get_size(size, suffix=None, use_1024=False, round_to=2, strip_zeroes=False):
     # size is the number of bytes
     # suffix is the target suffix to locate (B, KB, MB, etc) - if found
@@ -46,154 +76,1323 @@ def get_size(size, suffix=None, use_1024=False, round_to=2, strip_zeroes=False):
     b = b.rstrip("0") if strip_zeroes else b.ljust(round_to,"0") if round_to > 0 else ""
     return "{:,}{} {}".format(int(a),"" if not b else "."+b,biggest)
 
-def _process_hook(queue, total_size, bytes_so_far=0, update_interval=1.0, max_packets=0):
-    packets = []
-    speed = remaining = ""
-    last_update = time.time()
-    while True:
-        # Write our info first so we have *some* status while
-        # waiting for packets
-        if total_size > 0:
-            percent = float(bytes_so_far) / total_size
-            percent = round(percent*100, 2)
-            t_s = get_size(total_size)
+def parse_size(value):
+    # Turns "500K", "20M", "1.5GiB" or a plain number of bytes into bytes - 1024
+    # based.  Raises ValueError if it can't make sense of it.
+    value = str(value).strip().upper()
+    if value.endswith("B"): value = value[:-1]
+    if value.endswith("I"): value = value[:-1]
+    units = "KMGT"
+    mult = 1
+    if value and value[-1] in units:
+        mult = 1024**(units.index(value[-1])+1)
+        value = value[:-1]
+    size = int(float(value)*mult)
+    if size < 0:
+        raise ValueError("Size can't be negative")
+    return size
+
+def classify_error(error = None, status = None):
+    # Sorts a failure - an exception or an HTTP status - into ERROR_TRANSIENT (worth
+    # trying again) or ERROR_FATAL.  Statuses below 400 aren't errors and get None.
+    code = getattr(error,"code",None) if isinstance(error,HTTPError) else status
+    if code is not None:
+        if code < 400: return None
+        return ERROR_TRANSIENT if code in TRANSIENT_STATUSES else ERROR_FATAL
+    # urlopen() wraps socket errors - look at what it wrapped
+    reason = getattr(error,"reason",None)
+    if isinstance(reason,Exception):
+        error = reason
+    if isinstance(error,socket.timeout):
+        return ERROR_TRANSIENT
+    if isinstance(error,socket.gaierror):
+        # Only a lookup that might work next time is worth repeating
+        return ERROR_TRANSIENT if error.args and error.args[0] == getattr(socket,"EAI_AGAIN",None) else ERROR_FATAL
+    if isinstance(error,getattr(ssl,"CertificateError",())) or isinstance(error,getattr(ssl,"SSLCertVerificationError",())):
+        return ERROR_FATAL
+    if isinstance(error,ssl.SSLError):
+        return ERROR_TRANSIENT
+    if isinstance(error,httplib.InvalidURL):
+        return ERROR_FATAL
+    if isinstance(error,httplib.HTTPException):
+        # Cut off or garbled responses - IncompleteRead, BadStatusLine and friends
+        return ERROR_TRANSIENT
+    if isinstance(error,(socket.error,IOError,OSError)):
+        return ERROR_TRANSIENT if getattr(error,"errno",None) in TRANSIENT_ERRNOS else ERROR_FATAL
+    return ERROR_FATAL
+
+def _get_remaining(seconds_left):
+    days  = seconds_left // 86400
+    hours = (seconds_left - (days*86400)) // 3600
+    mins  = (seconds_left - (days*86400) - (hours*3600)) // 60
+    secs  = seconds_left - (days*86400) - (hours*3600) - (mins*60)
+    if days > 99:
+        return " | ?? left"
+    return " | {}{:02d}:{:02d}:{:02d} left".format(
+        "{}:".format(int(days)) if days else "",
+        int(hours),
+        int(mins),
+        int(round(secs))
+    )
+
+class ProgressTask:
+
+    def __init__(self, total_size, bytes_so_far = 0, label = None):
+        # Tracks a single transfer - workers call update() with the number of
+        # bytes they just received, and the renderer samples it on its own schedule
+        self.total_size = total_size
+        self.bytes_so_far = bytes_so_far
+        self.label = label
+        self.finished = False
+        self.lock = threading.Lock()
+        # Throughput is an exponentially weighted moving average updated once per
+        # redraw, so it costs the same no matter how many chunks arrive
+        self.speed = None
+        self.sample_bytes = bytes_so_far
+        self.sample_time = time.time()
+
+    def update(self, size):
+        with self.lock:
+            self.bytes_so_far += size
+
+    def sample(self, now, smoothing):
+        with self.lock:
+            bytes_so_far = self.bytes_so_far
+        t = now - self.sample_time
+        if t <= 0: return
+        bytes_speed = (bytes_so_far - self.sample_bytes) / t
+        self.speed = bytes_speed if self.speed is None else smoothing*bytes_speed + (1-smoothing)*self.speed
+        self.sample_bytes = bytes_so_far
+        self.sample_time = now
+
+    def render(self, with_label = False):
+        bytes_so_far = self.bytes_so_far
+        label = "{} | ".format(self.label) if with_label and self.label else ""
+        speed = remaining = ""
+        if self.speed is not None:
+            speed = " | {}/s".format(get_size(self.speed,round_to=1))
+            if self.total_size > 0:
+                remaining = " | ?? left" if self.speed <= 0 else _get_remaining((self.total_size-bytes_so_far) / self.speed)
+        if self.total_size <= 0:
+            return "{}{}{}".format(label, get_size(bytes_so_far), speed)
+        percent = float(bytes_so_far) / self.total_size
+        percent = round(percent*100, 2)
+        t_s = get_size(self.total_size)
+        try:
+            b_s = get_size(bytes_so_far, t_s.split(" ")[1])
+        except:
+            b_s = get_size(bytes_so_far)
+        perc_str = " {:.2f}%".format(percent)
+        bar_width = (TERMINAL_WIDTH // 3)-len(perc_str)
+        progress = "=" * min(bar_width,int(bar_width * (percent/100)))
+        return "{}{}/{} | {}{}{}{}{}".format(
+            label,
+            b_s,
+            t_s,
+            progress,
+            " " * (bar_width-len(progress)),
+            perc_str,
+            speed,
+            remaining
+        )
+
+class ProgressRenderer:
+
+    def __init__(self, update_interval = 1.0, smoothing = 0.3, stream = None):
+        # Draws one status line per active ProgressTask from a single background
+        # thread, redrawing every update_interval seconds.  The thread only runs
+        # while there's something to draw.
+        self.update_interval = update_interval
+        self.smoothing = smoothing
+        self.stream = stream
+        self.tasks = []
+        self.lines_drawn = 0
+        self.lock = threading.RLock()
+        self.thread = None
+
+    def add(self, total_size, bytes_so_far = 0, label = None):
+        task = ProgressTask(total_size, bytes_so_far, label)
+        with self.lock:
+            self.tasks.append(task)
+            self.draw(sample=False)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run)
+                self.thread.daemon = True
+                self.thread.start()
+        return task
+
+    def finish(self, task):
+        # Marks the task done and draws its final line right away so anything the
+        # caller prints next lands below it
+        with self.lock:
+            if task.finished: return
+            task.finished = True
+            self.draw()
+
+    def _run(self):
+        while True:
+            time.sleep(self.update_interval)
+            with self.lock:
+                if not self.tasks:
+                    self.thread = None
+                    return
+                self.draw()
+
+    def draw(self, sample = True):
+        stream = self.stream or sys.stdout
+        with self.lock:
+            now = time.time()
+            if sample:
+                for task in self.tasks:
+                    task.sample(now, self.smoothing)
+            # Finished tasks are drawn once more at the top of our block, then left
+            # behind as we move on
+            finished = [x for x in self.tasks if x.finished]
+            active = [x for x in self.tasks if not x.finished]
+            if not finished and not active: return
+            with_label = len(self.tasks) > 1 or self.lines_drawn > 1
+            out = "\033[{}A".format(self.lines_drawn-1) if self.lines_drawn > 1 else ""
+            out += "\n".join("\r\033[K"+x.render(with_label) for x in finished+active)
+            if not active:
+                out += "\n" # Jump to the next line
+            self.lines_drawn = len(active)
+            self.tasks = active
             try:
-                b_s = get_size(bytes_so_far, t_s.split(" ")[1])
+                stream.write(out)
+                stream.flush()
             except:
-                b_s = get_size(bytes_so_far)
-            perc_str = " {:.2f}%".format(percent)
-            bar_width = (TERMINAL_WIDTH // 3)-len(perc_str)
-            progress = "=" * int(bar_width * (percent/100))
-            sys.stdout.write("\r\033[K{}/{} | {}{}{}{}{}".format(
-                b_s,
-                t_s,
-                progress,
-                " " * (bar_width-len(progress)),
-                perc_str,
-                speed,
-                remaining
-            ))
+                pass
+
+default_renderer = ProgressRenderer()
+
+class SchedulerSlot:
+
+    def __init__(self, scheduler, host):
+        # A connection granted by Scheduler.acquire() - release it when done.  Safe
+        # to release more than once.
+        self.scheduler = scheduler
+        self.host = host
+
+    def release(self):
+        scheduler,self.scheduler = self.scheduler,None
+        if scheduler: scheduler.release(self.host)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+class Scheduler:
+
+    def __init__(self, rate = None, burst = None, max_connections = None, max_per_host = None):
+        # Coordinates every Downloader that shares it.  A token bucket caps the
+        # combined read rate at rate bytes/sec (bursting up to burst bytes), and
+        # open connections are capped in total and per host.  Waiting connections
+        # are handed out in priority order - so metadata fetches get the next free
+        # slot ahead of bulk transfers.  Metadata reads also skip the rate limit,
+        # though what they read still counts against it.  None means no limit.
+        self.rate = rate
+        self.burst = burst or rate
+        self.max_connections = max_connections
+        self.max_per_host = max_per_host
+        self.tokens = self.burst or 0
+        self.stamp = time.time()
+        self.active = 0
+        self.hosts = {}
+        self.waiting = [] # sorted (priority, sequence, host)
+        self.sequence = 0
+        self.cond = threading.Condition()
+        self.bucket_lock = threading.Lock()
+
+    def _get_host(self, url):
+        parsed = urlparse(url)
+        return (parsed.hostname,parsed.port)
+
+    def _has_room(self, host):
+        if self.max_connections and self.active >= self.max_connections: return False
+        if self.max_per_host and self.hosts.get(host,0) >= self.max_per_host: return False
+        return True
+
+    def _can_start(self, entry):
+        if not self._has_room(entry[2]): return False
+        # Only go if nobody ahead of us could use the room instead
+        for other in self.waiting:
+            if other == entry: return True
+            if self._has_room(other[2]): return False
+        return True
+
+    def acquire(self, url, priority = PRIORITY_BULK):
+        # Blocks until a connection to url's host is allowed - returns a SchedulerSlot
+        host = self._get_host(url)
+        with self.cond:
+            entry = (priority,self.sequence,host)
+            self.sequence += 1
+            self.waiting.append(entry)
+            self.waiting.sort()
+            try:
+                while not self._can_start(entry):
+                    # Wait with a timeout so KeyboardInterrupt can get through
+                    self.cond.wait(0.5)
+            finally:
+                self.waiting.remove(entry)
+                # Whoever was queued behind us may be able to go now
+                self.cond.notify_all()
+            self.active += 1
+            self.hosts[host] = self.hosts.get(host,0)+1
+        return SchedulerSlot(self,host)
+
+    def release(self, host):
+        with self.cond:
+            self.active -= 1
+            self.hosts[host] -= 1
+            if not self.hosts[host]: del self.hosts[host]
+            self.cond.notify_all()
+
+    def read_size(self, size):
+        # Caps a read at one burst so throttled reads stay smooth
+        if not self.rate: return size
+        return max(16384,min(size,self.burst))
+
+    def throttle(self, size, priority = PRIORITY_BULK):
+        # Accounts for size bytes just read - sleeping as long as it takes the
+        # bucket to pay them back when they overdrew it
+        if not self.rate or size <= 0: return
+        with self.bucket_lock:
+            now = time.time()
+            self.tokens = min(self.burst,self.tokens+(now-self.stamp)*self.rate)
+            self.stamp = now
+            self.tokens -= size
+            wait = 0 if priority < PRIORITY_BULK or self.tokens >= 0 else -self.tokens/float(self.rate)
+        if wait > 0: time.sleep(wait)
+
+# Shared by every Downloader that isn't given its own - no limits by default
+default_scheduler = Scheduler()
+
+class StreamDecoder:
+
+    def __init__(self, encoding):
+        # Incrementally decodes a gzip or deflate Content-Encoding as chunks
+        # arrive so we never need to hold the compressed body in memory
+        self.encoding = encoding.lower()
+        # gzip wants the gzip header/trailer (16 + MAX_WBITS) - deflate is
+        # supposed to be zlib wrapped, but some servers send it raw, so we
+        # fall back on -MAX_WBITS if the first chunk doesn't parse
+        self.wbits = 16+zlib.MAX_WBITS if self.encoding in ("gzip","x-gzip") else zlib.MAX_WBITS
+        self.decoder = zlib.decompressobj(self.wbits)
+        self.started = False
+
+    @classmethod
+    def supports(cls, encoding):
+        return (encoding or "").lower() in ("gzip","x-gzip","deflate")
+
+    def decompress(self, data):
+        # bytes() of a memoryview on py2 gives its repr, not its contents
+        data = data.tobytes() if isinstance(data,memoryview) else bytes(data)
+        if not self.started and self.encoding == "deflate":
+            self.started = True
+            try:
+                return self.decoder.decompress(data)
+            except zlib.error:
+                self.wbits = -zlib.MAX_WBITS
+                self.decoder = zlib.decompressobj(self.wbits)
+        self.started = True
+        out = self.decoder.decompress(data)
+        # Concatenated gzip members are valid - keep going if there's more
+        while self.decoder.unused_data and self.wbits > 16:
+            data = self.decoder.unused_data
+            self.decoder = zlib.decompressobj(self.wbits)
+            out += self.decoder.decompress(data)
+        return out
+
+    def flush(self):
+        return self.decoder.flush()
+
+class BufferPool:
+
+    def __init__(self, max_buffers = 16):
+        # Recycles read buffers so the hot loops don't allocate a fresh bytes object
+        # on every read.  Buffers are bucketed by power of two size, and at most
+        # max_buffers of each size are kept around.
+        self.max_buffers = max_buffers
+        self.free = {}
+        self.lock = threading.Lock()
+
+    def _get_size_class(self, size):
+        size_class = 4096
+        while size_class < size:
+            size_class <<= 1
+        return size_class
+
+    def get(self, size):
+        # Returns a bytearray of at least size bytes
+        size = self._get_size_class(size)
+        with self.lock:
+            free = self.free.get(size)
+            if free: return free.pop()
+        return bytearray(size)
+
+    def put(self, buf):
+        with self.lock:
+            free = self.free.setdefault(len(buf),[])
+            if len(free) < self.max_buffers:
+                free.append(buf)
+
+class ChunkSizer:
+
+    def __init__(self, min_size = 65536, max_size = 4194304, target = 0.25, smoothing = 0.3, min_sample = 0.005):
+        # Picks read sizes from measured throughput - small reads on slow links so
+        # progress stays responsive, large ones on fast links so we make fewer
+        # calls.  Aims for each read to take about target seconds, and only ever
+        # hands out powers of two so the BufferPool can recycle them.
+        #
+        # Throughput is measured over the wall time between updates rather than per
+        # read - a read served from what's already in the socket buffer takes next
+        # to no time - and updates closer together than min_sample seconds are
+        # pooled into one sample.  The size at most doubles or halves per sample
+        # so one odd measurement can't swing it across the whole range.
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target = target
+        self.smoothing = smoothing
+        self.min_sample = min_sample
+        self.rate = None
+        self.size = min_size
+        self.last = None
+        self.pending = 0
+
+    def update(self, read, elapsed = 0):
+        if read <= 0: return
+        now = time.time()
+        if self.last is None:
+            # Nothing to measure from yet but the read itself
+            self.last = now-elapsed
+        self.pending += read
+        span = now-self.last
+        if span < self.min_sample: return
+        rate = self.pending/span
+        self.pending,self.last = 0,now
+        self.rate = rate if self.rate is None else self.smoothing*rate+(1-self.smoothing)*self.rate
+        size = self.min_size
+        while size < self.rate*self.target and size < self.max_size:
+            size <<= 1
+        if size > self.size:
+            self.size = min(self.size << 1,self.max_size)
+        elif size < self.size:
+            self.size = max(self.size >> 1,self.min_size)
+
+class StreamVerifier:
+
+    def __init__(self, digest = None, chunklist = None, offset = 0, file_path = None, end = None, max_queue = 8):
+        # Hashes data on a worker thread as it's fed in, so verification overlaps
+        # the network instead of needing a second pass over the file.
+        #
+        # digest is an (algorithm, hex digest) tuple for the whole stream, and
+        # chunklist is a list of (size, sha256 digest) tuples as found in a recovery
+        # .chunklist.  offset is where in the file the fed data starts - if that's
+        # not the start of the file (or of a chunk), the bytes before it are read
+        # back from file_path first.  end is where the fed data should stop - the
+        # end of the chunklist by default.
+        self.hasher = hashlib.new(digest[0]) if digest else None
+        self.expected = digest[1].lower() if digest else None
+        self.chunks = chunklist
+        self.end = end if end is not None or chunklist is None else sum(x[0] for x in chunklist)
+        self.index = 0
+        self.chunk_start = 0
+        self.chunk_bytes = 0
+        self.chunk_hash = hashlib.sha256()
+        self.error = None
+        self.bad_offset = None
+        self.failed = threading.Event()
+        self.queue = q.Queue(max_queue)
+        prefix = 0 if self.hasher else offset
+        if self.chunks is not None:
+            # Find the chunk our offset lands in
+            while self.index < len(self.chunks) and self.chunk_start + self.chunks[self.index][0] <= offset:
+                self.chunk_start += self.chunks[self.index][0]
+                self.index += 1
+            prefix = min(prefix,self.chunk_start)
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        if prefix < offset:
+            if not file_path:
+                raise ValueError("Need the existing file to verify from offset {}".format(offset))
+            self.queue.put((self._consume_file,(file_path,prefix,offset),None))
+
+    def _fail(self, error, bad_offset = None):
+        if self.failed.is_set(): return
+        self.error = error
+        self.bad_offset = bad_offset
+        self.failed.set()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None: return
+            consume,args,release = item
+            try:
+                if not self.failed.is_set(): # Otherwise just drain
+                    consume(*args)
+            except Exception as e:
+                self._fail(str(e))
+            finally:
+                if release: release()
+
+    def _consume_file(self, file_path, start, end):
+        with open(file_path,"rb") as f:
+            f.seek(start)
+            while start < end and not self.failed.is_set():
+                data = f.read(min(1048576,end-start))
+                if not data:
+                    self._fail("{} is shorter than expected".format(os.path.basename(file_path)))
+                    return
+                start += len(data)
+                self._consume(data)
+
+    def _consume(self, data):
+        if self.hasher:
+            self.hasher.update(data)
+        if self.chunks is None: return
+        view = memoryview(data)
+        pos = 0
+        while pos < len(view):
+            if self.index >= len(self.chunks):
+                self._fail("More data than the chunklist describes",self.chunk_start)
+                return
+            size,expected = self.chunks[self.index]
+            take = min(size-self.chunk_bytes,len(view)-pos)
+            self.chunk_hash.update(view[pos:pos+take])
+            pos += take
+            self.chunk_bytes += take
+            if self.chunk_bytes == size:
+                if self.chunk_hash.digest() != expected:
+                    self._fail("Chunk {:,} at offset {:,} is invalid".format(self.index+1,self.chunk_start),self.chunk_start)
+                    return
+                self.index += 1
+                self.chunk_start += size
+                self.chunk_bytes = 0
+                self.chunk_hash = hashlib.sha256()
+
+    def feed(self, data, release = None):
+        # Queues data for hashing - blocks if the hasher falls too far behind.  If
+        # data is a view of a reused buffer, release is called once it's hashed so
+        # the buffer can be handed out again.
+        if not self.failed.is_set():
+            self.queue.put((self._consume,(data,),release))
+        elif release:
+            release()
+
+    def finish(self, complete = True):
+        # Waits for the hasher to catch up.  If complete, the stream is expected to
+        # have covered everything the digest/chunklist describes.  Returns True if
+        # everything checked out.
+        self.queue.put(None)
+        self.thread.join()
+        if self.failed.is_set() or not complete:
+            return not self.failed.is_set()
+        if self.hasher and self.hasher.hexdigest().lower() != self.expected:
+            self._fail("{} digest mismatch".format(self.hasher.name))
+        elif self.chunks is not None and (self.chunk_start != self.end or self.chunk_bytes):
+            self._fail("Less data than the chunklist describes",self.chunk_start)
+        return not self.failed.is_set()
+
+class TransferJournal:
+
+    def __init__(self, file_path, flush_interval = 2.0):
+        # Sidecar record of which byte ranges of file_path have made it to disk, and
+        # which version of the file the server was handing out at the time.  Lets an
+        # interrupted download re-request just the missing ranges - in any order -
+        # even after a crash.
+        #
+        # Ranges are only written to the journal after the file has been fsync'd, so
+        # anything it lists was on disk.  Each range also carries a sha256 so data
+        # that changed under us is caught on resume.
+        self.file_path = file_path
+        self.path = file_path+JOURNAL_SUFFIX
+        self.flush_interval = flush_interval
+        self.size = -1
+        self.validators = {}
+        self.ranges = [] # [start, end (exclusive), sha256 hex digest]
+        self.dirty = False
+        self.last_flush = 0
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+
+    @staticmethod
+    def get_validators(headers):
+        # The headers that tell us whether the server's copy changed
+        validators = {}
+        for key in ("ETag","Last-Modified"):
+            value = headers.get(key) if headers is not None else None
+            if value: validators[key] = value
+        return validators
+
+    def start(self, size, headers):
+        # Begins a fresh journal for a size byte file described by headers
+        with self.lock:
+            self.size = size
+            self.validators = self.get_validators(headers)
+            self.ranges = []
+            self.dirty = True
+        self.flush(sync=False)
+
+    def load(self):
+        # Reads the journal from disk - returns False if it's missing or unusable
+        try:
+            with open(self.path,"r") as f:
+                data = json.load(f)
+            assert data.get("version") == JOURNAL_VERSION
+            size = int(data["size"])
+            validators = dict(data.get("validators",{}))
+            ranges = [[int(a),int(b),str(c)] for a,b,c in data.get("ranges",[])]
+        except:
+            return False
+        with self.lock:
+            self.size,self.validators,self.ranges = size,validators,ranges
+            self.dirty = False
+        return True
+
+    def matches(self, size, headers):
+        # Whether the server still describes the file we journaled.  Every validator
+        # we recorded that the server still sends has to match - and if it stopped
+        # sending all of them, we can't tell, so assume it changed.
+        if size != self.size: return False
+        validators = self.get_validators(headers)
+        shared = [x for x in self.validators if x in validators]
+        if self.validators and not shared: return False
+        return all(self.validators[x] == validators[x] for x in shared)
+
+    def covers(self, start, end):
+        # True if start-end (exclusive) lies entirely within recorded ranges
+        with self.lock:
+            done = sorted((a,b) for a,b,c in self.ranges)
+        for a,b in done:
+            if a > start: return False
+            if b > start: start = b
+            if start >= end: return True
+        return start >= end
+
+    def missing(self):
+        # Returns a sorted list of (start, end) exclusive ranges we don't have yet
+        with self.lock:
+            done = sorted((a,b) for a,b,c in self.ranges)
+        gaps = []
+        pos = 0
+        for a,b in done:
+            if a > pos: gaps.append((pos,a))
+            pos = max(pos,b)
+        if pos < self.size: gaps.append((pos,self.size))
+        return gaps
+
+    def verify(self, block_size = 1048576):
+        # Re-hashes each recorded range from disk and forgets any that no longer
+        # match.  Returns the number of bytes kept.
+        good = []
+        try:
+            with open(self.file_path,"rb") as f:
+                for start,end,digest in self.ranges:
+                    f.seek(start)
+                    h = hashlib.sha256()
+                    left = end-start
+                    while left:
+                        data = f.read(min(block_size,left))
+                        if not data: break
+                        h.update(data)
+                        left -= len(data)
+                    if not left and h.hexdigest() == digest:
+                        good.append([start,end,digest])
+        except (IOError,OSError):
+            pass
+        with self.lock:
+            if len(good) != len(self.ranges): self.dirty = True
+            self.ranges = good
+        return sum(b-a for a,b,c in good)
+
+    def add(self, start, end, digest):
+        # Records start-end (exclusive) as written - the caller must have flushed
+        # its file object first.  Flushes the journal if it's been a while.
+        with self.lock:
+            self.ranges.append([start,end,digest])
+            self.dirty = True
+            due = time.time()-self.last_flush >= self.flush_interval
+        if due: self.flush()
+
+    def discard(self, start, end = None):
+        # Forgets every range overlapping start-end (exclusive) - or start onward
+        with self.lock:
+            self.ranges = [x for x in self.ranges if x[1] <= start or (end is not None and x[0] >= end)]
+            self.dirty = True
+
+    def flush(self, sync = True):
+        # Writes the journal out.  With sync, the file's data is forced to disk
+        # first so the journal never gets ahead of it.
+        with self.flush_lock:
+            with self.lock:
+                if not self.dirty: return
+                data = {
+                    "version":JOURNAL_VERSION,
+                    "size":self.size,
+                    "validators":self.validators,
+                    "ranges":[list(x) for x in self.ranges]
+                }
+                self.dirty = False
+                self.last_flush = time.time()
+            temp = None
+            try:
+                if sync and os.path.isfile(self.file_path):
+                    with open(self.file_path,"r+b") as f:
+                        os.fsync(f.fileno())
+                # Swap a complete copy in so a crash never leaves a torn journal
+                fd,temp = tempfile.mkstemp(prefix=".journal-",dir=os.path.dirname(os.path.abspath(self.path)))
+                with os.fdopen(fd,"w") as f:
+                    json.dump(data,f)
+                if hasattr(os,"replace"):
+                    os.replace(temp,self.path)
+                else:
+                    if os.name == "nt" and os.path.exists(self.path):
+                        os.remove(self.path)
+                    os.rename(temp,self.path)
+            except:
+                if temp:
+                    try: os.remove(temp)
+                    except: pass
+
+    def remove(self):
+        with self.flush_lock:
+            try: os.remove(self.path)
+            except OSError: pass
+
+def preallocate(f, size):
+    # Reserves size bytes for f up front - with posix_fallocate() where the OS has it
+    # so the blocks really are allocated (and a full disk fails now instead of mid
+    # download), otherwise by just extending the file
+    f.flush()
+    if hasattr(os,"posix_fallocate"):
+        try:
+            os.posix_fallocate(f.fileno(),0,size)
+        except OSError as e:
+            if e.errno == errno.ENOSPC: raise
+    if os.fstat(f.fileno()).st_size != size:
+        f.truncate(size)
+
+class BufferRelease:
+
+    def __init__(self, pool, buf, count):
+        # Hands buf back to pool once it's been released count times - one for
+        # each consumer still holding a view of it
+        self.pool = pool
+        self.buf = buf
+        self.count = count
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        with self.lock:
+            self.count -= 1
+            if self.count: return
+        self.pool.put(self.buf)
+
+class WriteBehind:
+
+    def __init__(self, f, max_queue = 16):
+        # Does the writes to f on a dedicated thread so a slow disk (or an antivirus
+        # scan) never stalls the socket reads feeding it.  The queue is bounded, so
+        # once the disk falls that far behind, callers block until it catches up.
+        # Writes with an offset go through os.pwrite() where available, so every
+        # segment of a download can share one file and one writer.
+        self.f = f
+        self.pwrite = getattr(os,"pwrite",None)
+        self.queue = q.Queue(max_queue)
+        self.error = None
+        self.failed = threading.Event()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None: return
+            func,args,release = item
+            try:
+                if not self.failed.is_set(): # Otherwise just drain
+                    func(*args)
+            except Exception as e:
+                self.error = e
+                self.failed.set()
+            finally:
+                if release: release()
+
+    def _write(self, data, offset):
+        if offset is None:
+            self.f.write(data)
+        elif self.pwrite:
+            fd = self.f.fileno()
+            while len(data):
+                written = self.pwrite(fd,data,offset)
+                data = data[written:]
+                offset += written
         else:
-            b_s = get_size(bytes_so_far)
-            sys.stdout.write("\r\033[K{}{}".format(b_s, speed))
-        sys.stdout.flush()
-        # Now we gather the next packet
+            # Only this thread touches f, so a seek is safe
+            self.f.seek(offset)
+            self.f.write(data)
+
+    def write(self, data, offset = None, release = None):
+        # Queues data to be written at offset (or wherever the last write left off
+        # if None).  release is called once it's on its way to disk.  Raises if an
+        # earlier write failed.
+        if self.failed.is_set():
+            if release: release()
+            raise IOError("Write failed: {}".format(self.error))
+        self.queue.put((self._write,(data,offset),release))
+
+    def call(self, func, *args):
+        # Runs func on the writer thread once everything queued before it is written
+        self.queue.put((func,args,None))
+
+    def close(self):
+        # Waits for every queued write to land - returns False if any failed
+        self.queue.put(None)
+        self.thread.join()
+        return not self.failed.is_set()
+
+class JournalWriter:
+
+    def __init__(self, out, offset, journal = None, piece_size = 8388608, positional = False):
+        # Writes sequential data through the WriteBehind out starting at offset,
+        # recording it in the journal in piece_size ranges once it's landed.  With
+        # positional, every write carries its offset so out can be shared.  Without
+        # a journal it's just a plain write.
+        self.out = out
+        self.journal = journal
+        self.piece_size = piece_size
+        self.positional = positional
+        self.start = self.pos = offset
+        self.hash = hashlib.sha256() if journal else None
+
+    def write(self, data, release = None):
+        size = len(data)
+        if self.journal:
+            self.hash.update(data)
+        self.out.write(data,self.pos if self.positional else None,release)
+        self.pos += size
+        if self.journal and self.pos-self.start >= self.piece_size:
+            self.commit()
+
+    def _record(self, start, end, digest):
+        # Runs on the writer thread - after the piece's data has been written
+        self.out.f.flush()
+        self.journal.add(start,end,digest)
+
+    def commit(self):
+        # Records whatever's been written since the last commit
+        if not self.journal or self.pos == self.start: return
+        self.out.call(self._record,self.start,self.pos,self.hash.hexdigest())
+        self.start = self.pos
+        self.hash = hashlib.sha256()
+
+class SpooledBuffer:
+
+    def __init__(self, max_size = 33554432):
+        # A read-only file-like result that's filled once, then read back with
+        # random access.  It stays in memory until it outgrows max_size bytes, then
+        # moves to an anonymous temp file - which is memory mapped once it's filled,
+        # so large payloads never have to live in RAM.
+        self.max_size = max_size
+        self.mem = bytearray()
+        self.file = None
+        self.map = None
+        self.data = None
+        self.size = 0
+        self.pos = 0
+
+    @property
+    def rolled(self):
+        # True if the contents spilled to disk
+        return self.file is not None
+
+    def write(self, data, release = None):
+        # Appends data while filling - release is called once it's been copied
+        if self.data is not None or self.mem is None:
+            raise ValueError("SpooledBuffer is read-only once filled")
         try:
-            packet = queue.get(timeout=update_interval)
-            # Packets should be formatted as a tuple of
-            # (timestamp, len(bytes_downloaded))
-            # If "DONE" is passed, we assume the download
-            # finished - and bail
-            if packet == "DONE":
-                print("") # Jump to the next line
-                return
-            # Append our packet to the list and ensure we're not
-            # beyond our max.
-            # Only check max if it's > 0
-            packets.append(packet)
-            if max_packets > 0:
-                packets = packets[-max_packets:]
-            # Increment our bytes so far as well
-            bytes_so_far += packet[1]
-        except q.Empty:
-            # Didn't get anything - reset the speed
-            # and packets
-            packets = []
-            speed = " | 0 B/s"
-            remaining = " | ?? left" if total_size > 0 else ""
-        except KeyboardInterrupt:
-            print("") # Jump to the next line
-            return
-        # If we have packets and it's time for an update, process
-        # the info.
-        update_check = time.time()
-        if packets and update_check - last_update >= update_interval:
-            last_update = update_check # Refresh our update timestamp
-            speed = " | ?? B/s"
-            if len(packets) > 1:
-                # Let's calculate the amount downloaded over how long
-                try:
-                    first,last = packets[0][0],packets[-1][0]
-                    chunks = sum([float(x[1]) for x in packets])
-                    t = last-first
-                    assert t >= 0
-                    bytes_speed = 1. / t * chunks
-                    speed = " | {}/s".format(get_size(bytes_speed,round_to=1))
-                    # Get our remaining time
-                    if total_size > 0:
-                        seconds_left = (total_size-bytes_so_far) / bytes_speed
-                        days  = seconds_left // 86400
-                        hours = (seconds_left - (days*86400)) // 3600
-                        mins  = (seconds_left - (days*86400) - (hours*3600)) // 60
-                        secs  = seconds_left - (days*86400) - (hours*3600) - (mins*60)
-                        if days > 99 or bytes_speed == 0:
-                            remaining = " | ?? left"
-                        else:
-                            remaining = " | {}{:02d}:{:02d}:{:02d} left".format(
-                                "{}:".format(int(days)) if days else "",
-                                int(hours),
-                                int(mins),
-                                int(round(secs))
-                            )
-                except:
-                    pass
-                # Clear the packets so we don't reuse the same ones
-                packets = []
+            if self.file is None and self.size+len(data) > self.max_size:
+                # Too big to keep around - move what we have to disk
+                self.file = tempfile.TemporaryFile()
+                self.file.write(self.mem)
+                self.mem = bytearray()
+            if self.file is not None:
+                self.file.write(data)
+            else:
+                self.mem.extend(data)
+            self.size += len(data)
+        finally:
+            if release: release()
+
+    def finish(self):
+        # Done filling - maps the temp file if we spilled, and rewinds.  Returns self.
+        if self.data is not None: return self
+        if self.file is not None:
+            self.file.flush()
+            self.map = mmap.mmap(self.file.fileno(),0,access=mmap.ACCESS_READ)
+            self.data = self.map
+        else:
+            self.data = self.mem
+        try:
+            # Slicing a memoryview only copies once
+            self.data = memoryview(self.data)
+        except TypeError:
+            pass # Python 2 can't view an mmap - slicing it works the same
+        self.pos = 0
+        return self
+
+    def __len__(self):
+        return self.size
+
+    def getbuffer(self):
+        # Zero-copy view of the contents - release it before closing
+        return self.finish().data
+
+    def getvalue(self):
+        return bytes(self.finish().data[:])
+
+    def seek(self, offset, whence = 0):
+        if whence == 1: offset += self.pos
+        elif whence == 2: offset += self.size
+        if offset < 0:
+            raise ValueError("Negative seek position {}".format(offset))
+        self.pos = offset
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def read(self, size = -1):
+        self.finish()
+        end = self.size if size is None or size < 0 else min(self.size,self.pos+size)
+        if self.pos >= end: return b""
+        data = bytes(self.data[self.pos:end])
+        self.pos = end
+        return data
+
+    def readinto(self, b):
+        self.finish()
+        count = max(0,min(len(b),self.size-self.pos))
+        b[:count] = self.data[self.pos:self.pos+count]
+        self.pos += count
+        return count
+
+    def close(self):
+        if isinstance(self.data,memoryview):
+            self.data.release()
+        self.data = None
+        if self.map is not None:
+            try: self.map.close()
+            except BufferError: pass # Someone still holds a view - leave it to gc
+            self.map = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.mem = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def _connect_timed(conn):
+    # Opens conn's socket the way httplib would - but does the lookup itself so
+    # conn.timings can tell DNS apart from the TCP handshake
+    conn.timings = {"dns":None,"connect":None,"tls":None}
+    started = time.time()
+    addresses = socket.getaddrinfo(conn.host,conn.port,0,socket.SOCK_STREAM)
+    resolved = time.time()
+    conn.timings["dns"] = resolved-started
+    error = None
+    for address in addresses:
+        try:
+            conn.sock = socket.create_connection(address[4][:2],conn.timeout,conn.source_address)
+            break
+        except socket.error as e:
+            error = e
+    else:
+        raise error or socket.error("No addresses found for {}".format(conn.host))
+    conn.timings["connect"] = time.time()-resolved
+    try: conn.sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+    except (socket.error,AttributeError): pass
+
+def _set_read_timeout(conn):
+    # conn.timeout covered connecting - reads get their own (usually longer) limit
+    read_timeout = getattr(conn,"read_timeout",None)
+    if read_timeout is not None:
+        conn.sock.settimeout(read_timeout)
+
+class TimedHTTPConnection(httplib.HTTPConnection):
+
+    def connect(self):
+        _connect_timed(self)
+        _set_read_timeout(self)
+
+class TimedHTTPSConnection(httplib.HTTPSConnection):
+
+    def connect(self):
+        _connect_timed(self)
+        started = time.time()
+        self.sock = self._context.wrap_socket(self.sock,server_hostname=self.host)
+        self.timings["tls"] = time.time()-started
+        _set_read_timeout(self)
+
+class TransferStats:
+
+    def __init__(self, url, stall_threshold = 1.0):
+        # Collects the timings for one transfer across every connection and read it
+        # makes.  Any read that takes stall_threshold seconds or longer counts
+        # toward the stall time.
+        self.url = url
+        self.stall_threshold = stall_threshold
+        self.started = time.time()
+        self.lock = threading.Lock()
+        # Taken from the first new connection and the first response - that's what
+        # the transfer actually waited on
+        self.dns = self.connect = self.tls = self.ttfb = None
+        self.connections = 0
+        self.reused = 0
+        self.retries = 0
+        self.bytes = 0
+        self.reads = 0
+        self.stall = 0.0
+
+    def add_connection(self, timings):
+        with self.lock:
+            self.connections += 1
+            if self.connections == 1:
+                self.dns,self.connect,self.tls = timings["dns"],timings["connect"],timings["tls"]
+
+    def add_reused(self):
+        with self.lock:
+            self.reused += 1
+
+    def add_retry(self):
+        with self.lock:
+            self.retries += 1
+
+    def add_response(self, ttfb):
+        with self.lock:
+            if self.ttfb is None: self.ttfb = ttfb
+
+    def add_read(self, size, elapsed):
+        with self.lock:
+            self.bytes += size
+            self.reads += 1
+            if elapsed >= self.stall_threshold:
+                self.stall += elapsed
+
+    def summary(self):
+        # Returns the totals as a dict of plain values - throughput only counts the
+        # time after the first response showed up
+        elapsed = time.time()-self.started
+        with self.lock:
+            transfer = elapsed-(self.ttfb or 0)
+            return {
+                "url":self.url,
+                "bytes":self.bytes,
+                "elapsed":round(elapsed,4),
+                "dns":None if self.dns is None else round(self.dns,4),
+                "connect":None if self.connect is None else round(self.connect,4),
+                "tls":None if self.tls is None else round(self.tls,4),
+                "ttfb":None if self.ttfb is None else round(self.ttfb,4),
+                "throughput":round(self.bytes/transfer,1) if transfer > 0 else None,
+                "stall":round(self.stall,4),
+                "connections":self.connections,
+                "reused":self.reused,
+                "retries":self.retries,
+                "reads":self.reads
+            }
+
+class JsonLinesSink:
+
+    def __init__(self, target):
+        # A hook that writes every event it's handed as one JSON object per line.
+        # target is a path (appended to) or an open file-like object.
+        self.owned = not hasattr(target,"write")
+        self.stream = open(target,"a") if self.owned else target
+        self.lock = threading.Lock()
+
+    def __call__(self, event):
+        line = json.dumps(event,sort_keys=True,default=str)
+        with self.lock:
+            self.stream.write(line+"\n")
+            self.stream.flush()
+
+    def close(self):
+        if self.owned:
+            self.stream.close()
+
+class ConnectionPool:
+
+    def __init__(self, ssl_context = None, max_idle = 6, idle_timeout = 30, connect_timeout = None, read_timeout = None):
+        # Keeps finished keep-alive connections around per (scheme,host,port)
+        # so repeated requests to the same server skip the TCP/TLS handshake.
+        # max_idle caps how many idle connections we hold per host, and
+        # idle_timeout is how many seconds an idle connection is trusted for.
+        # New connections give up on connecting (and the TLS handshake) after
+        # connect_timeout seconds, and on any single read after read_timeout.
+        # ssl_context can also be a callable returning one, so it's only built
+        # once an https connection is made.
+        self.ssl_context = ssl_context
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.lock = threading.Lock()
+        self.idle = {}
+
+    def new(self, key):
+        scheme,host,port = key
+        timeout = socket._GLOBAL_DEFAULT_TIMEOUT if self.connect_timeout is None else self.connect_timeout
+        if scheme == "https":
+            context = self.ssl_context() if callable(self.ssl_context) else self.ssl_context
+            conn = TimedHTTPSConnection(host, port, timeout=timeout, context=context)
+        else:
+            conn = TimedHTTPConnection(host, port, timeout=timeout)
+        conn.read_timeout = self.read_timeout
+        return conn
+
+    def get(self, key):
+        # Returns a tuple of (connection, reused) - preferring the most recently
+        # returned idle connection as it's the least likely to have gone stale
+        now = time.time()
+        stale = []
+        conn = None
+        with self.lock:
+            conns = self.idle.get(key,[])
+            while conns:
+                stamp,c = conns.pop()
+                if now - stamp < self.idle_timeout:
+                    conn = c
+                    break
+                stale.append(c)
+        for c in stale:
+            c.close()
+        if conn is not None:
+            return (conn,True)
+        return (self.new(key),False)
+
+    def put(self, key, conn):
+        # Returns a connection to the idle list - expiring any stale entries and
+        # closing the oldest if we're over our limit
+        now = time.time()
+        drop = []
+        with self.lock:
+            conns = [x for x in self.idle.get(key,[]) if now - x[0] < self.idle_timeout]
+            drop.extend(x[1] for x in self.idle.get(key,[]) if now - x[0] >= self.idle_timeout)
+            conns.append((now,conn))
+            if len(conns) > self.max_idle:
+                drop.extend(x[1] for x in conns[:-self.max_idle])
+                conns = conns[-self.max_idle:]
+            self.idle[key] = conns
+        for c in drop:
+            c.close()
+
+    def clear(self):
+        with self.lock:
+            conns = [x[1] for v in self.idle.values() for x in v]
+            self.idle = {}
+        for c in conns:
+            c.close()
+
+class PooledResponse:
+
+    def __init__(self, pool, key, conn, response, url):
+        # Wraps an httplib response so it looks like what urlopen() returns,
+        # and hands the connection back to the pool once the body is consumed
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.url = url
+        self.status = response.status
+        self.headers = response.msg
+
+    def getcode(self):
+        return self.status
+
+    def geturl(self):
+        return self.url
+
+    def info(self):
+        return self.headers
+
+    def read(self, amt = None):
+        try:
+            chunk = self.response.read() if amt is None else self.response.read(amt)
+        except:
+            # Whatever happened, this connection is no good anymore
+            self.close(reuse=False)
+            raise
+        if not chunk or self.response.isclosed():
+            # Body's done - release the connection early
+            self.close()
+        return chunk
+
+    def readinto(self, b):
+        if not hasattr(self.response,"readinto"):
+            # Python 2's httplib can't fill a buffer - emulate it
+            chunk = self.read(len(b))
+            b[:len(chunk)] = chunk
+            return len(chunk)
+        try:
+            n = self.response.readinto(b)
+        except:
+            self.close(reuse=False)
+            raise
+        if not n or self.response.isclosed():
+            self.close()
+        return n
+
+    def close(self, reuse = True):
+        if self.conn is None: return
+        conn,self.conn = self.conn,None
+        # Only connections whose response was fully read - and that the server
+        # didn't ask us to close - can be reused.  httplib closes a response that
+        # was cut short too, but leaves the bytes it never got in length.
+        if reuse and self.response.isclosed() and not self.response.will_close and not getattr(self.response,"length",None):
+            self.pool.put(self.key,conn)
+        else:
+            self.response.close()
+            conn.close()
 
 class Downloader:
 
     def __init__(self,**kwargs):
         self.ua = kwargs.get("useragent",{"User-Agent":"Mozilla"})
+        self.renderer = kwargs.get("renderer",None) or default_renderer
+        self.scheduler = kwargs.get("scheduler",None) or default_scheduler
         self.chunk = 1048576 # 1024 x 1024 i.e. 1MiB
+        # Streaming reads adapt their size to the link between these bounds, and
+        # recycle their buffers through a shared pool
+        self.chunk_min = kwargs.get("chunk_min",65536) # 64KiB
+        self.chunk_max = kwargs.get("chunk_max",4194304) # 4 x 1MiB
+        self.buffers = kwargs.get("buffers",None) or BufferPool()
+        # How big a get_buffer() result can get before it spills to disk
+        self.spool_max = kwargs.get("spool_max",33554432) # 32 x 1MiB
+        # Segmented downloads - how many ranges to fetch at once, and the smallest
+        # range worth opening another connection for
+        self.segments = kwargs.get("segments",1)
+        self.segment_min = kwargs.get("segment_min",4194304) # 4 x 1MiB
+        # How much data to write between journal entries when resuming via a
+        # sidecar journal
+        self.journal_piece = kwargs.get("journal_piece",8388608) # 8 x 1MiB
+        # Reserve the full size of a download on disk before writing it
+        self.preallocate = kwargs.get("preallocate",True)
         if os.name=="nt": os.system("color") # Initialize cmd for ANSI escapes
-        # Provide reasonable default logic to workaround macOS CA file handling 
-        cafile = ssl.get_default_verify_paths().openssl_cafile
-        try:
-            # If default OpenSSL CA file does not exist, use that from certifi
-            if not os.path.exists(cafile):
-                import certifi
-                cafile = certifi.where()
-            self.ssl_context = ssl.create_default_context(cafile=cafile)
-        except:
-            # None of the above worked, disable certificate verification for now
-            self.ssl_context = ssl._create_unverified_context()
+        # Loading the CA certificates is the slowest part of setting up - it's put
+        # off until the first https connection asks for the context
+        self.ssl_context = kwargs.get("ssl_context",None)
+        self.ssl_lock = threading.Lock()
+        # Seconds to wait on connecting and on any one read - None waits forever
+        self.connect_timeout = kwargs.get("connect_timeout",15)
+        self.read_timeout = kwargs.get("read_timeout",60)
+        # Transient failures are retried up to retries times, waiting an
+        # exponentially growing (and jittered) delay starting around backoff
+        # seconds and capped at backoff_max.  A stream that breaks off mid-body is
+        # reopened from where it stopped under the same budget.
+        self.retries = kwargs.get("retries",5)
+        self.backoff = kwargs.get("backoff",0.5)
+        self.backoff_max = kwargs.get("backoff_max",30)
+        # When racing mirrors of a file, how long each gets to answer before the
+        # next one joins in
+        self.race_stagger = kwargs.get("race_stagger",0.25)
+        # Persistent keep-alive connections shared by every request we make
+        self.use_pool = kwargs.get("use_pool",True)
+        self.max_redirects = kwargs.get("max_redirects",10)
+        self.pool = kwargs.get("pool",None) or ConnectionPool(
+            self.get_ssl_context,
+            max_idle=kwargs.get("max_idle",6),
+            idle_timeout=kwargs.get("idle_timeout",30),
+            connect_timeout=self.connect_timeout,
+            read_timeout=self.read_timeout
+        )
+        # Event hooks - {event:[callables]} - each called with a dict describing
+        # what happened.  metrics_file logs every event but the (very chatty)
+        # chunk events there as JSON lines.
+        self.hooks = {}
+        for event,funcs in (kwargs.get("hooks",None) or {}).items():
+            for func in (funcs if isinstance(funcs,(list,tuple)) else [funcs]):
+                self.add_hook(event,func)
+        self.stall_threshold = kwargs.get("stall_threshold",1.0)
+        self.metrics = None
+        if kwargs.get("metrics_file",None):
+            self.metrics = JsonLinesSink(kwargs["metrics_file"])
+            for event in EVENTS:
+                if event != EVENT_CHUNK:
+                    self.add_hook(event,self.metrics)
         return
 
+    def get_ssl_context(self):
+        with self.ssl_lock:
+            if self.ssl_context is None:
+                # Provide reasonable default logic to workaround macOS CA file handling 
+                cafile = ssl.get_default_verify_paths().openssl_cafile
+                try:
+                    # If default OpenSSL CA file does not exist, use that from certifi
+                    if not os.path.exists(cafile):
+                        import certifi
+                        cafile = certifi.where()
+                    self.ssl_context = ssl.create_default_context(cafile=cafile)
+                except:
+                    # None of the above worked, disable certificate verification for now
+                    self.ssl_context = ssl._create_unverified_context()
+            return self.ssl_context
+
+    def add_hook(self, event, func):
+        if not event in EVENTS:
+            raise ValueError("Unknown event: {}".format(event))
+        # Copy on write so _emit() never has to lock
+        self.hooks = dict(self.hooks,**{event:self.hooks.get(event,[])+[func]})
+
+    def remove_hook(self, event, func):
+        self.hooks = dict(self.hooks,**{event:[x for x in self.hooks.get(event,[]) if x is not func]})
+
+    def _emit(self, event, url, **kwargs):
+        funcs = self.hooks.get(event)
+        if not funcs: return
+        kwargs.update({"event":event,"time":time.time(),"url":url})
+        for func in funcs:
+            try:
+                func(dict(kwargs))
+            except Exception:
+                # A broken hook shouldn't take the download down with it
+                pass
+
+    def _start_stats(self, url):
+        return TransferStats(url,self.stall_threshold)
+
+    def _finish_stats(self, stats, ok, info = None):
+        # Reports a finished transfer to the complete hooks - and to the caller
+        # through info["metrics"] and info["retries"]
+        summary = stats.summary()
+        if isinstance(info,dict):
+            info["metrics"] = summary
+            info["retries"] = summary["retries"]
+        if self.hooks.get(EVENT_COMPLETE):
+            summary = dict(summary)
+            url = summary.pop("url")
+            self._emit(EVENT_COMPLETE,url,ok=ok,
+                status=info.get("status") if isinstance(info,dict) else None,
+                error=info.get("error") if isinstance(info,dict) else None,
+                **summary)
+
     def _decode(self, value, encoding="utf-8", errors="ignore"):
-        # Helper method to only decode if bytes type
-        if sys.version_info >= (3,0) and isinstance(value, bytes):
+        # Helper method to only decode if bytes type - get_bytes hands back a
+        # bytearray, which py2 wants as a str
+        if sys.version_info >= (3,0) and isinstance(value, (bytes,bytearray)):
             return value.decode(encoding,errors)
+        if isinstance(value, bytearray):
+            return bytes(value)
         return value
 
-    def _update_main_name(self):
-        # Windows running python 2 seems to have issues with multiprocessing
-        # if the case of the main script's name is incorrect:
-        # e.g. Downloader.py vs downloader.py
-        #
-        # To work around this, we try to scrape for the correct case if
-        # possible.
-        try:
-            path = os.path.abspath(sys.modules["__main__"].__file__)
-        except AttributeError as e:
-            # This likely means we're running from the interpreter
-            # directly
-            return None
-        if not os.path.isfile(path):
-            return None
-        # Get the file name and folder path
-        name = os.path.basename(path).lower()
-        fldr = os.path.dirname(path)
-        # Walk the files in the folder until we find our
-        # name - then steal its case and update that path
-        for f in os.listdir(fldr):
-            if f.lower() == name:
-                # Got it
-                new_path = os.path.join(fldr,f)
-                sys.modules["__main__"].__file__ = new_path
-                return new_path
-        # If we got here, it wasn't found
-        return None
-
     def _get_headers(self, headers = None):
         # Fall back on the default ua if none provided
         target = headers if isinstance(headers,dict) else self.ua
@@ -204,125 +1403,959 @@ class Downloader:
             new_headers[k] = target[k]
         return new_headers
 
-    def open_url(self, url, headers = None):
+    def _use_pool(self, url):
+        # The pool speaks plain http/https only - anything else, or anything that
+        # needs to go through a proxy, is left to urlopen()
+        scheme = urlparse(url).scheme.lower()
+        return self.use_pool and scheme in ("http","https") and not getproxies().get(scheme)
+
+    def _request_pooled(self, key, path, headers, url = None, stats = None):
+        conn,reused = self.pool.get(key)
+        try:
+            conn.request("GET", path, headers=headers)
+            response = conn.getresponse()
+            self._connected(url,conn,reused,stats)
+            return (conn,response)
+        except (httplib.HTTPException, socket.error) as e:
+            conn.close()
+            if not reused: raise
+            if stats: stats.add_retry()
+            self._emit(EVENT_RETRY,url,attempt=1,reason="stale connection",error=str(e))
+        # The server closed our idle connection under us - try once more with
+        # a fresh one
+        conn = self.pool.new(key)
+        try:
+            conn.request("GET", path, headers=headers)
+            response = conn.getresponse()
+            self._connected(url,conn,False,stats)
+            return (conn,response)
+        except:
+            conn.close()
+            raise
+
+    def _connected(self, url, conn, reused, stats = None):
+        # Reports how a freshly made connection came together
+        if reused:
+            if stats: stats.add_reused()
+            return
+        timings = getattr(conn,"timings",None)
+        if not timings: return
+        if stats: stats.add_connection(timings)
+        self._emit(EVENT_CONNECT,url,host=conn.host,port=conn.port,dns=timings["dns"],connect=timings["connect"])
+        if timings["tls"] is not None:
+            self._emit(EVENT_TLS,url,host=conn.host,port=conn.port,tls=timings["tls"])
+
+    def preconnect(self, url):
+        # Opens a connection to url's server ahead of time and parks it in the pool
+        # so the next request there skips DNS, TCP and TLS.  Returns True if one is
+        # waiting - it's dropped like any other once it's been idle idle_timeout
+        # seconds.
+        if not self._use_pool(url): return False
+        parsed = urlparse(url)
+        scheme = parsed.scheme.lower()
+        key = (scheme,parsed.hostname,parsed.port or (443 if scheme == "https" else 80))
+        conn = self.pool.new(key)
+        try:
+            conn.connect()
+        except Exception:
+            conn.close()
+            return False
+        self._connected(url,conn,False)
+        self.pool.put(key,conn)
+        return True
+
+    def _update_info(self, info, status = None, headers = None, url = None, error = None, error_class = None):
+        # Fills out the optional info dict callers can pass to learn what the
+        # server actually said - even when we hand back None.  Errors are fatal
+        # unless said otherwise.
+        if not isinstance(info,dict): return
+        info["status"] = status
+        info["headers"] = headers if headers is not None else {}
+        info["url"] = url
+        info["error"] = error
+        info["error_class"] = error_class if error_class or not error else ERROR_FATAL
+
+    def _open_pooled(self, url, headers, info = None, stats = None):
+        for _ in range(self.max_redirects+1):
+            parsed = urlparse(url)
+            scheme = parsed.scheme.lower()
+            key = (scheme,parsed.hostname,parsed.port or (443 if scheme == "https" else 80))
+            path = (parsed.path or "/") + ("?"+parsed.query if parsed.query else "")
+            conn,response = self._request_pooled(key,path,headers,url,stats)
+            pooled = PooledResponse(self.pool,key,conn,response,url)
+            location = response.getheader("Location")
+            if response.status in (301,302,303,307,308) and location:
+                # Drain the redirect body so the connection can be reused, then follow it
+                pooled.read()
+                pooled.close()
+                new_url = urljoin(url,location)
+                if urlparse(new_url).hostname != parsed.hostname:
+                    # Don't carry a pinned Host header over to another server
+                    headers = dict((k,v) for k,v in headers.items() if k.lower() != "host")
+                url = new_url
+                continue
+            self._update_info(info,response.status,response.msg,url)
+            if not 200 <= response.status < 300:
+                # Mirror urlopen() and treat anything else as a failure - small
+                # bodies (304s, error pages) are drained so the connection survives
+                try: length = int(response.getheader("Content-Length"))
+                except: length = -1
+                if 0 <= length <= 65536:
+                    pooled.read()
+                pooled.close()
+                return None
+            return pooled
+        self._update_info(info,url=url,error="Too many redirects")
+        return None
+
+    def open_url(self, url, headers = None, info = None, stats = None, retries = None):
+        # Returns the response for url, or None on failure - transient failures
+        # (as sorted by classify_error()) are retried up to retries times, or
+        # self.retries by default, with backoff
         headers = self._get_headers(headers)
+        # Keep our own info if the caller didn't pass one - we need the status
+        info = info if isinstance(info,dict) else {}
+        retries = self.retries if retries is None else retries
+        attempt = 0
+        while True:
+            self._update_info(info,url=url)
+            started = time.time()
+            response = self._open_url(url, headers, info, stats)
+            if info.get("status") is not None:
+                ttfb = time.time()-started
+                if stats: stats.add_response(ttfb)
+                self._emit(EVENT_FIRST_BYTE,url,status=info["status"],ttfb=ttfb,final_url=info.get("url"))
+            if response is not None:
+                return response
+            if info.get("error_class") is None:
+                info["error_class"] = classify_error(status=info.get("status"))
+            if info["error_class"] != ERROR_TRANSIENT or attempt >= retries:
+                return None
+            attempt += 1
+            self._retry(url,attempt,info.get("error") or "HTTP {}".format(info.get("status")),stats,self._get_retry_after(info.get("headers")))
+
+    def open_race(self, urls, headers = None, info = None, stats = None, stagger = None):
+        # Happy eyeballs across mirrors of the same file - urls are tried in order,
+        # each getting stagger seconds (or until it fails) before the next one
+        # joins in.  The first to answer with a 2xx (or a 304 to a conditional
+        # request) wins, and any that answer after it are closed.  Returns a tuple
+        # of (url, response) - the response is None for a 304, and both are None
+        # if every url failed.  info describes the winner (or the last failure),
+        # with info["mirror"] set to the winning url and info["mirrors"] holding
+        # {url:{"ok","status","latency","error"}} for every url that was tried.
+        # Those still going when the winner answered are in there too - with
+        # "lost" set, and how long they'd taken so far as their latency.
+        info = info if isinstance(info,dict) else {}
+        stagger = self.race_stagger if stagger is None else stagger
+        # A lone url gets the usual retries - with more, the next mirror is the retry
+        retries = None if len(urls) == 1 else 0
+        results = q.Queue()
+        lock = threading.Lock()
+        state = {"winner":None}
+        def _try(url):
+            attempt = {}
+            started = time.time()
+            response = None
+            try:
+                response = self.open_url(url, headers, attempt, stats, retries)
+            except Exception as e:
+                self._set_error(attempt,e)
+            latency = time.time()-started
+            healthy = response is not None or attempt.get("status") == 304
+            with lock:
+                won = healthy and state["winner"] is None
+                if won: state["winner"] = url
+            if response is not None and not won:
+                # Lost the race - we don't need its body
+                response.close()
+            results.put((url,response if won else None,won,healthy,attempt,latency))
+        begun = {}
+        def _start(url):
+            begun[url] = time.time()
+            t = threading.Thread(target=_try,args=(url,))
+            t.daemon = True
+            t.start()
+        mirrors = {}
+        last = {}
+        started = finished = 0
+        while finished < len(urls):
+            if started == finished:
+                # Nothing in flight - start the next one right away
+                _start(urls[started])
+                started += 1
+            try:
+                url,response,won,healthy,attempt,latency = results.get(timeout=stagger if started < len(urls) else None)
+            except q.Empty:
+                # The ones in flight are taking too long - let the next one have a go
+                _start(urls[started])
+                started += 1
+                continue
+            finished += 1
+            mirrors[url] = {
+                "ok":healthy,
+                "status":attempt.get("status"),
+                "latency":round(latency,4),
+                "error":attempt.get("error")
+            }
+            last = attempt
+            if won:
+                now = time.time()
+                for other in urls[:started]:
+                    if other in mirrors: continue
+                    # Slower than the winner by at least this much - without it, a
+                    # mirror that never finishes first would never be measured
+                    mirrors[other] = {
+                        "ok":False,
+                        "lost":True,
+                        "status":None,
+                        "latency":round(now-begun[other],4),
+                        "error":None
+                    }
+                info.update(attempt)
+                info["mirror"] = url
+                info["mirrors"] = mirrors
+                return (url,response)
+        info.update(last)
+        info["mirror"] = None
+        info["mirrors"] = mirrors
+        return (None,None)
+
+    def _set_error(self, info, error):
+        # Records what ended a transfer - an exception is classified, anything else
+        # is taken as a fatal error message
+        if not isinstance(info,dict): return
+        if isinstance(error,Exception):
+            info["error"] = str(error) or type(error).__name__
+            info["error_class"] = classify_error(error)
+        else:
+            info["error"] = error
+            info["error_class"] = ERROR_FATAL
+
+    def _get_retry_after(self, headers):
+        # Seconds the server asked us to wait in a Retry-After header, if any
+        try: return max(0,float(headers.get("Retry-After")))
+        except: return None
+
+    def _get_delay(self, failures, retry_after = None):
+        # Exponential backoff with jitter - half the delay is fixed and half random,
+        # so clients that failed together don't come back together.  No delay
+        # before the first retry after a stream that was making progress broke off.
+        if failures <= 0: return 0
+        delay = min(self.backoff_max,self.backoff*2**(failures-1))
+        delay = delay/2+random.uniform(0,delay/2)
+        if retry_after is not None:
+            delay = max(delay,min(retry_after,self.backoff_max))
+        return delay
+
+    def _retry(self, url, attempt, reason, stats = None, retry_after = None, failures = None):
+        # Counts and reports a retry, then waits out its backoff
+        delay = self._get_delay(attempt if failures is None else failures,retry_after)
+        if stats: stats.add_retry()
+        self._emit(EVENT_RETRY,url,attempt=attempt,reason=str(reason),delay=delay)
+        if delay: time.sleep(delay)
+
+    def _open_url(self, url, headers, info, stats = None):
         # Wrap up the try/except block so we don't have to do this for each function
         try:
-            response = urlopen(Request(url, headers=headers), context=self.ssl_context)
+            if self._use_pool(url):
+                response = self._open_pooled(url, headers, info, stats)
+            else:
+                timeout = socket._GLOBAL_DEFAULT_TIMEOUT if self.read_timeout is None else self.read_timeout
+                response = urlopen(Request(url, headers=headers), context=self.get_ssl_context(), timeout=timeout)
+                self._update_info(info,response.getcode(),response.headers,response.geturl())
+        except HTTPError as e:
+            # Keep the status and headers around - a 304 isn't really an error
+            self._update_info(info,e.code,e.headers,url,str(e),classify_error(e))
+            return None
         except Exception as e:
-            # No fixing this - bail
+            # Let open_url() decide whether it's worth another try
+            self._update_info(info,url=url,error=str(e) or type(e).__name__,error_class=classify_error(e))
             return None
         return response
 
     def get_size(self, *args, **kwargs):
         return get_size(*args,**kwargs)
 
-    def get_string(self, url, progress = True, headers = None, expand_gzip = True):
-        response = self.get_bytes(url,progress,headers,expand_gzip)
+    def get_string(self, url, progress = True, headers = None, expand_gzip = True, info = None, priority = PRIORITY_METADATA):
+        response = self.get_bytes(url,progress,headers,expand_gzip,info,priority)
         if response is None: return None
         return self._decode(response)
 
-    def get_bytes(self, url, progress = True, headers = None, expand_gzip = True):
-        response = self.open_url(url, headers)
+    def _read_into(self, response, view):
+        # Fills as much of the passed memoryview as one read allows, returning
+        # the number of bytes we got - 0 means the body is done
+        if hasattr(response,"readinto"):
+            return response.readinto(view) or 0
+        chunk = response.read(len(view))
+        view[:len(chunk)] = chunk
+        return len(chunk)
+
+    def _get_reopener(self, url, headers, response, end = None, stats = None):
+        # Returns a function that picks response's body back up after it breaks off
+        # - reopen(read) asks the server for what's left past the read bytes we
+        # got, and returns the new response - None if retrying didn't help, and
+        # raises IOError if the server's copy changed.  Returns None itself if the
+        # response can't be resumed - the server doesn't take ranges, the size is
+        # unknown, or the body is encoded.
+        if response.headers.get("Content-Encoding","identity").lower() != "identity":
+            return None
+        if response.getcode() == 206:
+            start,total = self._get_range_start(response),self._get_range_total(response)
+        elif self._accepts_ranges(response):
+            start = 0
+            try: total = int(response.headers["Content-Length"])
+            except: total = -1
+        else:
+            return None
+        if start < 0 or total < 0:
+            return None
+        validators = TransferJournal.get_validators(response.headers)
+        state = {"offset":None,"failures":0,"attempt":0}
+        def reopen(read):
+            offset = start+read
+            if offset != state["offset"]:
+                # We made progress since the last break - start the count over
+                state["offset"],state["failures"] = offset,0
+            new_headers = self._get_headers(headers)
+            new_headers["Range"] = "bytes={}-{}".format(offset,"" if end is None else end)
+            # Only hand back the rest if it's still the same file
+            etag = validators.get("ETag")
+            if etag and not etag.startswith("W/"):
+                new_headers["If-Range"] = etag
+            elif validators.get("Last-Modified"):
+                new_headers["If-Range"] = validators["Last-Modified"]
+            while state["failures"] < self.retries:
+                state["attempt"] += 1
+                self._retry(url,state["attempt"],"Connection lost at byte {:,}".format(offset),stats,failures=state["failures"])
+                state["failures"] += 1
+                info = {}
+                new_response = self.open_url(url,new_headers,info,stats,retries=0)
+                if new_response is None:
+                    if info.get("error_class") == ERROR_TRANSIENT: continue
+                    return None
+                new_validators = TransferJournal.get_validators(new_response.headers)
+                if new_response.getcode() != 206 \
+                or self._get_range_start(new_response) != offset \
+                or self._get_range_total(new_response) != total \
+                or any(new_validators.get(x,v) != v for x,v in validators.items()):
+                    # Not the same file anymore (or not the part we asked for) -
+                    # splicing it in would corrupt what we have
+                    new_response.close()
+                    raise IOError("Server didn't resume the same file at byte {:,}".format(offset))
+                return new_response
+            return None
+        return reopen
+
+    def _reopen(self, reopen, read, error, response, opened):
+        # Swaps a broken response for a new one that picks up where it left off -
+        # raising if that's not possible
+        if reopen is None or classify_error(error) != ERROR_TRANSIENT:
+            raise error
+        try: response.close()
+        except: pass
+        new_response = reopen(read)
+        if new_response is None:
+            raise error
+        opened.append(new_response)
+        return new_response
+
+    def _pump(self, response, writer, limit = -1, task = None, verifier = None, priority = PRIORITY_BULK, stop = None, decoder = None, stats = None, reopen = None):
+        # Copies the response body to writer (a JournalWriter or SpooledBuffer)
+        # through pooled buffers filled in place with readinto - no per-read
+        # allocations.  Each buffer goes back to the pool once it's written and (if
+        # there's a verifier) hashed.  With a decoder, data is expanded before it's
+        # written.  Reads at most limit bytes unless it's -1, and stops early if the
+        # verifier fails or stop is set.  Every read is counted toward stats when
+        # it's passed.  If the body breaks off and there's a reopen function (see
+        # _get_reopener()), the rest is fetched on a new response.  Returns the
+        # number of bytes read.
+        opened = []
+        try:
+            return self._pump_into(response,writer,limit,task,verifier,priority,stop,decoder,stats,reopen,opened)
+        finally:
+            # Close any responses we opened along the way
+            for r in opened:
+                r.close()
+
+    def _pump_into(self, response, writer, limit, task, verifier, priority, stop, decoder, stats, reopen, opened):
+        sizer = ChunkSizer(self.chunk_min,self.chunk_max)
+        total = 0
+        while limit < 0 or total < limit:
+            if stop is not None and stop.is_set(): break
+            if verifier and verifier.failed.is_set(): break
+            size = self.scheduler.read_size(sizer.size)
+            if limit >= 0: size = min(size,limit-total)
+            buf = self.buffers.get(size)
+            started = time.time()
+            try:
+                read = self._read_into(response, memoryview(buf)[:size])
+            except Exception as e:
+                self.buffers.put(buf)
+                response = self._reopen(reopen,total,e,response,opened)
+                continue
+            elapsed = time.time()-started
+            sizer.update(read,elapsed)
+            if task: task.update(read)
+            if stats: self._add_read(stats,read,elapsed)
+            if not read:
+                self.buffers.put(buf)
+                if reopen and total < limit:
+                    # Closed early without raising - treat it as a break
+                    response = self._reopen(reopen,total,httplib.IncompleteRead(b"",limit-total),response,opened)
+                    continue
+                break
+            total += read
+            self.scheduler.throttle(read,priority)
+            data = memoryview(buf)[:read]
+            if decoder:
+                data = decoder.decompress(data)
+            elif sys.version_info < (3,0):
+                # Python 2's file objects want a real string
+                data = data.tobytes()
+            # The buffer's free once the writer and the verifier are both done with it
+            release = BufferRelease(self.buffers,buf,2 if verifier else 1)
+            writer.write(data,release)
+            if verifier: verifier.feed(data,release)
+        return total
+
+    def _add_read(self, stats, size, elapsed):
+        stats.add_read(size,elapsed)
+        if self.hooks.get(EVENT_CHUNK):
+            self._emit(EVENT_CHUNK,stats.url,size=size,elapsed=elapsed,bytes=stats.bytes)
+
+    def get_bytes(self, url, progress = True, headers = None, expand_gzip = True, info = None, priority = PRIORITY_METADATA):
+        # Returns the body as a bytearray - None on failure
+        headers = self._get_headers(headers)
+        if expand_gzip and not any(k.lower() == "accept-encoding" for k in headers):
+            # We can decode these on the fly - let the server know
+            headers["Accept-Encoding"] = "gzip, deflate"
+        info = info if isinstance(info,dict) else {}
+        stats = self._start_stats(url)
+        result = None
+        try:
+            with self.scheduler.acquire(url,priority):
+                result = self._get_bytes(url,progress,headers,expand_gzip,info,priority,stats)
+        finally:
+            self._finish_stats(stats,result is not None,info)
+        return result
+
+    def get_buffer(self, url, progress = True, headers = None, expand_gzip = True, info = None, priority = PRIORITY_METADATA, max_size = None):
+        # Like get_bytes, but returns a SpooledBuffer - kept in memory up to max_size
+        # bytes (self.spool_max by default) and spilled to a memory mapped temp file
+        # past that.  Returns None on failure.
+        headers = self._get_headers(headers)
+        if expand_gzip and not any(k.lower() == "accept-encoding" for k in headers):
+            headers["Accept-Encoding"] = "gzip, deflate"
+        info = info if isinstance(info,dict) else {}
+        stats = self._start_stats(url)
+        result = None
+        try:
+            with self.scheduler.acquire(url,priority):
+                result = self._get_buffer(url,progress,headers,expand_gzip,info,priority,max_size,stats)
+        finally:
+            self._finish_stats(stats,result is not None,info)
+        return result
+
+    def _get_buffer(self, url, progress, headers, expand_gzip, info, priority, max_size, stats):
+        response = self.open_url(url, headers, info, stats)
         if response is None: return None
         try: total_size = int(response.headers['Content-Length'])
         except: total_size = -1
-        chunk_so_far = b""
-        packets = queue = process = None
-        if progress:
-            # Make sure our vars are initialized
-            packets = [] if progress else None
-            queue = multiprocessing.Queue()
-            # Create the multiprocess and start it
-            process = multiprocessing.Process(
-                target=_process_hook,
-                args=(queue,total_size)
-            )
-            process.daemon = True
-            # Filthy hack for earlier python versions on Windows
-            if os.name == "nt" and hasattr(multiprocessing,"forking"):
-                self._update_main_name()
-            process.start()
+        encoding = response.headers.get("Content-Encoding","identity")
+        decoder = StreamDecoder(encoding) if expand_gzip and StreamDecoder.supports(encoding) else None
+        out = SpooledBuffer(self.spool_max if max_size is None else max_size)
+        task = self._start_progress(total_size) if progress else None
         try:
-            while True:
-                chunk = response.read(self.chunk)
-                if progress:
-                    # Add our items to the queue
-                    queue.put((time.time(),len(chunk)))
-                if not chunk: break
-                chunk_so_far += chunk
+            reopen = self._get_reopener(url,headers,response,stats=stats) if decoder is None else None
+            self._pump(response,out,total_size if decoder is None else -1,task,priority=priority,decoder=decoder,stats=stats,reopen=reopen)
+            if decoder:
+                out.write(decoder.flush())
+        except Exception as e:
+            out.close()
+            self._set_error(info,e)
+            return None
+        except:
+            out.close()
+            raise
         finally:
             # Close the response whenever we're done
             response.close()
-        if expand_gzip and response.headers.get("Content-Encoding","unknown").lower() == "gzip":
-            fileobj = BytesIO(chunk_so_far)
-            gfile   = gzip.GzipFile(fileobj=fileobj)
-            return gfile.read()
-        if progress:
-            # Finalize the queue and wait
-            queue.put("DONE")
-            process.join()
-        return chunk_so_far
+            if task: self._stop_progress(task)
+        return out.finish()
 
-    def stream_to_file(self, url, file_path, progress = True, headers = None, ensure_size_if_present = True, allow_resume = False):
-        response = self.open_url(url, headers)
+    def _get_bytes(self, url, progress, headers, expand_gzip, info, priority, stats = None):
+        response = self.open_url(url, headers, info, stats)
         if response is None: return None
-        bytes_so_far = 0
+        read_size = self.scheduler.read_size(self.chunk)
         try: total_size = int(response.headers['Content-Length'])
         except: total_size = -1
-        packets = queue = process = None
-        mode = "wb"
-        if allow_resume and os.path.isfile(file_path) and total_size != -1:
-            # File exists, we're resuming and have a target size.  Check the
-            # local file size.
-            current_size = os.stat(file_path).st_size
-            if current_size == total_size:
-                # File is already complete - return the path
-                return file_path
-            elif current_size < total_size:
+        encoding = response.headers.get("Content-Encoding","identity")
+        decoder = StreamDecoder(encoding) if expand_gzip and StreamDecoder.supports(encoding) else None
+        if decoder is None and total_size > 0:
+            # We know exactly how much is coming - read straight into place
+            out = bytearray(total_size)
+            buf = None
+        else:
+            # Grow as needed - bytearray appends are amortized linear
+            out = bytearray()
+            buf = bytearray(read_size)
+        bytes_so_far = 0
+        # Reading straight into place means we can pick the body back up if it breaks off
+        reopen = self._get_reopener(url,headers,response,stats=stats) if buf is None else None
+        task = self._start_progress(total_size) if progress else None
+        try:
+            out_view = memoryview(out) if buf is None else None
+            buf_view = memoryview(buf) if buf is not None else None
+            while True:
+                started = time.time()
+                if buf is None:
+                    if bytes_so_far >= total_size: break
+                    try:
+                        read = self._read_into(response, out_view[bytes_so_far:bytes_so_far+read_size])
+                    except Exception as e:
+                        response = self._reopen(reopen,bytes_so_far,e,response,[])
+                        continue
+                    if not read and reopen:
+                        response = self._reopen(reopen,bytes_so_far,httplib.IncompleteRead(b"",total_size-bytes_so_far),response,[])
+                        continue
+                else:
+                    read = self._read_into(response, buf_view)
+                elapsed = time.time()-started
+                if task: task.update(read)
+                if stats: self._add_read(stats,read,elapsed)
+                if not read: break
+                self.scheduler.throttle(read,priority)
+                bytes_so_far += read
+                if buf is not None:
+                    out.extend(decoder.decompress(buf_view[:read]) if decoder else buf_view[:read])
+            if decoder:
+                out.extend(decoder.flush())
+        except Exception as e:
+            self._set_error(info,e)
+            return None
+        finally:
+            # Close the response whenever we're done
+            response.close()
+            if task: self._stop_progress(task)
+        # Hand back the buffer itself - copying it into bytes would briefly hold the
+        # body twice
+        out_view = None
+        if buf is None and bytes_so_far < total_size:
+            # Came up short - only hand back what we actually got
+            del out[bytes_so_far:]
+        return out
+
+    def _start_progress(self, total_size, bytes_so_far=0, label=None):
+        return self.renderer.add(total_size,bytes_so_far,label)
+
+    def _stop_progress(self, task):
+        self.renderer.finish(task)
+
+    def _accepts_ranges(self, response):
+        # Only trust servers that explicitly advertise byte ranges
+        return response.headers.get("Accept-Ranges","none").lower() == "bytes"
+
+    def _get_boundaries(self, chunklist):
+        # Returns the end offset of each chunk
+        boundaries = []
+        offset = 0
+        for size,digest in chunklist:
+            offset += size
+            boundaries.append(offset)
+        return boundaries
+
+    def _split_range(self, start, end, segments, boundaries = None):
+        # Split start-end (exclusive) into at most segments inclusive (start,end)
+        # byte ranges - none of which are smaller than self.segment_min.  With
+        # chunk boundaries, each split is pushed to the next boundary so every
+        # segment can verify its own chunks.
+        seg_size = max(self.segment_min, -(-(end-start) // max(1,segments)))
+        ranges = []
+        while start < end:
+            stop = min(start+seg_size,end)
+            if boundaries:
+                stop = min(end,next((x for x in boundaries if x >= stop),end))
+            ranges.append((start,stop-1))
+            start = stop
+        return ranges
+
+    def _get_segments(self, total_size, segments, chunklist = None):
+        return self._split_range(0,total_size,segments,self._get_boundaries(chunklist) if chunklist else None)
+
+    def _get_missing_segments(self, journal, segments, chunklist = None):
+        # Turns the journal's gaps into ranges to fetch.  With a chunklist, each gap
+        # is widened to whole chunks so every byte we fetch can be verified.
+        gaps = journal.missing()
+        boundaries = None
+        if chunklist:
+            boundaries = self._get_boundaries(chunklist)
+            widened = []
+            for start,end in gaps:
+                start = max([0]+[x for x in boundaries if x <= start])
+                end = next((x for x in boundaries if x >= end),journal.size)
+                if widened and start <= widened[-1][1]:
+                    widened[-1] = (widened[-1][0],max(end,widened[-1][1]))
+                else:
+                    widened.append((start,end))
+            gaps = widened
+        ranges = []
+        for start,end in gaps:
+            ranges.extend(self._split_range(start,end,segments,boundaries))
+        return ranges
+
+    def _hash_file(self, file_path, algorithm):
+        h = hashlib.new(algorithm)
+        with open(file_path,"rb") as f:
+            while True:
+                chunk = f.read(self.chunk)
+                if not chunk: break
+                h.update(chunk)
+        return h.hexdigest()
+
+    def _stream_segment(self, url, out, headers, start, end, task, failed, errors, chunklist = None, journal = None, priority = PRIORITY_BULK, stats = None):
+        # Fetches bytes start-end (inclusive) and writes them at their offset in the
+        # preallocated file behind the WriteBehind out.  Any failure sets the failed
+        # event so the other segments can bail early.
+        new_headers = self._get_headers(headers)
+        new_headers["Range"] = "bytes={}-{}".format(start,end)
+        response = self.open_url(url, new_headers, stats=stats)
+        if response is None:
+            failed.set()
+            return
+        bytes_so_far = 0
+        verifier = StreamVerifier(chunklist=chunklist,offset=start,end=end+1) if chunklist else None
+        try:
+            # Make sure the server actually honored our range
+            if response.getcode() != 206:
+                failed.set()
+                return
+            writer = JournalWriter(out,start,journal,self.journal_piece,True)
+            try:
+                reopen = self._get_reopener(url,headers,response,end,stats)
+                bytes_so_far = self._pump(response,writer,end-start+1,task,verifier,priority,failed,stats=stats,reopen=reopen)
+            finally:
+                # Whatever made it into the file is worth keeping
+                writer.commit()
+        except Exception as e:
+            errors.append(e)
+            failed.set()
+        finally:
+            # Close the response whenever we're done
+            response.close()
+            if verifier and not verifier.finish(bytes_so_far == end-start+1):
+                errors.append(verifier.error)
+                failed.set()
+                if journal and verifier.bad_offset is not None:
+                    # Queued behind our pending journal entries so none of them
+                    # sneak the bad range back in
+                    out.call(journal.discard,verifier.bad_offset,end+1)
+        if bytes_so_far != end-start+1:
+            failed.set()
+
+    def _stream_segments(self, url, file_path, headers, total_size, segments, progress,
+            digest = None, chunklist = None, info = None, ranges = None, journal = None,
+            bytes_so_far = 0, priority = PRIORITY_BULK, stats = None, stop = None):
+        # Pulls the passed inclusive (start,end) ranges - or the whole file split
+        # into segments - over up to segments connections at once.  Every segment
+        # writes at its own offset through one shared write-behind thread.
+        if ranges is None:
+            ranges = self._get_segments(total_size,segments,chunklist)
+            mode = "wb"
+        else:
+            # Filling in the gaps of an existing file - keep what's there
+            mode = "r+b"
+        failed = threading.Event()
+        errors = []
+        with open(file_path,mode,0) as f:
+            # Size the file up front so each segment can write at its own offset
+            if self.preallocate:
+                preallocate(f,total_size)
+            elif os.fstat(f.fileno()).st_size != total_size:
+                f.truncate(total_size)
+            out = WriteBehind(f)
+            task = self._start_progress(total_size,bytes_so_far,os.path.basename(file_path)) if progress else None
+            todo = q.Queue()
+            for r in ranges:
+                todo.put(r)
+            def _work():
+                while not failed.is_set():
+                    try:
+                        start,end = todo.get_nowait()
+                    except q.Empty:
+                        return
+                    with self.scheduler.acquire(url,priority):
+                        if failed.is_set(): return
+                        self._stream_segment(url,out,headers,start,end,task,failed,errors,chunklist,journal,priority,stats)
+            threads = []
+            for _ in range(max(1,min(segments,len(ranges)))):
+                t = threading.Thread(target=_work)
+                t.daemon = True
+                t.start()
+                threads.append(t)
+            try:
+                for t in threads:
+                    # Join with a timeout so KeyboardInterrupt (and stop) can get through
+                    while t.is_alive():
+                        t.join(0.5)
+                        if stop is not None and stop.is_set():
+                            failed.set()
+            except KeyboardInterrupt:
+                failed.set()
+                if journal:
+                    # Give the segments a moment to record what they wrote
+                    for t in threads:
+                        t.join(2)
+                raise
+            finally:
+                if task: self._stop_progress(task)
+                # Let everything queued hit the disk
+                if not out.close():
+                    errors.append("Write failed: {}".format(out.error))
+                    failed.set()
+        if not failed.is_set() and digest and self._hash_file(file_path,digest[0]).lower() != digest[1].lower():
+            # A whole-file digest can't be split across segments - check it once
+            # everything has landed
+            errors.append("{} digest mismatch".format(digest[0]))
+            failed.set()
+            if journal: journal.discard(0)
+        if errors and isinstance(info,dict):
+            self._set_error(info,errors[0])
+        return None if failed.is_set() else file_path
+
+    def _get_range_start(self, response):
+        # Pulls the first offset out of a "Content-Range: bytes a-b/total" header
+        try: return int(response.headers["Content-Range"].split()[-1].split("-")[0])
+        except: return -1
+
+    def _get_range_total(self, response):
+        # Pulls the full size out of a "Content-Range: bytes a-b/total" header
+        try: return int(response.headers["Content-Range"].split("/")[-1])
+        except: return -1
+
+    def _unshare(self, file_path):
+        # A file with more than one link (say, into an image store) must never be
+        # written through - drop our name for it so we start on a fresh inode
+        try:
+            if os.stat(file_path).st_nlink > 1:
+                os.remove(file_path)
+        except (OSError,AttributeError):
+            pass
+
+    def _verify_kept(self, file_path, journal, chunklist):
+        # Checks every chunk the journal fully covers against the chunklist - those
+        # are stronger than the journal's own digests, and catch data recorded just
+        # before a crash that the stream verifier never got to.  Bad chunks are
+        # dropped from the journal so they get fetched again.
+        offset = 0
+        with open(file_path,"rb") as f:
+            for size,expected in chunklist:
+                if journal.covers(offset,offset+size):
+                    f.seek(offset)
+                    if hashlib.sha256(f.read(size)).digest() != expected:
+                        journal.discard(offset,offset+size)
+                offset += size
+
+    def _resume_journal(self, url, file_path, headers, journal, segments, progress, digest = None, chunklist = None, info = None, priority = PRIORITY_BULK, stats = None, stop = None):
+        # Picks an interrupted download back up from its journal.  Returns False if
+        # the journal can't be used and the download should start over.
+        new_headers = self._get_headers(headers)
+        # A single byte is enough to learn the size and the validators
+        new_headers["Range"] = "bytes=0-0"
+        with self.scheduler.acquire(url,priority):
+            response = self.open_url(url, new_headers, info, stats)
+            if response is None: return None
+            try:
+                response.read()
+            finally:
                 response.close()
-                # File is not complete - seek to our current size
-                bytes_so_far = current_size
-                mode = "ab" # Append
-                # We also need to try creating a new request
-                # in order to pass our range header
-                new_headers = self._get_headers(headers)
-                # Get the start byte, 0-indexed
-                byte_string = "bytes={}-".format(current_size)
-                new_headers["Range"] = byte_string
-                response = self.open_url(url, new_headers)
-                if response is None: return None
+        total_size = self._get_range_total(response)
+        if response.getcode() != 206 or not journal.matches(total_size,response.headers):
+            # The server's copy changed (or it stopped taking ranges) - what we
+            # have is no good
+            return False
+        if chunklist and sum(x[0] for x in chunklist) != total_size:
+            self._update_info(info,getattr(response,"status",None),response.headers,url,"Size doesn't match the chunklist")
+            return None
+        try:
+            if chunklist:
+                self._verify_kept(file_path,journal,chunklist)
+            else:
+                journal.verify()
+        except (IOError,OSError):
+            return False
+        ranges = self._get_missing_segments(journal,segments,chunklist)
+        missing = sum(end-start+1 for start,end in ranges)
+        if not ranges:
+            with open(file_path,"r+b") as f:
+                f.truncate(total_size)
+            if digest and self._hash_file(file_path,digest[0]).lower() != digest[1].lower():
+                journal.discard(0)
+                self._update_info(info,206,response.headers,url,"{} digest mismatch".format(digest[0]))
+                return None
+            return file_path
+        return self._stream_segments(url,file_path,headers,total_size,segments,progress,digest,chunklist,info,ranges,journal,total_size-missing,priority,stats,stop)
+
+    def stream_to_file(self, url, file_path, progress = True, headers = None,
+            ensure_size_if_present = True, allow_resume = False, segments = None, info = None,
+            digest = None, chunklist = None, use_journal = False, priority = PRIORITY_BULK,
+            mirrors = None, stop = None):
+        # digest is an optional (algorithm, hex digest) tuple, and chunklist an optional
+        # list of (size, sha256 digest) tuples - either is checked as the data streams
+        # in, and a mismatch stops the download and returns None.  priority is the
+        # Scheduler class the transfer runs under.
+        #
+        # With use_journal, progress is recorded in a sidecar journal next to the
+        # file so a later call can fetch only what's missing - this replaces the
+        # length based allow_resume, which can't tell good data from garbage.
+        #
+        # Like get_bytes/get_buffer, the transfer's timings end up in
+        # info["metrics"] and are reported to the complete hooks.
+        #
+        # mirrors is an optional list of other urls serving the same file - they're
+        # raced against url with open_race(), and the winner serves the rest of
+        # the transfer.
+        #
+        # stop is an optional threading.Event - setting it cuts the transfer short
+        # and returns None, keeping whatever is journaled for a later call.
+        info = info if isinstance(info,dict) else {}
+        stats = self._start_stats(url)
+        result = None
+        try:
+            result = self._stream_to_file_journaled(url,file_path,progress,headers,ensure_size_if_present,allow_resume,segments,info,digest,chunklist,use_journal,priority,stats,mirrors,stop)
+        finally:
+            if not result and stop is not None and stop.is_set():
+                self._update_info(info,info.get("status"),info.get("headers"),info.get("url") or url,"Cancelled")
+            self._finish_stats(stats,bool(result),info)
+        return result
+
+    def _stream_to_file_journaled(self, url, file_path, progress, headers, ensure_size_if_present,
+            allow_resume, segments, info, digest, chunklist, use_journal, priority, stats,
+            mirrors = None, stop = None):
+        self._unshare(file_path)
+        journal = TransferJournal(file_path) if use_journal else None
+        if journal:
+            allow_resume = False
+            if os.path.isfile(file_path) and journal.load():
+                try:
+                    result = self._resume_journal(url,file_path,headers,journal,self.segments if segments is None else max(1,segments),progress,digest,chunklist,info,priority,stats,stop)
+                finally:
+                    journal.flush()
+                if result is not False:
+                    if result: journal.remove()
+                    return result
+            # Nothing usable to resume from
+            journal.remove()
+        slot = self.scheduler.acquire(url,priority)
+        try:
+            result = self._stream_to_file(url,file_path,progress,headers,ensure_size_if_present,allow_resume,segments,info,digest,chunklist,journal,priority,slot,stats,mirrors,stop)
+        finally:
+            slot.release()
+            if journal: journal.flush()
+        if journal and result: journal.remove()
+        return result
+
+    def _stream_to_file(self, url, file_path, progress = True, headers = None,
+            ensure_size_if_present = True, allow_resume = False, segments = None, info = None,
+            digest = None, chunklist = None, journal = None, priority = PRIORITY_BULK, slot = None,
+            stats = None, mirrors = None, stop = None):
+        bytes_so_far = 0
+        segments = self.segments if segments is None else segments
+        task = response = None
+        mode = "wb"
+        current_size = os.stat(file_path).st_size if allow_resume and os.path.isfile(file_path) else 0
+        if current_size:
+            # File exists and we're resuming - ask for the rest up front so we
+            # don't have to throw away a full response just to learn the size
+            new_headers = self._get_headers(headers)
+            # Get the start byte, 0-indexed
+            new_headers["Range"] = "bytes={}-".format(current_size)
+            response = self.open_url(url, new_headers, info, stats)
+            if response is not None:
+                if response.getcode() == 206:
+                    # File is not complete - seek to our current size
+                    total_size = self._get_range_total(response)
+                    bytes_so_far = current_size
+                    mode = "ab" # Append
+                else:
+                    # Server ignored our range - start over
+                    try: total_size = int(response.headers['Content-Length'])
+                    except: total_size = -1
+        if response is None:
+            if mirrors:
+                # Whoever answers first serves the whole transfer
+                url,response = self.open_race([url]+[x for x in mirrors if x != url], headers, info, stats)
+            else:
+                response = self.open_url(url, headers, info, stats)
+            if response is None: return None
+            try: total_size = int(response.headers['Content-Length'])
+            except: total_size = -1
+            if current_size and current_size == total_size:
+                if not (digest or chunklist) or StreamVerifier(digest,chunklist,current_size,file_path).finish():
+                    # File is already complete - return the path
+                    response.close()
+                    return file_path
+        if chunklist and total_size != -1 and sum(x[0] for x in chunklist) != total_size:
+            # No way this will verify - don't bother downloading it
+            response.close()
+            self._update_info(info,getattr(response,"status",None),response.headers,url,"Size doesn't match the chunklist")
+            return None
+        if journal:
+            if total_size != -1 and self._accepts_ranges(response):
+                journal.start(total_size,response.headers)
+            else:
+                # No way to ask for just the missing parts later
+                journal = None
+        if mode == "wb" and segments > 1 and total_size > self.segment_min and self._accepts_ranges(response):
+            # We know the size and the server takes ranges - split the body up
+            # and pull the pieces over separate connections - they queue for their
+            # own connections, so give this one back
+            response.close()
+            if slot: slot.release()
+            return self._stream_segments(url,file_path,headers,total_size,segments,progress,digest,chunklist,info,journal=journal,priority=priority,stats=stats,stop=stop)
+        verifier = None
+        if digest or chunklist:
+            verifier = StreamVerifier(digest,chunklist,bytes_so_far,file_path)
         if progress:
-            # Make sure our vars are initialized
-            packets = [] if progress else None
-            queue = multiprocessing.Queue()
-            # Create the multiprocess and start it
-            process = multiprocessing.Process(
-                target=_process_hook,
-                args=(queue,total_size,bytes_so_far)
-            )
-            process.daemon = True
-            # Filthy hack for earlier python versions on Windows
-            if os.name == "nt" and hasattr(multiprocessing,"forking"):
-                self._update_main_name()
-            process.start()
+            task = self._start_progress(total_size,bytes_so_far,os.path.basename(file_path))
         with open(file_path,mode) as f:
+            if journal and self.preallocate:
+                # The journal knows what's real - so it's safe to claim the space now
+                preallocate(f,total_size)
+            out = WriteBehind(f)
+            writer = JournalWriter(out,bytes_so_far,journal,self.journal_piece)
+            error = None
             try:
-                while True:
-                    chunk = response.read(self.chunk)
-                    bytes_so_far += len(chunk)
-                    if progress:
-                        # Add our items to the queue
-                        queue.put((time.time(),len(chunk)))
-                    if not chunk: break
-                    f.write(chunk)
+                reopen = self._get_reopener(url,headers,response,stats=stats)
+                bytes_so_far += self._pump(response,writer,total_size-bytes_so_far if reopen else -1,task,verifier,priority,stop,stats=stats,reopen=reopen)
+            except Exception as e:
+                # Broke off and couldn't be picked back up - whatever we wrote is
+                # still journaled
+                error = e
             finally:
                 # Close the response whenever we're done
                 response.close()
-        if progress:
-            # Finalize the queue and wait
-            queue.put("DONE")
-            process.join()
+                writer.commit()
+                if task: self._stop_progress(task)
+                if not out.close() and isinstance(info,dict):
+                    info["error"] = "Write failed: {}".format(out.error)
+        if out.failed.is_set() or error is not None:
+            if verifier: verifier.finish(False)
+            if error is not None: self._set_error(info,error)
+            return None
+        if stop is not None and stop.is_set() and (total_size == -1 or bytes_so_far != total_size):
+            # Cut short on purpose - whatever's journaled is kept
+            if verifier: verifier.finish(False)
+            return None
+        if verifier and not verifier.finish(total_size == -1 or bytes_so_far == total_size):
+            if isinstance(info,dict): info["error"] = verifier.error
+            if verifier.bad_offset is not None:
+                # Everything before the bad chunk checked out - keep just that so a
+                # resume picks up from there
+                with open(file_path,"r+b") as f:
+                    f.truncate(verifier.bad_offset)
+            if journal:
+                journal.discard(verifier.bad_offset if verifier.bad_offset is not None else 0)
+            return None
         if ensure_size_if_present and total_size != -1:
             # We're verifying size - make sure we got what we asked for
             if bytes_so_far != total_size:
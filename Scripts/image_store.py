@@ -0,0 +1,208 @@
+import os, sys, json, time, shutil, hashlib, tempfile, threading
+
+def _reflink(source, target):
+    # Copy-on-write clone - instant, and the two files stay independent
+    if sys.platform.startswith("linux"):
+        import fcntl
+        FICLONE = 0x40049409
+        try:
+            with open(source,"rb") as s:
+                with open(target,"wb") as t:
+                    fcntl.ioctl(t.fileno(),FICLONE,s.fileno())
+        except:
+            if os.path.exists(target): os.remove(target)
+            raise
+    elif sys.platform == "darwin":
+        import ctypes, ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c"),use_errno=True)
+        if libc.clonefile(source.encode("utf-8"),target.encode("utf-8"),0) != 0:
+            e = ctypes.get_errno()
+            raise OSError(e,os.strerror(e))
+    else:
+        raise OSError("Reflinks are not supported on {}".format(sys.platform))
+
+def link_file(source, target, allow_copy = True):
+    # Places source at target as cheaply as the filesystem allows - a reflink, then a
+    # hardlink, then (if allowed) a full copy.  Returns which one was used.
+    if os.path.exists(target):
+        os.remove(target)
+    try:
+        _reflink(source,target)
+        return "reflink"
+    except:
+        pass
+    try:
+        os.link(source,target)
+        return "hardlink"
+    except:
+        pass
+    if not allow_copy:
+        raise OSError("Could not link {} to {}".format(source,target))
+    shutil.copy2(source,target)
+    return "copy"
+
+def get_file_hash(path, block_size = 1048576):
+    h = hashlib.sha256()
+    with open(path,"rb") as f:
+        while True:
+            chunk = f.read(block_size)
+            if not chunk: break
+            h.update(chunk)
+    return h.hexdigest()
+
+class ImageStore:
+
+    def __init__(self, root, max_size = None):
+        # Recovery images keyed by the sha256 of their chunklist.  Many board ids
+        # are served the exact same BaseSystem image - once it's here, any target
+        # with the same chunklist is satisfied with a link instead of a download.
+        #
+        # root/<chunklist sha256>/
+        #     BaseSystem.chunklist
+        #     BaseSystem.dmg
+        #     meta.json
+        #
+        # If max_size (in bytes) is set, the least recently used entries are evicted
+        # whenever an add takes the store over it.  An entry's mtime is bumped each
+        # time it's materialized, and is what "recently used" goes by.
+        self.root = root
+        self.max_size = max_size
+        self.lock = threading.Lock()
+
+    def key_for(self, chunklist_path):
+        return get_file_hash(chunklist_path)
+
+    def get_path(self, key):
+        return os.path.join(self.root,key)
+
+    def get_meta(self, key):
+        try:
+            with open(os.path.join(self.get_path(key),"meta.json"),"r") as f:
+                return json.load(f)
+        except:
+            return None
+
+    def get(self, key):
+        # Returns the meta dict for a complete entry - None if we don't have it
+        meta = self.get_meta(key)
+        if not meta: return None
+        path = self.get_path(key)
+        for name,size in meta.get("files",{}).items():
+            try:
+                if os.path.getsize(os.path.join(path,name)) != size:
+                    return None
+            except OSError:
+                return None
+        return meta
+
+    def entries(self):
+        # Returns a list of (key, meta, last used) for every complete entry, least
+        # recently used first
+        entries = []
+        try:
+            names = os.listdir(self.root)
+        except OSError:
+            return entries
+        for key in names:
+            if key.startswith("."): continue
+            meta = self.get(key)
+            if not meta: continue
+            try:
+                used = os.path.getmtime(self.get_path(key))
+            except OSError:
+                continue
+            entries.append((key,meta,used))
+        return sorted(entries,key=lambda x:x[2])
+
+    def get_size(self, meta):
+        return sum(meta.get("files",{}).values())
+
+    def usage(self):
+        # Returns (entry count, total bytes)
+        entries = self.entries()
+        return (len(entries),sum(self.get_size(x[1]) for x in entries))
+
+    def remove(self, key):
+        shutil.rmtree(self.get_path(key),ignore_errors=True)
+
+    def evict(self, max_size = None, keep = None):
+        # Drops least recently used entries until the store fits in max_size (or
+        # self.max_size) bytes - never the keep entry.  Returns the evicted keys.
+        max_size = self.max_size if max_size is None else max_size
+        if max_size is None: return []
+        evicted = []
+        with self.lock:
+            entries = self.entries()
+            total = sum(self.get_size(x[1]) for x in entries)
+            for key,meta,used in entries:
+                if total <= max_size: break
+                if key == keep: continue
+                self.remove(key)
+                total -= self.get_size(meta)
+                evicted.append(key)
+        return evicted
+
+    def clear(self):
+        # Removes every entry - along with anything left behind by an interrupted
+        # add.  Returns (entry count, bytes) that were removed.
+        removed = self.usage()
+        with self.lock:
+            try:
+                names = os.listdir(self.root)
+            except OSError:
+                names = []
+            for name in names:
+                path = os.path.join(self.root,name)
+                if os.path.isdir(path):
+                    shutil.rmtree(path,ignore_errors=True)
+        return removed
+
+    def add(self, key, files, meta = None):
+        # Stores the passed list of file paths under key.  Files are only ever
+        # linked in - if the filesystem can't, this raises OSError rather than
+        # following every download with a full copy.  Returns the meta dict.
+        if self.get(key): return self.get(key)
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+        meta = dict(meta or {})
+        meta["files"] = {}
+        meta["added"] = int(time.time())
+        # Build the entry off to the side and rename it into place so a half-added
+        # entry is never visible
+        temp = tempfile.mkdtemp(prefix=".{}-".format(key),dir=self.root)
+        try:
+            for path in files:
+                name = os.path.basename(path)
+                link_file(path,os.path.join(temp,name),allow_copy=False)
+                meta["files"][name] = os.path.getsize(path)
+            with open(os.path.join(temp,"meta.json"),"w") as f:
+                json.dump(meta,f,indent=2)
+            target = self.get_path(key)
+            if os.path.exists(target):
+                # Stale or incomplete entry - replace it
+                shutil.rmtree(target,ignore_errors=True)
+            os.rename(temp,target)
+        except:
+            shutil.rmtree(temp,ignore_errors=True)
+            raise
+        self.evict(keep=key)
+        return meta
+
+    def materialize(self, key, output, names = None):
+        # Links the stored files (or just the passed names) into output.  Returns a
+        # dict of name -> method used.
+        meta = self.get(key)
+        if not meta:
+            raise KeyError(key)
+        if not os.path.exists(output):
+            os.makedirs(output)
+        methods = {}
+        for name in meta["files"]:
+            if names is not None and not name in names: continue
+            methods[name] = link_file(os.path.join(self.get_path(key),name),os.path.join(output,name))
+        try:
+            # Mark it as recently used so evict() keeps it around
+            os.utime(self.get_path(key),None)
+        except OSError:
+            pass
+        return methods
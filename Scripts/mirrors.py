@@ -0,0 +1,118 @@
+import os, json, time, threading
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+def get_github_mirrors(url):
+    # Returns every place GitHub serves the same raw file from - url can be any of
+    # them (or a jsDelivr url for one).  Anything else comes back as the only
+    # entry.  jsDelivr itself is left out: its ETags differ from GitHub's, so
+    # conditional requests would only pay off when the same mirror won twice in
+    # a row, and it caches branches for hours - a stale file from it could be
+    # swapped in next to fresh ones from GitHub.
+    parsed = urlparse(url)
+    parts = [x for x in parsed.path.split("/") if x]
+    host = (parsed.hostname or "").lower()
+    if host == "raw.githubusercontent.com" and len(parts) >= 4:
+        user,repo,branch,path = parts[0],parts[1],parts[2],parts[3:]
+    elif host == "github.com" and len(parts) >= 5 and parts[2] in ("raw","blob"):
+        user,repo,branch,path = parts[0],parts[1],parts[3],parts[4:]
+    elif host == "cdn.jsdelivr.net" and len(parts) >= 4 and parts[0] == "gh" and "@" in parts[2]:
+        user = parts[1]
+        repo,branch = parts[2].split("@",1)
+        path = parts[3:]
+    else:
+        return [url]
+    path = "/".join(path)
+    return [
+        "https://raw.githubusercontent.com/{}/{}/{}/{}".format(user,repo,branch,path),
+        "https://github.com/{}/{}/raw/{}/{}".format(user,repo,branch,path)
+    ]
+
+def get_mirror_urls(url, local = None):
+    # The candidate urls for url - a local mirror (a base url serving files by
+    # name) goes first, then every GitHub mirror of it
+    urls = []
+    if local:
+        urls.append(local.rstrip("/")+"/"+os.path.basename(urlparse(url).path))
+    urls.extend(x for x in get_github_mirrors(url) if not x in urls)
+    return urls
+
+class MirrorScores:
+
+    def __init__(self, path = None, smoothing = 0.3, penalty = 10.0, max_age = 86400):
+        # Per-host latency scores - an exponentially weighted moving average of how
+        # long each took to answer, with failures counted as penalty seconds.
+        # Kept in path (if passed) between runs, and forgotten after max_age
+        # seconds so a host that had a bad day gets another chance.
+        self.path = path
+        self.smoothing = smoothing
+        self.penalty = penalty
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.scores = None
+
+    def _load(self):
+        # Reads the saved scores the first time they're needed
+        if self.scores is not None: return
+        scores = {}
+        if self.path and os.path.exists(self.path):
+            try:
+                with open(self.path,"r") as f:
+                    scores = json.load(f)
+                assert isinstance(scores,dict)
+            except:
+                scores = {}
+        self.scores = scores
+
+    def get_key(self, url):
+        parsed = urlparse(url)
+        return "{}://{}".format(parsed.scheme.lower(),parsed.netloc.lower())
+
+    def get(self, url):
+        # Returns the score for url's host - or None if we don't know it (anymore)
+        with self.lock:
+            self._load()
+            entry = self.scores.get(self.get_key(url))
+        if not isinstance(entry,dict) or time.time()-entry.get("updated",0) > self.max_age:
+            return None
+        return entry.get("latency")
+
+    def order(self, urls):
+        # Sorts urls fastest first.  Hosts we know nothing about go to the front
+        # (in their original order) so they get measured.
+        scored = [(self.get(x),i,x) for i,x in enumerate(urls)]
+        return [x[2] for x in sorted(scored,key=lambda x:(x[0] is not None,x[0] or 0,x[1]))]
+
+    def record(self, url, latency = None, ok = True):
+        # Folds one answer (or failure) into url's host's score
+        sample = latency if ok and latency is not None else self.penalty
+        key = self.get_key(url)
+        with self.lock:
+            self._load()
+            entry = self.scores.get(key)
+            if not isinstance(entry,dict) or time.time()-entry.get("updated",0) > self.max_age:
+                entry = {"latency":sample,"answers":0,"failures":0}
+            else:
+                entry["latency"] = self.smoothing*sample+(1-self.smoothing)*entry["latency"]
+            entry["answers" if ok else "failures"] = entry.get("answers" if ok else "failures",0)+1
+            entry["updated"] = time.time()
+            self.scores[key] = entry
+
+    def record_race(self, mirrors):
+        # Records every result of a Downloader.open_race() - its info["mirrors"].
+        # A mirror that lost while still going isn't a failure - its time so far
+        # is counted as its answer.
+        for url,result in (mirrors or {}).items():
+            self.record(url,result.get("latency"),result.get("ok") or result.get("lost",False))
+
+    def save(self):
+        if not self.path or self.scores is None: return
+        with self.lock:
+            data = json.dumps(self.scores,indent=2,sort_keys=True)
+        try:
+            with open(self.path,"w") as f:
+                f.write(data)
+        except:
+            pass
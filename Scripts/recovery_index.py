@@ -0,0 +1,240 @@
+import os, sys, json, pickle, hashlib
+from collections import OrderedDict
+
+try:
+    intern = sys.intern
+except AttributeError:
+    # Python 2 has it as a builtin
+    pass
+
+# Bump this whenever the layout of the cached data changes
+CACHE_VERSION = 1
+
+class RecoveryEntry(object):
+    # One board id/MLB pair from recovery_urls.txt.  Thousands of these get built
+    # so keep them small - and share the board id strings with boards.json
+    __slots__ = ("board_id","mlb")
+
+    def __init__(self, board_id, mlb):
+        self.board_id = intern(str(board_id))
+        self.mlb = mlb
+
+    def __repr__(self):
+        return "RecoveryEntry({!r}, {!r})".format(self.board_id,self.mlb)
+
+    def __eq__(self, other):
+        return isinstance(other,RecoveryEntry) and (self.board_id,self.mlb) == (other.board_id,other.mlb)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash((self.board_id,self.mlb))
+
+def parse_boards(path):
+    # Returns an OrderedDict of board id -> macOS name from boards.json
+    if not os.path.exists(path):
+        return OrderedDict()
+    with open(path,"r") as f:
+        boards = json.load(f,object_pairs_hook=OrderedDict)
+    if not isinstance(boards,dict):
+        return OrderedDict()
+    return OrderedDict((intern(str(k)),intern(str(v))) for k,v in boards.items())
+
+def parse_recovery(path):
+    # Returns an OrderedDict of macOS name -> [RecoveryEntry] from recovery_urls.txt
+    if not os.path.exists(path):
+        return OrderedDict()
+    with open(path,"r") as f:
+        r = f.read()
+    r_dict = OrderedDict()
+    last_os = None
+    for line in r.split("\n"):
+        if not line.strip(): continue # Skip empty lines
+        if line.lower().startswith(("diagnostics","default")):
+            last_os = None
+            continue
+        if line.startswith("./") and last_os and not "<" in line:
+            # Got some info - let's get the 3rd and 5th elements
+            try:
+                parts = line.split()
+                r_dict.setdefault(last_os,[]).append(RecoveryEntry(parts[2],parts[4]))
+            except:
+                continue
+        elif not line.startswith("./"):
+            last_os = intern(str(line.strip().rstrip(":").replace(" version","")))
+    return r_dict
+
+def _get_stamp(path):
+    # Returns [mtime, size, sha1] for the passed file - or None if it's missing.
+    # The hash is filled in lazily as it's only needed when the stat changed.
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime,st.st_size,None]
+
+def _get_hash(path):
+    h = hashlib.sha1()
+    with open(path,"rb") as f:
+        h.update(f.read())
+    return h.hexdigest()
+
+def _check_sources(sources, paths):
+    # Compares the cached stamps against what's on disk.  Returns a tuple of
+    # (valid, changed) where changed means the content matched but the stat
+    # didn't - so the cache should be rewritten with the new stamps.
+    changed = False
+    for name,path in paths.items():
+        cached = sources.get(name)
+        stamp = _get_stamp(path)
+        if stamp is None or cached is None:
+            if stamp != cached: return (False,False)
+            continue
+        if cached[:2] == stamp[:2]:
+            continue
+        # File was touched - only stale if the content differs too
+        if cached[2] != _get_hash(path):
+            return (False,False)
+        cached[:2] = stamp[:2]
+        changed = True
+    return (True,changed)
+
+def _pack(boards, recovery):
+    # Flatten everything into plain tuples - they pickle small and load fast
+    return (
+        tuple(boards.items()),
+        tuple((k,tuple((x.board_id,x.mlb) for x in v)) for k,v in recovery.items())
+    )
+
+def _unpack(data):
+    boards = OrderedDict((intern(str(k)),intern(str(v))) for k,v in data[0])
+    recovery = OrderedDict((k,[RecoveryEntry(b,m) for b,m in v]) for k,v in data[1])
+    return (boards,recovery)
+
+def _write_cache(cache_path, cache):
+    # Write to a temp file and swap it in so a crash never leaves a torn cache
+    import tempfile
+    try:
+        fd,temp = tempfile.mkstemp(prefix=".index-",dir=os.path.dirname(os.path.abspath(cache_path)))
+        with os.fdopen(fd,"wb") as f:
+            pickle.dump(cache,f,protocol=2)
+        if hasattr(os,"replace"):
+            os.replace(temp,cache_path)
+        else:
+            if os.name == "nt" and os.path.exists(cache_path):
+                os.remove(cache_path)
+            os.rename(temp,cache_path)
+    except:
+        try: os.remove(temp)
+        except: pass
+
+def _read_cache(cache_path):
+    try:
+        with open(cache_path,"rb") as f:
+            cache = pickle.loads(f.read())
+        assert isinstance(cache,dict) and cache.get("version") == CACHE_VERSION
+        return cache
+    except:
+        return None
+
+def load(boards_path, recovery_path, cache_path):
+    # Returns a tuple of (boards, recovery) - from the compiled cache if it's still
+    # current for both source files, otherwise parsed from scratch and cached
+    paths = OrderedDict((("boards",boards_path),("recovery",recovery_path)))
+    cache = _read_cache(cache_path)
+    if cache:
+        valid,changed = _check_sources(cache["sources"],paths)
+        if valid:
+            if changed: _write_cache(cache_path,cache)
+            return _unpack(cache["data"])
+    # Stale or missing - rebuild it
+    boards = parse_boards(boards_path)
+    recovery = parse_recovery(recovery_path)
+    sources = {}
+    for name,path in paths.items():
+        stamp = _get_stamp(path)
+        if stamp is not None:
+            stamp[2] = _get_hash(path)
+        sources[name] = stamp
+    _write_cache(cache_path,{
+        "version":CACHE_VERSION,
+        "sources":sources,
+        "data":_pack(boards,recovery)
+    })
+    return (boards,recovery)
+
+def normalize_board_id(board_id):
+    # Board ids are "Mac-" followed by 8 or 16 hex digits - accept any case and
+    # with or without the prefix
+    board_id = str(board_id).strip()
+    if board_id.lower().startswith("mac-"):
+        board_id = board_id[4:]
+    return "Mac-"+board_id.upper()
+
+def is_latest(macos):
+    return "latest" in str(macos).lower()
+
+class RecoveryIndex(object):
+
+    def __init__(self, boards = None, recovery = None):
+        # Builds hash maps over boards.json and recovery_urls.txt once so lookups
+        # by OS or board id don't have to scan everything
+        self.boards = boards if boards is not None else OrderedDict()
+        self.recovery = recovery if recovery is not None else OrderedDict()
+        self.os_boards = OrderedDict()  # boards.json macOS name -> [board ids]
+        self.board_os = {}              # board id -> (macOS name, latest)
+        self.board_recovery = {}        # board id -> [(recovery macOS name, RecoveryEntry)]
+        for board,macos in self.boards.items():
+            self.os_boards.setdefault(macos,[]).append(board)
+            self.board_os[normalize_board_id(board)] = (macos,is_latest(macos))
+        for macos,entries in self.recovery.items():
+            for entry in entries:
+                self.board_recovery.setdefault(normalize_board_id(entry.board_id),[]).append((macos,entry))
+
+    def os_versions(self):
+        # macOS names from boards.json - sorted the same way the menu lists them
+        return sorted(self.os_boards,reverse=True)
+
+    def recovery_os_versions(self):
+        # macOS names from recovery_urls.txt - latest -> oldest
+        return list(self.recovery)[::-1]
+
+    def boards_for_os(self, macos):
+        return list(self.os_boards.get(macos,[]))
+
+    def entries_for_os(self, macos):
+        return list(self.recovery.get(macos,[]))
+
+    def board_info(self, board_id):
+        # Returns (macOS name, latest) from boards.json, or None if it's not listed
+        return self.board_os.get(normalize_board_id(board_id))
+
+    def os_for_board(self, board_id, default = None):
+        # Prefers boards.json, then falls back on the newest recovery_urls.txt
+        # section that lists the board
+        info = self.board_info(board_id)
+        if info: return info[0]
+        entries = self.recovery_for_board(board_id)
+        return entries[-1][0] if entries else default
+
+    def recovery_for_board(self, board_id):
+        # Returns a list of (macOS name, RecoveryEntry) for the board - oldest -> latest
+        return list(self.board_recovery.get(normalize_board_id(board_id),[]))
+
+    def mlbs_for_board(self, board_id):
+        return [x[1].mlb for x in self.recovery_for_board(board_id)]
+
+    def available(self, board_id):
+        # Everything we know about a board in one shot
+        info = self.board_info(board_id)
+        return {
+            "board_id":normalize_board_id(board_id),
+            "os":info[0] if info else None,
+            "latest":info[1] if info else False,
+            "recovery":[{"os":macos,"mlb":entry.mlb} for macos,entry in self.recovery_for_board(board_id)]
+        }
+
+def load_index(boards_path, recovery_path, cache_path):
+    # Convenience for scripts - returns a ready to query RecoveryIndex
+    return RecoveryIndex(*load(boards_path,recovery_path,cache_path))
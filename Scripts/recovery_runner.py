@@ -0,0 +1,464 @@
+import os, sys, json, time, shutil, hashlib, argparse, threading
+from Scripts import chunklist, downloader, image_store
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+# Keys macrecovery.py uses in the InstallationPayload response
+INFO_PRODUCT    = "AP"
+INFO_IMAGE_LINK = "AU"
+INFO_IMAGE_HASH = "AH"
+INFO_IMAGE_SESS = "AT"
+INFO_SIGN_LINK  = "CU"
+INFO_SIGN_HASH  = "CH"
+INFO_SIGN_SESS  = "CT"
+
+# What we need from macrecovery.py to drive it ourselves
+REQUIRED_FUNCTIONS = ("get_session","get_image_info","verify_chunklist")
+
+# Left in the output folder after a successful download so a later run for the
+# same target can tell what's already there
+MARKER_NAME = ".gibmacrecovery.json"
+
+# sys.stdout is swapped for sys.stderr while any thread is inside macrecovery.py -
+# counted so overlapping calls don't restore it out of order
+_stdout_lock = threading.Lock()
+_stdout_state = {"depth":0,"stdout":None}
+
+def _redirect_stdout(enter):
+    with _stdout_lock:
+        if enter:
+            if not _stdout_state["depth"]:
+                _stdout_state["stdout"],sys.stdout = sys.stdout,sys.stderr
+            _stdout_state["depth"] += 1
+        else:
+            _stdout_state["depth"] -= 1
+            if not _stdout_state["depth"]:
+                sys.stdout,_stdout_state["stdout"] = _stdout_state["stdout"],None
+
+class RecoveryRunner:
+
+    def __init__(self, macrecovery_path, downloader, store = None):
+        # Drives macrecovery.py's functions from this process instead of spawning a
+        # new interpreter - while doing the actual transfers with our Downloader.
+        # If an ImageStore is passed, verified images are kept there and reused for
+        # any later target with the same chunklist.
+        self.macrecovery_path = macrecovery_path
+        self.d = downloader
+        self.store = store
+        self.lock = threading.Lock()
+        self.module = None
+        self.module_stamp = None
+
+    def load(self):
+        # Imports macrecovery.py as a module, reusing the last import until the file
+        # changes.  Returns None if it can't be imported or lacks what we need.
+        if sys.version_info < (3,5):
+            return None # The legacy fork is only ever run as a script
+        try:
+            stamp = os.path.getmtime(self.macrecovery_path)
+        except OSError:
+            return None
+        with self.lock:
+            if self.module_stamp == stamp:
+                return self.module
+            module = None
+            try:
+                import importlib.util
+                spec = importlib.util.spec_from_file_location("gibmacrecovery_macrecovery",self.macrecovery_path)
+                module = importlib.util.module_from_spec(spec)
+                self.call(spec.loader.exec_module,module)
+                if not all(callable(getattr(module,x,None)) for x in REQUIRED_FUNCTIONS):
+                    module = None
+            except Exception:
+                module = None
+            self.module,self.module_stamp = module,stamp
+            return module
+
+    def call(self, func, *args, **kwargs):
+        # Runs one of macrecovery.py's functions.  It's written as a script - it
+        # prints as it goes, and calls sys.exit() when a request fails - so its
+        # output goes to stderr instead of wherever our results go, and exiting
+        # becomes a RuntimeError the callers already handle.
+        _redirect_stdout(True)
+        try:
+            return func(*args,**kwargs)
+        except SystemExit as e:
+            raise RuntimeError("{} exited{}".format(
+                getattr(func,"__name__","macrecovery.py"),
+                " with {}".format(e.code) if e.code not in (None,0) else ""
+            ))
+        finally:
+            _redirect_stdout(False)
+
+    def get_chunks(self, chunklist_path):
+        # Lets macrecovery.py check the chunklist's signature - it does so as it
+        # yields the (size, sha256 digest) entries, so they're all pulled here
+        module = self.load()
+        return self.call(lambda: list(module.verify_chunklist(chunklist_path)))
+
+    def available(self):
+        return self.load() is not None
+
+    def get_args(self, board_id, mlb, os_type, output, diagnostics = False):
+        # macrecovery.py's helpers take its argparse namespace - build a matching one
+        return argparse.Namespace(
+            action="download",
+            outdir=output,
+            basename="",
+            board_id=board_id,
+            mlb=mlb,
+            code="",
+            model="",
+            os_type=os_type,
+            diagnostics=diagnostics,
+            verbose=False,
+            disk=None,
+            shell=False
+        )
+
+    def get_image_info(self, board_id, mlb, os_type, diagnostics = False):
+        # Asks Apple which image serves this target - returns macrecovery.py's info
+        # dict with the image/chunklist links and asset tokens
+        module = self.load()
+        if module is None:
+            raise RuntimeError("{} could not be loaded".format(os.path.basename(self.macrecovery_path)))
+        args = self.get_args(board_id,mlb,os_type,None,diagnostics)
+        session = self.call(module.get_session,args)
+        return self.call(module.get_image_info,session,bid=board_id,mlb=mlb,diag=diagnostics,os_type=os_type)
+
+    def get_headers(self, url, session):
+        # Same headers macrecovery.py's save_image() sends - minus Connection: close
+        # so the transfer can ride a pooled connection
+        return {
+            "Host":urlparse(url).hostname,
+            "User-Agent":"InternetRecovery/1.0",
+            "Cookie":"=".join(["AssetToken",session])
+        }
+
+    def get_file_path(self, url, output):
+        name = os.path.basename(urlparse(url).path)
+        if not name or os.sep in name:
+            raise RuntimeError("Invalid save path {}".format(name))
+        return os.path.join(output,name)
+
+    def save_image(self, url, session, output, progress = True, chunklist = None, use_journal = False, priority = downloader.PRIORITY_BULK, stop = None):
+        # Downloads url into output - checking it against the chunklist entries as it
+        # streams in when they're passed.  With use_journal, an interrupted download
+        # picks up where it left off next time.  Setting stop cuts it short.
+        path = self.get_file_path(url,output)
+        info = {}
+        if not self.d.stream_to_file(url,path,progress,headers=self.get_headers(url,session),info=info,chunklist=chunklist,use_journal=use_journal,priority=priority,stop=stop):
+            raise RuntimeError("Failed to download {}{}".format(
+                os.path.basename(path),
+                " ({})".format(info["error"]) if info.get("error") else ""
+            ))
+        return path
+
+    def verify_image(self, dmg_path, chunklist_path):
+        # Checks every chunk of the image against the chunklist.  Same checks as
+        # macrecovery.py's verify_image(), without the console output.
+        with open(dmg_path,"rb") as f:
+            for size,digest in self.get_chunks(chunklist_path):
+                chunk = f.read(size)
+                if len(chunk) != size or hashlib.sha256(chunk).digest() != digest:
+                    raise RuntimeError("Chunk at offset {:,} is invalid".format(f.tell()-len(chunk)))
+            if f.read(1) != b"":
+                raise RuntimeError("Image size doesn't match the chunklist")
+
+    def download(self, board_id, mlb, os_type, output, progress = True, diagnostics = False, prefetched = None):
+        # Fetches and verifies the recovery image for the target into output.
+        # Returns a result dict instead of an exit code.  prefetched is a prefetch()
+        # result for the same target whose files have been moved into output - its
+        # image info is reused if it's still there, as is its chunklist, and an
+        # image it already verified means there's nothing left to fetch.  A partial
+        # image it left behind is resumed from its journal.
+        prefetched = prefetched or {}
+        result = {
+            "returncode":1,
+            "product":None,
+            "image":None,
+            "chunklist":None,
+            "verified":False,
+            "store":None,
+            "error":None
+        }
+        try:
+            if prefetched.get("verified") and prefetched.get("image") and prefetched.get("chunklist"):
+                # Fetched and verified before the download was even confirmed
+                result.update(dict((x,prefetched[x]) for x in ("product","chunklist","image")),verified=True,returncode=0)
+                self.store_image(result)
+                self.write_marker(output,board_id,mlb,os_type,result["product"])
+                return result
+            info = prefetched.get("info") or self.get_image_info(board_id,mlb,os_type,diagnostics)
+            result["product"] = info.get(INFO_PRODUCT)
+            if prefetched.get("info") and prefetched.get("chunklist"):
+                result["chunklist"] = prefetched["chunklist"]
+            else:
+                # The chunklist is tiny - grab it first so a bad session fails fast, and
+                # so we know which image we're after before pulling it
+                result["chunklist"] = self.save_image(info[INFO_SIGN_LINK],info[INFO_SIGN_SESS],output,progress,priority=downloader.PRIORITY_METADATA)
+            if self.restore_image(info,result,output):
+                result["returncode"] = 0
+                self.write_marker(output,board_id,mlb,os_type,result["product"])
+                return result
+            # Let macrecovery.py check the chunklist's signature, then verify each chunk
+            # of the image as it downloads - journaling progress so a multi-GB image
+            # never has to start from zero
+            chunks = self.get_chunks(result["chunklist"])
+            result["image"] = self.save_image(info[INFO_IMAGE_LINK],info[INFO_IMAGE_SESS],output,progress,chunks,True)
+            result["verified"] = True
+            result["returncode"] = 0
+            self.store_image(result)
+            self.write_marker(output,board_id,mlb,os_type,result["product"])
+        except Exception as e:
+            result["error"] = str(e) or type(e).__name__
+        return result
+
+    def prefetch(self, board_id, mlb, os_type, output, image = False, stop = None, diagnostics = False):
+        # The first steps of download() for a target that hasn't been confirmed yet:
+        # asks Apple for the image info, opens a connection to the server holding
+        # the image, and fetches the chunklist into output.  With image, the image
+        # itself follows (journaled, so download() can resume it) - unless the store
+        # already has it.  Checks stop between steps, and the transfers give up
+        # partway once it's set.  Returns a result dict - what it has so far if it
+        # was stopped.
+        stop = stop or threading.Event()
+        result = {
+            "info":None,
+            "fetched":None,
+            "product":None,
+            "chunklist":None,
+            "image":None,
+            "verified":False,
+            "error":None
+        }
+        try:
+            info = self.get_image_info(board_id,mlb,os_type,diagnostics)
+            result.update(info=info,fetched=time.time(),product=info.get(INFO_PRODUCT))
+            hosts = []
+            for url in (info[INFO_SIGN_LINK],info[INFO_IMAGE_LINK]):
+                if stop.is_set(): return result
+                if not urlparse(url).hostname in hosts:
+                    hosts.append(urlparse(url).hostname)
+                    self.d.preconnect(url)
+            if stop.is_set(): return result
+            result["chunklist"] = self.save_image(info[INFO_SIGN_LINK],info[INFO_SIGN_SESS],output,False,priority=downloader.PRIORITY_METADATA,stop=stop)
+            if not image or stop.is_set() or (self.store and self.store.get(self.store.key_for(result["chunklist"]))):
+                return result
+            chunks = self.get_chunks(result["chunklist"])
+            result["image"] = self.save_image(info[INFO_IMAGE_LINK],info[INFO_IMAGE_SESS],output,False,chunks,True,stop=stop)
+            result["verified"] = True
+        except Exception as e:
+            result["error"] = str(e) or type(e).__name__
+        return result
+
+    def restore_image(self, info, result, output):
+        # Links the image in from the store if we already have one matching the
+        # chunklist.  Returns True if the store satisfied the download.
+        if not self.store: return False
+        try:
+            key = self.store.key_for(result["chunklist"])
+            meta = self.store.get(key)
+            if not meta: return False
+            image = self.get_file_path(info[INFO_IMAGE_LINK],output)
+            name = os.path.basename(image)
+            if not name in meta["files"]: return False
+            # Entries are links to earlier outputs - anything that rewrote one of those
+            # in place rewrote the entry too, so check it against the chunklist again
+            valid,error = chunklist.verify_file(os.path.join(self.store.get_path(key),name),chunklist.parse(result["chunklist"]))
+            if not valid:
+                self.store.remove(key)
+                return False
+            methods = self.store.materialize(key,output,[name])
+            if not methods: return False
+        except Exception:
+            return False
+        result["image"] = image
+        result["verified"] = True
+        result["store"] = "hit ({})".format(methods[os.path.basename(image)])
+        return True
+
+    def store_image(self, result):
+        # Adds a freshly verified image to the store - failing to do so shouldn't
+        # fail the download
+        if not self.store: return
+        try:
+            key = self.store.key_for(result["chunklist"])
+            self.store.add(key,[result["chunklist"],result["image"]],{"product":result["product"]})
+            result["store"] = "added"
+        except Exception:
+            pass
+
+    def find_image(self, output):
+        # Returns (image path, chunklist path) for the first .dmg in output that has
+        # a matching .chunklist - or (None, None)
+        try:
+            names = sorted(os.listdir(output))
+        except OSError:
+            return (None,None)
+        for name in names:
+            base,ext = os.path.splitext(name)
+            if ext.lower() == ".dmg" and base+".chunklist" in names:
+                return (os.path.join(output,name),os.path.join(output,base+".chunklist"))
+        return (None,None)
+
+    def read_marker(self, output):
+        try:
+            with open(os.path.join(output,MARKER_NAME),"r") as f:
+                marker = json.load(f)
+            assert isinstance(marker,dict)
+            return marker
+        except:
+            return None
+
+    def write_marker(self, output, board_id, mlb, os_type, product = None):
+        # Records which target the image in output belongs to.  Returns the marker,
+        # or None if there's no image/chunklist pair to describe.
+        image,cnk = self.find_image(output)
+        if not image: return None
+        marker = {
+            "board_id":board_id,
+            "mlb":mlb,
+            "os_type":os_type,
+            "product":product,
+            "image":os.path.basename(image),
+            "chunklist":os.path.basename(cnk),
+            "chunklist_sha256":image_store.get_file_hash(cnk)
+        }
+        try:
+            with open(os.path.join(output,MARKER_NAME),"w") as f:
+                json.dump(marker,f,indent=2)
+        except:
+            return None
+        return marker
+
+    def get_expected_chunklist(self, board_id, mlb, os_type, diagnostics = False):
+        # Asks Apple for the target's current chunklist - returns a tuple of
+        # (product, image name, chunklist bytes), or None if we can't find out
+        if not self.available(): return None
+        try:
+            info = self.get_image_info(board_id,mlb,os_type,diagnostics)
+            data = self.d.get_bytes(info[INFO_SIGN_LINK],False,headers=self.get_headers(info[INFO_SIGN_LINK],info[INFO_SIGN_SESS]))
+            if not data: return None
+            return (info.get(INFO_PRODUCT),os.path.basename(self.get_file_path(info[INFO_IMAGE_LINK],"")),data)
+        except Exception:
+            return None
+
+    def check_existing(self, board_id, mlb, os_type, output, diagnostics = False, threads = None):
+        # Checks whether output already holds an intact image for the target.  The
+        # existing chunklist has to match what Apple serves for the target now (or,
+        # if we can't ask, what we recorded when it was downloaded), and the image
+        # has to verify against it.  Returns a result dict like download() does, or
+        # None if the target needs downloading.
+        marker = self.read_marker(output)
+        expected = self.get_expected_chunklist(board_id,mlb,os_type,diagnostics)
+        if expected:
+            product,image_name,data = expected
+            image = os.path.join(output,image_name)
+            cnk = os.path.splitext(image)[0]+".chunklist"
+            if not os.path.isfile(cnk) or image_store.get_file_hash(cnk) != hashlib.sha256(data).hexdigest():
+                return None
+        else:
+            # Fall back on what we recorded last time - only trusted for the exact
+            # same target
+            if not marker or [marker.get(x) for x in ("board_id","mlb","os_type")] != [board_id,mlb,os_type]:
+                return None
+            product = marker.get("product")
+            image = os.path.join(output,marker.get("image",""))
+            cnk = os.path.join(output,marker.get("chunklist",""))
+            if not os.path.isfile(cnk) or image_store.get_file_hash(cnk) != marker.get("chunklist_sha256"):
+                return None
+        if os.path.exists(image+downloader.JOURNAL_SUFFIX):
+            # Still mid-download
+            return None
+        try:
+            valid,error = chunklist.verify_file(image,chunklist.parse(cnk),threads)
+        except Exception:
+            return None
+        if not valid: return None
+        if not marker or marker.get("chunklist_sha256") is None:
+            self.write_marker(output,board_id,mlb,os_type,product)
+        return {
+            "returncode":0,
+            "product":product,
+            "image":image,
+            "chunklist":cnk,
+            "verified":True,
+            "store":None,
+            "skipped":True,
+            "error":None
+        }
+
+class Prefetch:
+
+    def __init__(self, runner, board_id, mlb, os_type, staging, image = False):
+        # Runs RecoveryRunner.prefetch() for a target on a background thread, into a
+        # staging folder of its own.  cancel() throws the work away, and promote()
+        # hands it over to a confirmed download.
+        self.runner = runner
+        self.target = (board_id,mlb,os_type)
+        self.staging = staging
+        self.image = image
+        self.stop = threading.Event()
+        self.lock = threading.Lock()
+        self.discard = False
+        self.finished = False
+        self.result = None
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def _run(self):
+        try:
+            self.result = self.runner.prefetch(self.target[0],self.target[1],self.target[2],self.staging,self.image,self.stop)
+        finally:
+            with self.lock:
+                self.finished = True
+                if self.discard:
+                    shutil.rmtree(self.staging,ignore_errors=True)
+
+    def is_for(self, board_id, mlb, os_type):
+        return self.target == (board_id,mlb,os_type)
+
+    def cancel(self):
+        # Stops the work and deletes whatever it staged - without waiting, the
+        # thread cleans up after itself if it's still going
+        with self.lock:
+            self.discard = True
+            self.stop.set()
+            if self.finished:
+                shutil.rmtree(self.staging,ignore_errors=True)
+
+    def promote(self, output):
+        # Stops any transfer still going (a partial image stays journaled), waits
+        # for the thread, and moves everything staged into output.  Returns the
+        # prefetch() result with its paths pointing into output - or None if there
+        # was nothing to hand over.
+        self.stop.set()
+        self.thread.join()
+        result = self.result
+        try:
+            if not result or self.discard or not result.get("info"):
+                return None
+            names = os.listdir(self.staging)
+            for name in names:
+                target = os.path.join(output,name)
+                # An older journal would describe some other copy of the file
+                for path in (target,target+downloader.JOURNAL_SUFFIX):
+                    if os.path.exists(path) and not os.path.basename(path) in names:
+                        os.remove(path)
+                if os.path.exists(target): os.remove(target)
+                shutil.move(os.path.join(self.staging,name),target)
+            for key in ("chunklist","image"):
+                if result.get(key):
+                    result[key] = os.path.join(output,os.path.basename(result[key]))
+            return result
+        except (IOError,OSError):
+            return None
+        finally:
+            shutil.rmtree(self.staging,ignore_errors=True)
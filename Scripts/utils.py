@@ -1,4 +1,4 @@
-import sys, os, time, re, json, datetime, ctypes, subprocess
+import sys, os, time, re, json
 
 if os.name == "nt":
     # Windows
@@ -25,6 +25,7 @@ class Utils:
         try:
             is_admin = os.getuid() == 0
         except AttributeError:
+            import ctypes
             is_admin = ctypes.windll.shell32.IsUserAnAdmin() != 0
         return is_admin
 
@@ -33,9 +34,11 @@ class Utils:
         if self.check_admin():
             return
         if os.name == "nt":
+            import ctypes
             ctypes.windll.shell32.ShellExecuteW(None, "runas", '"{}"'.format(sys.executable), '"{}"'.format(file), None, 1)
         else:
             try:
+                import subprocess
                 p = subprocess.Popen(["which", "sudo"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
                 c = p.communicate()[0].decode("utf-8", "ignore").replace("\n", "")
                 os.execv(c, [ sys.executable, 'python'] + sys.argv)
@@ -251,6 +254,7 @@ class Utils:
         print("www.reddit.com/u/corpnewt")
         print("www.github.com/corpnewt\n")
         # Get the time and wish them a good morning, afternoon, evening, and night
+        import datetime
         hr = datetime.datetime.now().time().hour
         if hr > 3 and hr < 12:
             print("Have a nice morning!\n\n")
@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+# Benchmarks the download stack against the local stand-in server in server.py and
+# compares the results to a stored baseline.
+#
+#   python benchmarks/bench.py                  run everything and compare
+#   python benchmarks/bench.py stream_to_file   run only the named cases
+#   python benchmarks/bench.py --save-baseline  run everything and store the results
+#
+# Each case runs in its own process so CPU time and peak RSS belong to it alone.
+# The startup cases time a fresh interpreter of their own, and are held to a
+# fixed budget on top of the baseline.
+import os, sys, json, time, shutil, argparse, tempfile, threading, subprocess
+try:
+    import resource
+except ImportError:
+    resource = None # Windows - no peak RSS
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0,ROOT)
+from Scripts import downloader, mirrors
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)),"baseline.json")
+MiB = 1048576
+
+def _stream(url, segments = 1, progress = False, renderer = None):
+    temp = tempfile.mkdtemp()
+    try:
+        d = downloader.Downloader(segments=segments,renderer=renderer)
+        path = d.stream_to_file(url,os.path.join(temp,"payload.bin"),progress)
+        return {"ok":path is not None,"bytes":os.path.getsize(path) if path else 0}
+    finally:
+        shutil.rmtree(temp,ignore_errors=True)
+
+def _get_bytes(url):
+    data = downloader.Downloader().get_bytes(url,False)
+    return {"ok":data is not None,"bytes":len(data or b"")}
+
+def _update_macrecovery(base, runs):
+    # Points a gibMacRecovery at throwaway copies of its support files, served
+    # by the stand-in - without running its __init__, which would touch the real
+    # ones.  The first update is cold, the rest revalidate with ETags.
+    import gibMacRecovery
+    temp = tempfile.mkdtemp()
+    devnull = open(os.devnull,"w")
+    stdout,stderr = sys.stdout,sys.stderr
+    try:
+        g = gibMacRecovery.gibMacRecovery.__new__(gibMacRecovery.gibMacRecovery)
+        g.interactive = False
+        g.d = downloader.Downloader()
+        for name in ("boards","macrecovery","recovery"):
+            file_name = "recovery_urls.txt" if name == "recovery" else name+(".json" if name == "boards" else ".py")
+            setattr(g,name+"_url",base+"/support/"+file_name)
+            setattr(g,name+"_path",os.path.join(temp,file_name))
+        g.mirror = None
+        g.mirror_scores = mirrors.MirrorScores(os.path.join(temp,"mirror_scores.json"))
+        g.cache_path = os.path.join(temp,"metadata_cache.json")
+        g.index_path = os.path.join(temp,"index.cache")
+        g.refresh_lock = threading.Lock()
+        g.refresh_thread = None
+        sys.stdout = sys.stderr = devnull
+        for _ in range(runs):
+            g.update_macrecovery()
+        sys.stdout,sys.stderr = stdout,stderr
+        ok = all(os.path.exists(x) for x in (g.boards_path,g.macrecovery_path,g.recovery_path)) and len(g.boards) > 0
+        return {"ok":ok,"bytes":sum(os.path.getsize(x) for x in (g.boards_path,g.macrecovery_path,g.recovery_path))}
+    finally:
+        sys.stdout,sys.stderr = stdout,stderr
+        devnull.close()
+        shutil.rmtree(temp,ignore_errors=True)
+
+def _get_startup_tree(temp):
+    # A copy of the script and Scripts folder with the stand-in support files in
+    # place, freshly checked - so startup never goes near the network
+    from server import _get_support_files
+    shutil.copy(os.path.join(ROOT,"gibMacRecovery.py"),temp)
+    scripts = os.path.join(temp,"Scripts")
+    os.makedirs(scripts)
+    for name in os.listdir(os.path.join(ROOT,"Scripts")):
+        if name.endswith(".py") or name == "colors.json":
+            shutil.copy(os.path.join(ROOT,"Scripts",name),scripts)
+    files = _get_support_files()
+    for name,data in files.items():
+        with open(os.path.join(scripts,name),"wb") as f:
+            f.write(data)
+    with open(os.path.join(scripts,"metadata_cache.json"),"w") as f:
+        json.dump(dict((name,{"checked":time.time()}) for name in files),f)
+    return temp
+
+def _time_startup(args, cwd, until = None):
+    # Seconds from spawning a python running args until it exits - or until it
+    # prints until, at which point it's killed
+    env = dict(os.environ,PYTHONDONTWRITEBYTECODE="1")
+    started = time.time()
+    p = subprocess.Popen([sys.executable]+args,cwd=cwd,env=env,stdin=subprocess.PIPE,stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
+    if until is None:
+        out = p.communicate()[0]
+        return (time.time()-started if p.returncode == 0 else None,out)
+    out = b""
+    while not until.encode() in out:
+        data = os.read(p.stdout.fileno(),65536)
+        if not data: break
+        out += data
+    wall = time.time()-started
+    p.kill()
+    p.communicate()
+    return (wall if until.encode() in out else None,out)
+
+def _startup(until_menu):
+    # Time to import gibMacRecovery - or to draw its main menu - from a fresh
+    # interpreter.  The first run compiles the .pyc files and builds the index
+    # cache, so only the second (warm) one is timed.
+    temp = tempfile.mkdtemp()
+    try:
+        tree = _get_startup_tree(temp)
+        if until_menu:
+            args,until = (["gibMacRecovery.py"],"Please select an option")
+        else:
+            args,until = (["-c","import gibMacRecovery"],None)
+        _time_startup(["-m","compileall","-q","."],tree)
+        _time_startup(args,tree,until)
+        wall,out = _time_startup(args,tree,until)
+        return {"ok":wall is not None,"bytes":0,"wall":round(wall,4) if wall else None}
+    finally:
+        shutil.rmtree(temp,ignore_errors=True)
+
+# name -> (description, function(base url, scale))
+CASES = [
+    ("get_bytes",("16MiB into memory",lambda base,s: _get_bytes(base+"/payload/{}".format(16*s*MiB)))),
+    ("get_bytes_gzip",("16MiB of gzipped text into memory",lambda base,s: _get_bytes(base+"/payload/{}?kind=text&gzip=1".format(16*s*MiB)))),
+    ("stream_to_file",("128MiB to disk over one connection",lambda base,s: _stream(base+"/payload/{}".format(128*s*MiB)))),
+    ("stream_to_file_segmented",("128MiB to disk over 4 segments",lambda base,s: _stream(base+"/payload/{}".format(128*s*MiB),4))),
+    ("stream_to_file_progress",("128MiB to disk with the progress renderer drawing to /dev/null",lambda base,s: _stream(
+        base+"/payload/{}".format(128*s*MiB),
+        progress=True,
+        renderer=downloader.ProgressRenderer(update_interval=0.05,stream=open(os.devnull,"w"))
+    ))),
+    ("stream_to_file_capped",("32MiB capped at 16MiB/s with 50ms latency",lambda base,s: _stream(base+"/payload/{}?rate=16M&latency=50".format(32*s*MiB)))),
+    ("stream_to_file_dropped",("32MiB with the connection cut every 8MiB",lambda base,s: _stream(base+"/payload/{}?drop=8M".format(32*s*MiB)))),
+    ("update_macrecovery",("update_macrecovery() - one cold fetch, then 4 revalidations",lambda base,s: _update_macrecovery(base,5))),
+    ("startup_import",("importing gibMacRecovery in a fresh interpreter",lambda base,s: _startup(False))),
+    ("startup_menu",("launching gibMacRecovery.py until the main menu is drawn",lambda base,s: _startup(True))),
+]
+
+# Hard limits in seconds of wall time - flagged whatever the baseline says
+BUDGETS = {
+    "startup_menu":0.1
+}
+
+def run_case(name, base, scale):
+    # Runs one case in this process and returns its measurements
+    func = dict(CASES)[name][1]
+    cpu = time.process_time() if hasattr(time,"process_time") else time.clock()
+    started = time.time()
+    result = func(base,scale)
+    wall = time.time()-started
+    cpu = (time.process_time() if hasattr(time,"process_time") else time.clock())-cpu
+    # Cases that time something outside this process report their own wall time
+    wall = result.get("wall") or wall
+    return dict(result,**{
+        "wall":round(wall,4),
+        "cpu":round(cpu,4),
+        "mb_s":round(result["bytes"]/float(MiB)/wall,2) if wall and result["bytes"] else None,
+        "cpu_s_per_gb":round(cpu/(result["bytes"]/float(1024*MiB)),3) if result["bytes"] else None,
+        "peak_rss_mb":get_peak_rss()
+    })
+
+def get_peak_rss():
+    # Peak RSS of this process in MiB - or None if we can't tell
+    try:
+        # Linux carries ru_maxrss over from the parent on fork, so prefer the
+        # high water mark of our own address space
+        with open("/proc/self/status","r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1])/1024.0,1)
+    except (IOError,OSError):
+        pass
+    if not resource: return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, everyone else KiB
+    return round(rss/float(MiB) if sys.platform == "darwin" else rss/1024.0,1)
+
+def run_child(name, base, scale):
+    # Runs a case in a fresh interpreter
+    p = subprocess.Popen(
+        [sys.executable,os.path.realpath(__file__),"--child",name,"--url",base,"--scale",str(scale)],
+        stdout=subprocess.PIPE,
+        cwd=ROOT
+    )
+    out = p.communicate()[0]
+    if p.returncode != 0:
+        return {"ok":False,"error":"exited with {}".format(p.returncode)}
+    return json.loads(out.decode().strip().split("\n")[-1])
+
+def best_of(results):
+    # The fastest run is the least disturbed by whatever else the machine was doing
+    ok = [x for x in results if x.get("ok")]
+    return min(ok,key=lambda x:x["wall"]) if ok else results[-1]
+
+def compare(name, result, baseline, tolerance):
+    # Returns a list of regressions against the baseline entry for name
+    base = baseline.get(name)
+    if not base: return []
+    problems = []
+    if base.get("ok") and not result.get("ok"):
+        problems.append("used to succeed")
+    if base.get("mb_s") and result.get("mb_s") is not None and result["mb_s"] < base["mb_s"]*(1-tolerance):
+        problems.append("MB/s {} -> {}".format(base["mb_s"],result["mb_s"]))
+    if base.get("cpu_s_per_gb") and result.get("cpu_s_per_gb") is not None and result["cpu_s_per_gb"] > base["cpu_s_per_gb"]*(1+tolerance):
+        problems.append("CPU s/GB {} -> {}".format(base["cpu_s_per_gb"],result["cpu_s_per_gb"]))
+    if not base.get("mb_s") and base.get("wall") and result.get("wall") is not None and result["wall"] > base["wall"]*(1+tolerance):
+        # Nothing transferred - the time taken is all there is to compare
+        problems.append("wall s {} -> {}".format(base["wall"],result["wall"]))
+    return problems
+
+def check_budget(name, result):
+    budget = BUDGETS.get(name)
+    if budget is None or not result.get("ok") or result["wall"] <= budget: return []
+    return ["over {}s budget".format(budget)]
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks Downloader against a local stand-in server.")
+    parser.add_argument("cases",nargs="*",help="cases to run (default: all) - one of: {}".format(", ".join(x[0] for x in CASES)))
+    parser.add_argument("-n","--repeat",type=int,default=3,help="runs per case - the best one is kept (default: 3)")
+    parser.add_argument("-s","--scale",type=int,default=1,help="multiply payload sizes by this (default: 1)")
+    parser.add_argument("-t","--tolerance",type=float,default=0.2,help="how far a result can fall behind the baseline before it's flagged (default: 0.2)")
+    parser.add_argument("--save-baseline",action="store_true",help="store the results as the new baseline")
+    parser.add_argument("--json",help="also write the results here")
+    parser.add_argument("--child",help=argparse.SUPPRESS)
+    parser.add_argument("--url",help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        print(json.dumps(run_case(args.child,args.url,args.scale)))
+        return 0
+    names = args.cases or [x[0] for x in CASES]
+    unknown = [x for x in names if not x in dict(CASES)]
+    if unknown:
+        parser.error("unknown case(s): {}".format(", ".join(unknown)))
+    from server import PayloadServer
+    server = PayloadServer().start()
+    try:
+        baseline = {}
+        if os.path.exists(BASELINE_PATH):
+            with open(BASELINE_PATH,"r") as f:
+                baseline = json.load(f).get("results",{})
+        results = {}
+        regressions = 0
+        print("{:<26} {:>9} {:>8} {:>8} {:>9} {:>8}  {}".format("case","MB/s","wall s","CPU s","CPU s/GB","RSS MB","vs baseline"))
+        for name in names:
+            # One untimed run first so the server has built (and gzipped) the payload
+            run_child(name,server.url,args.scale)
+            result = best_of([run_child(name,server.url,args.scale) for _ in range(max(1,args.repeat))])
+            results[name] = result
+            problems = compare(name,result,baseline,args.tolerance) if args.scale == 1 else []
+            problems.extend(check_budget(name,result))
+            regressions += bool(problems)
+            print("{:<26} {:>9} {:>8} {:>8} {:>9} {:>8}  {}".format(
+                name,
+                (result.get("mb_s") or "") if result.get("ok") else "failed",
+                result.get("wall",""),
+                result.get("cpu",""),
+                result.get("cpu_s_per_gb") or "",
+                result.get("peak_rss_mb") or "",
+                "; ".join(problems) if problems else ("ok" if name in baseline else "no baseline")
+            ))
+        if "stream_to_file" in results and "stream_to_file_progress" in results:
+            plain,drawn = results["stream_to_file"],results["stream_to_file_progress"]
+            if plain.get("ok") and drawn.get("ok"):
+                print("\nProgress renderer overhead: {:+.3f} CPU s per GB".format(drawn["cpu_s_per_gb"]-plain["cpu_s_per_gb"]))
+        output = {
+            "python":sys.version.split()[0],
+            "platform":sys.platform,
+            "scale":args.scale,
+            "results":results
+        }
+        if args.json:
+            with open(args.json,"w") as f:
+                json.dump(output,f,indent=2)
+        if args.save_baseline:
+            # Cases that weren't run keep their old baseline
+            saved = dict(output,results=dict(baseline,**results))
+            with open(BASELINE_PATH,"w") as f:
+                json.dump(saved,f,indent=2,sort_keys=True)
+            print("\nSaved baseline to {}".format(BASELINE_PATH))
+            return 0
+    finally:
+        server.shutdown()
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
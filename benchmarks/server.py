@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# Local stand-in for the servers gibMacRecovery talks to - serves synthetic payloads
+# so the download stack can be measured without hitting GitHub or Apple.
+#
+#   /payload/<size>          size bytes of data - size takes K, M, and G suffixes
+#   /support/boards.json     stand-ins for the files update_macrecovery() fetches
+#   /support/macrecovery.py
+#   /support/recovery_urls.txt
+#
+# Every path takes these query parameters:
+#
+#   latency=<ms>    wait this long before answering
+#   rate=<size>     cap each response at this many bytes/sec
+#   drop=<size>     cut the connection after sending this many bytes of a body
+#   gzip=1          gzip the body if the client accepts it (disables ranges)
+#   kind=text       compressible text instead of random data (payloads only)
+#
+# Range requests are honored, and every response carries an ETag - a matching
+# If-None-Match gets a 304.
+import os, sys, gzip, json, time, random, socket, threading
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from Scripts.downloader import parse_size
+
+BLOCK_SIZE = 1048576
+SEND_SIZE  = 65536
+
+def _get_block(kind):
+    # One deterministic MiB that payloads repeat
+    if kind == "text":
+        r = random.Random(0)
+        lines = []
+        size = 0
+        while size < BLOCK_SIZE:
+            line = '{{"board_id": "Mac-{:016X}", "mlb": "{:017d}"}}\n'.format(r.getrandbits(64),r.getrandbits(56))
+            lines.append(line)
+            size += len(line)
+        return "".join(lines).encode()[:BLOCK_SIZE]
+    r = random.Random(1)
+    return bytes(bytearray(r.getrandbits(8) for _ in range(BLOCK_SIZE)))
+
+def _get_support_files(boards = 2000):
+    # Synthetic boards.json, macrecovery.py and recovery_urls.txt - big enough to
+    # look like the real thing
+    r = random.Random(2)
+    versions = ["Lion","Mountain Lion","Mavericks","Yosemite","El Capitan","Sierra","High Sierra","Mojave","Catalina","Big Sur","Monterey","Ventura","Sonoma","latest"]
+    board_ids = ["Mac-{:016X}".format(r.getrandbits(64)) for _ in range(boards)]
+    boards_json = json.dumps(dict((b,versions[i % len(versions)]) for i,b in enumerate(board_ids)),indent=2)
+    recovery = []
+    for i,version in enumerate(versions):
+        recovery.append("{}:".format(version))
+        for b in board_ids[i::len(versions)][:40]:
+            recovery.append("./macrecovery.py -b {} -m {:017d} download".format(b,r.getrandbits(56)))
+        recovery.append("")
+    macrecovery = "# Stand-in for macrecovery.py\n" + "".join("def f{0}():\n    return {0}\n".format(i) for i in range(500))
+    return {
+        "boards.json":boards_json.encode(),
+        "recovery_urls.txt":"\n".join(recovery).encode(),
+        "macrecovery.py":macrecovery.encode()
+    }
+
+class PayloadHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _get_body(self, path, params):
+        # Returns (body, etag) - or (None, None) for a 404
+        if path.startswith("/payload/"):
+            size = parse_size(path.split("/")[-1])
+            kind = params.get("kind","random")
+            return (self.server.get_payload(size,kind),'"{}-{}"'.format(kind,size))
+        if path.startswith("/support/"):
+            body = self.server.support.get(path.split("/")[-1])
+            if body is not None:
+                return (body,'"support-{}"'.format(len(body)))
+        return (None,None)
+
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        params = dict((k,v[-1]) for k,v in parse_qs(parsed.query).items())
+        if params.get("latency"):
+            time.sleep(float(params["latency"])/1000.0)
+        body,etag = self._get_body(parsed.path,params)
+        if body is None:
+            self.send_response(404)
+            self.send_header("Content-Length","0")
+            self.end_headers()
+            return
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag",etag)
+            self.send_header("Content-Length","0")
+            self.end_headers()
+            return
+        status = 200
+        headers = [("ETag",etag)]
+        if params.get("gzip") == "1" and "gzip" in self.headers.get("Accept-Encoding",""):
+            body = self.server.get_gzipped(body,etag)
+            headers.append(("Content-Encoding","gzip"))
+        else:
+            headers.append(("Accept-Ranges","bytes"))
+            r = self.headers.get("Range","")
+            if r.startswith("bytes="):
+                start,end = r[6:].split("-")
+                start = int(start)
+                end = min(int(end),len(body)-1) if end else len(body)-1
+                headers.append(("Content-Range","bytes {}-{}/{}".format(start,end,len(body))))
+                body = body[start:end+1]
+                status = 206
+        self.send_response(status)
+        for k,v in headers:
+            self.send_header(k,v)
+        self.send_header("Content-Length",str(len(body)))
+        self.end_headers()
+        self._send(body,parse_size(params["rate"]) if params.get("rate") else None,parse_size(params["drop"]) if params.get("drop") else None)
+
+    def _send(self, body, rate, drop):
+        sent = 0
+        started = time.time()
+        # Slicing a memoryview doesn't copy - but py2's socket file writes a memoryview's
+        # repr rather than its contents, so slice the body itself there
+        view = memoryview(body) if sys.version_info >= (3,0) else body
+        limit = len(body) if drop is None else min(drop,len(body))
+        while sent < limit:
+            size = min(SEND_SIZE,limit-sent) if rate or drop is not None else limit-sent
+            self.wfile.write(view[sent:sent+size])
+            sent += size
+            if rate:
+                # Sleep off whatever we sent ahead of the cap
+                ahead = sent/float(rate)-(time.time()-started)
+                if ahead > 0: time.sleep(ahead)
+        if sent < len(body):
+            # Simulate the connection dropping mid-body
+            self.wfile.flush()
+            try: self.connection.shutdown(socket.SHUT_RDWR)
+            except socket.error: pass
+            self.close_connection = True
+
+class PayloadServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address = ("127.0.0.1",0)):
+        HTTPServer.__init__(self,address,PayloadHandler)
+        self.blocks = {}
+        self.payloads = {}
+        self.gzipped = {}
+        self.lock = threading.Lock()
+        self.support = _get_support_files()
+
+    def handle_error(self, request, client_address):
+        # Clients hanging up mid-body are expected - don't spew tracebacks
+        if not isinstance(sys.exc_info()[1],socket.error):
+            HTTPServer.handle_error(self,request,client_address)
+
+    @property
+    def url(self):
+        return "http://{}:{}".format(*self.server_address[:2])
+
+    def get_payload(self, size, kind):
+        with self.lock:
+            key = (size,kind)
+            if not key in self.payloads:
+                if not kind in self.blocks:
+                    self.blocks[kind] = _get_block(kind)
+                block = self.blocks[kind]
+                self.payloads[key] = (block*(size//BLOCK_SIZE+1))[:size]
+            return self.payloads[key]
+
+    def get_gzipped(self, body, etag):
+        with self.lock:
+            if not etag in self.gzipped:
+                self.gzipped[etag] = gzip.compress(body) if hasattr(gzip,"compress") else _gzip(body)
+            return self.gzipped[etag]
+
+    def start(self):
+        # Serves on a background thread - returns self
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+        return self
+
+def _gzip(data):
+    # Python 2 has no gzip.compress()
+    import io
+    out = io.BytesIO()
+    with gzip.GzipFile(fileobj=out,mode="wb") as f:
+        f.write(data)
+    return out.getvalue()
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
+    server = PayloadServer(("127.0.0.1",port))
+    print("Serving on {}".format(server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -1,11 +1,30 @@
 #!/usr/bin/env python
-from Scripts import downloader,utils
+from Scripts import utils,recovery_index
 from collections import OrderedDict
-import os, shutil, sys, json, subprocess
+import os, sys, json, threading, time
+
+# Built the first time they're used rather than in __init__ - none of them are
+# needed to draw the main menu.  The download stack (ssl, http.client, urllib)
+# is only imported by whatever needs it first.
+LAZY_ATTRIBUTES = ("d","store","runner","mirror_scores","boards","recovery","index")
+
+# Shown in the main menu's header while a background update is running
+REFRESH_STARTED = "Checking for updates in the background..."
+
+# What's fetched ahead of time once a target is selected - off, the image info
+# and chunklist (plus a warm connection to the image's server), or all that and
+# the image itself
+PREFETCH_MODES = ("off","metadata","image")
 
 class gibMacRecovery:
-    def __init__(self):
-        self.d = downloader.Downloader()
+    lazy_lock = threading.RLock()
+
+    def __init__(self, interactive = True, scheduler = None, metrics_file = None, mirror = None):
+        self.interactive = interactive
+        # Every transfer goes through the scheduler - pass one to cap bandwidth and
+        # connections.  metrics_file gets a JSON line per transfer event.
+        self.scheduler = scheduler
+        self.metrics_file = metrics_file
         self.u = utils.Utils("gibMacRecovery")
         if sys.version_info < (3,0):
             # Use the macrecovery-legacy.py fork
@@ -16,85 +35,327 @@ class gibMacRecovery:
         self.boards_url = "https://raw.githubusercontent.com/acidanthera/OpenCorePkg/master/Utilities/macrecovery/boards.json"
         self.boards_path = os.path.join(os.path.dirname(os.path.realpath(__file__)),"Scripts",os.path.basename(self.boards_url))
         self.macrecovery_path = os.path.join(os.path.dirname(os.path.realpath(__file__)),"Scripts",os.path.basename(self.macrecovery_url))
-        self.recovery_url = "https://github.com/acidanthera/OpenCorePkg/raw/master/Utilities/macrecovery/recovery_urls.txt"
+        self.recovery_url = "https://raw.githubusercontent.com/acidanthera/OpenCorePkg/master/Utilities/macrecovery/recovery_urls.txt"
         self.recovery_path = os.path.join(os.path.dirname(os.path.realpath(__file__)),"Scripts",os.path.basename(self.recovery_url))
+        self.cache_path = os.path.join(os.path.dirname(os.path.realpath(__file__)),"Scripts","metadata_cache.json")
+        self.index_path = os.path.join(os.path.dirname(os.path.realpath(__file__)),"Scripts","index.cache")
+        # Each of the urls above is also served by GitHub's other raw endpoint - and
+        # optionally by a local mirror (a base url serving the files by name).
+        # They're raced on every update, and how fast each answered is remembered
+        # so the quickest goes first next time.
+        self.mirror = mirror or os.environ.get("GIBMACRECOVERY_MIRROR") or None
+        self.mirror_scores_path = os.path.join(os.path.dirname(os.path.realpath(__file__)),"Scripts","mirror_scores.json")
         self.output = os.path.join(os.path.dirname(os.path.realpath(__file__)),"com.apple.recovery.boot")
+        # Drive macrecovery.py's functions directly when we can - the legacy fork
+        # for python 2 is always run as a subprocess
+        self.in_process = True
+        # Verified images are kept here keyed by their chunklist so targets that share
+        # an image only download it once
+        self.store_path = os.path.join(os.path.dirname(os.path.realpath(__file__)),"image_store")
+        # The least recently used images are evicted once the store grows past this -
+        # set GIBMACRECOVERY_STORE_LIMIT to a size like "20G", or "off" for no limit
+        self.store_limit = os.environ.get("GIBMACRECOVERY_STORE_LIMIT") or "10G"
+        # Speculative prefetching is opt-in - set GIBMACRECOVERY_PREFETCH to one of
+        # PREFETCH_MODES, or cycle through them from the menu.  Each prefetch stages
+        # its files in a folder of its own under prefetch_path, and its image info is
+        # only reused for prefetch_max_age seconds since Apple's asset tokens expire.
+        mode = (os.environ.get("GIBMACRECOVERY_PREFETCH") or "off").lower()
+        self.prefetch_mode = mode if mode in PREFETCH_MODES else "metadata" if mode in ("1","on","yes","true") else "off"
+        self.prefetch_path = os.path.join(os.path.dirname(os.path.realpath(__file__)),".prefetch")
+        self.prefetch_max_age = 300
+        self.prefetch_job = None
+        self.prefetch_swept = False
         self.min_w = 80
         self.min_h = 24
         if os.name == "nt":
             self.min_w = 120
             self.min_h = 30
-        if not os.path.exists(self.boards_path) or not os.path.exists(self.macrecovery_path) or not os.path.exists(self.recovery_path):
+        # The menu keeps the support files current from a background thread - it's
+        # started after the first paint, and checks again once refresh_interval
+        # seconds have passed since the last check
+        self.refresh_interval = 86400
+        self.refresh_lock = threading.Lock()
+        self.refresh_thread = None
+        self.refresh_status = None
+        if not self.interactive and any(not os.path.exists(x[0]) for x in self.get_support_files()):
+            # Batch mode has no menu to hide a download behind - and needs the files
             self.update_macrecovery()
-        self.boards = OrderedDict()
-        if os.path.exists(self.boards_path):
-            try: self.boards = json.load(open(self.boards_path))
-            except: pass
-        self.recovery = self.parse_recovery()
         self.target_macos = None
         self.target_mac = None
         self.target_mlb = "00000000000000000"
         self.latest_default = "default"
 
+    def __getattr__(self, name):
+        # Only called for attributes that aren't set yet - builds the lazy ones
+        if not name in LAZY_ATTRIBUTES:
+            raise AttributeError(name)
+        with self.lazy_lock:
+            if not name in self.__dict__:
+                if name in ("boards","recovery","index"):
+                    self.load_data()
+                else:
+                    getattr(self,"load_"+name)()
+        return self.__dict__[name]
+
+    def load_d(self):
+        from Scripts import downloader
+        self.d = downloader.Downloader(scheduler=self.scheduler,metrics_file=self.metrics_file)
+
+    def load_store(self):
+        from Scripts import image_store, downloader
+        limit = None
+        if not str(self.store_limit).lower() in ("off","none",""):
+            try:
+                limit = downloader.parse_size(self.store_limit)
+            except ValueError:
+                pass
+        self.store = image_store.ImageStore(self.store_path,max_size=limit)
+
+    def load_runner(self):
+        from Scripts import recovery_runner
+        self.runner = recovery_runner.RecoveryRunner(self.macrecovery_path,self.d,self.store)
+
+    def load_mirror_scores(self):
+        from Scripts import mirrors
+        self.mirror_scores = mirrors.MirrorScores(self.mirror_scores_path)
+
+    def load_cache(self):
+        # Returns the ETag/Last-Modified values we saved for each file last time
+        if not os.path.exists(self.cache_path):
+            return {}
+        try:
+            with open(self.cache_path,"r") as f:
+                cache = json.load(f)
+            assert isinstance(cache,dict)
+            return cache
+        except:
+            return {}
+
+    def save_cache(self, cache):
+        try:
+            with open(self.cache_path,"w") as f:
+                json.dump(cache,f,indent=2)
+        except:
+            pass
+
+    def get_support_urls(self, url):
+        # Every mirror of url - fastest first
+        from Scripts import mirrors
+        return self.mirror_scores.order(mirrors.get_mirror_urls(url,self.mirror))
+
+    def get_conditional_headers(self, cache, path, urls):
+        # Only ask the server if our copy changed when we actually have a copy that
+        # came from one of the same urls
+        headers = dict(self.d.ua)
+        entry = cache.get(os.path.basename(path),{})
+        if not os.path.exists(path) or not entry.get("url") in urls:
+            return headers
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def validate_support_file(self, path, name):
+        # Make sure a freshly downloaded file is usable before we swap it in
+        try:
+            if name == os.path.basename(self.boards_path):
+                with open(path,"r") as f:
+                    boards = json.load(f)
+                return isinstance(boards,dict) and len(boards) > 0
+            if name == os.path.basename(self.recovery_path):
+                return len(self.parse_recovery(path)) > 0
+            with open(path,"r") as f:
+                compile(f.read(),name,"exec")
+            return True
+        except:
+            return False
+
+    def fetch_support_file(self, path, url, staging, cache, results):
+        # Downloads a single file into the staging folder and records how it went
+        from Scripts import downloader
+        name = os.path.basename(path)
+        staged = os.path.join(staging,name)
+        urls = self.get_support_urls(url)
+        info = {}
+        try:
+            self.d.stream_to_file(urls[0],staged,False,headers=self.get_conditional_headers(cache,path,urls),info=info,priority=downloader.PRIORITY_METADATA,mirrors=urls[1:])
+        except Exception as e:
+            info["error"] = str(e)
+        self.mirror_scores.record_race(info.get("mirrors"))
+        if info.get("status") == 304:
+            results[name] = (None,"already up to date",info)
+        elif not os.path.exists(staged) or not 200 <= (info.get("status") or 0) < 300:
+            results[name] = (None,"failed to download{}".format(" ({})".format(info["status"]) if info.get("status") else ""),info)
+        elif not self.validate_support_file(staged,name):
+            results[name] = (None,"failed validation",info)
+        else:
+            results[name] = (staged,"updated",info)
+
+    def replace_file(self, source, target):
+        # os.replace() is atomic, but only exists on python 3
+        if hasattr(os,"replace"):
+            return os.replace(source,target)
+        if os.name == "nt" and os.path.exists(target):
+            os.remove(target)
+        os.rename(source,target)
+
+    def get_support_files(self):
+        # (path, url) for every file update_macrecovery() keeps current
+        return ((self.boards_path,self.boards_url),(self.macrecovery_path,self.macrecovery_url),(self.recovery_path,self.recovery_url))
+
+    def needs_refresh(self):
+        # True if any support file is missing, or hasn't been checked against the
+        # server within refresh_interval seconds
+        cache = self.load_cache()
+        for path,url in self.get_support_files():
+            if not os.path.exists(path):
+                return True
+            checked = cache.get(os.path.basename(path),{}).get("checked")
+            if not isinstance(checked,(int,float)) or not 0 <= time.time()-checked < self.refresh_interval:
+                return True
+        return False
+
+    def refresh_support_files(self):
+        # Fetches every support file at once and swaps them in only if all of them
+        # checked out.  Prints nothing - returns a tuple of (statuses, replaced)
+        # where statuses lists (name, status) per file, and replaced lists the
+        # names swapped in - or is None if nothing was.
+        import shutil, tempfile
+        with self.refresh_lock:
+            cache = self.load_cache()
+            files = self.get_support_files()
+            # Stage everything next to the real files so the final renames stay on the
+            # same filesystem
+            staging = tempfile.mkdtemp(prefix=".staging-",dir=os.path.dirname(self.boards_path))
+            try:
+                results = {}
+                threads = []
+                for path,url in files:
+                    t = threading.Thread(target=self.fetch_support_file,args=(path,url,staging,cache,results))
+                    t.daemon = True
+                    t.start()
+                    threads.append(t)
+                for t in threads:
+                    t.join()
+                statuses = [(os.path.basename(x[0]),results[os.path.basename(x[0])][1]) for x in files]
+                if any(results[name][0] is None and results[name][2].get("status") != 304 for name,status in statuses):
+                    # Leave what's on disk alone - a mix of old and new is worse than old
+                    return (statuses,None)
+                # Everything checked out - swap the new files in
+                replaced = []
+                checked = time.time()
+                for path,url in files:
+                    name = os.path.basename(path)
+                    staged,status,info = results[name]
+                    if staged is not None:
+                        self.replace_file(staged,path)
+                        replaced.append(name)
+                        cache[name] = {
+                            "url":info.get("mirror") or url,
+                            "etag":info["headers"].get("ETag"),
+                            "last_modified":info["headers"].get("Last-Modified")
+                        }
+                    cache.setdefault(name,{})["checked"] = checked
+                self.save_cache(cache)
+                return (statuses,replaced)
+            finally:
+                shutil.rmtree(staging,ignore_errors=True)
+                self.mirror_scores.save()
+
     def update_macrecovery(self):
-        self.u.head("Downloading Required Files")
-        print("")
+        if self.interactive:
+            self.u.head("Downloading Required Files")
+            print("")
         try:
-            for path,url in ((self.boards_path,self.boards_url),(self.macrecovery_path,self.macrecovery_url),(self.recovery_path,self.recovery_url)):
-                print("Downloading {}...".format(os.path.basename(path)))
-                self.d.stream_to_file(url,path,False)
+            self.log("Downloading {}...".format(", ".join(os.path.basename(x[0]) for x in self.get_support_files())))
+            if self.refreshing():
+                self.log("Waiting on the background update...")
+            statuses,replaced = self.refresh_support_files()
+            for name,status in statuses:
+                self.log(" - {} {}".format(name,status))
+            if replaced is None:
+                self.log("\nNo files were replaced.")
         except Exception as e:
-            print("Something went wrong:\n{}\n".format(e))
-            self.u.grab("Press [enter] to return...")
+            self.log("Something went wrong:\n{}\n".format(e))
+            if self.interactive: self.u.grab("Press [enter] to return...")
             return
-        if os.path.exists(self.boards_path):
-            try: self.boards = json.load(open(self.boards_path))
-            except: pass
-        self.recovery = self.parse_recovery()
-        print("\nDone.\n")
-        self.u.grab("Returning in 5 seconds...",timeout=5)
-
-    def parse_recovery(self):
-        if not os.path.exists(self.recovery_path):
-            return OrderedDict()
-        with open(self.recovery_path,"r") as f:
-            r = f.read()
-        r_dict = OrderedDict()
-        last_os = None
-        for line in r.split("\n"):
-            if not line.strip(): continue # Skip empty lines
-            if line.lower().startswith(("diagnostics","default")):
-                last_os = None
-                continue
-            if line.startswith("./") and last_os and not "<" in line:
-                # Got some info - let's get the 3rd and 5th elements
-                try:
-                    parts = line.split()
-                    comm_list = r_dict.get(last_os,[])
-                    comm_list.append({
-                        "board_id":parts[2],
-                        "mlb":parts[4]
-                    })
-                    r_dict[last_os] = comm_list
-                except:
-                    continue
-            elif not line.startswith("./"):
-                last_os = line.strip().rstrip(":").replace(" version","")
-        return r_dict            
+        self.load_data()
+        self.log("\nDone.\n")
+        if self.interactive: self.u.grab("Returning in 5 seconds...",timeout=5)
+
+    def log(self, text = ""):
+        # Progress meant for a person - batch mode writes its results to stdout, so
+        # this goes to stderr there
+        stream = sys.stdout if self.interactive else sys.stderr
+        stream.write(text+"\n")
+        stream.flush()
+
+    def refreshing(self):
+        return self.refresh_thread is not None and self.refresh_thread.is_alive()
+
+    def start_refresh(self):
+        # Updates the support files on a background thread - the menu stays usable
+        # meanwhile, and picks the new data up once it's been validated and swapped in
+        if self.refreshing(): return
+        self.refresh_status = REFRESH_STARTED
+        self.refresh_thread = threading.Thread(target=self.background_refresh)
+        self.refresh_thread.daemon = True
+        self.refresh_thread.start()
+
+    def background_refresh(self):
+        try:
+            statuses,replaced = self.refresh_support_files()
+        except Exception as e:
+            self.refresh_status = "Update failed ({})".format(e)
+            return
+        if replaced is None:
+            failed = [name for name,status in statuses if status.startswith("failed")]
+            self.refresh_status = "Update failed for {} - nothing was replaced".format(
+                failed[0] if len(failed) == 1 else "{} of {} files".format(len(failed),len(statuses))
+            )
+        elif replaced:
+            self.load_data()
+            self.refresh_status = "Updated {} at {}".format(", ".join(replaced),time.strftime("%H:%M"))
+        else:
+            self.refresh_status = "Up to date as of {}".format(time.strftime("%H:%M"))
+
+    def load_data(self):
+        # Pulls boards.json and recovery_urls.txt from the compiled index - which
+        # only reparses them if they changed since last time
+        try:
+            boards,recovery = recovery_index.load(self.boards_path,self.recovery_path,self.index_path)
+        except:
+            boards,recovery = OrderedDict(),OrderedDict()
+        index = recovery_index.RecoveryIndex(boards,recovery)
+        # A background update can land while the menu is using the old data - swap
+        # all three in together
+        with self.lazy_lock:
+            self.boards,self.recovery,self.index = boards,recovery,index
+
+    def parse_recovery(self, path = None):
+        return recovery_index.parse_recovery(path or self.recovery_path)
 
     def resize(self, width=0, height=0):
         self.u.resize(max(width,self.min_w),max(height,self.min_h))
 
     def select_target_macos(self):
-        if not self.boards:
+        # Hold onto the data for the whole screen - a background update can swap
+        # in new data while we wait on input
+        with self.lazy_lock:
+            boards,index = self.boards,self.index
+        if not boards:
             self.u.head("Select Target macOS Version")
             print("")
             print("No macOS versions found!  Make sure boards.json is in the Scripts directory,")
             print("and is a valid json file!")
             print("")
+            if self.refreshing():
+                print("It's still being downloaded in the background - try again in a moment.")
+                print("")
             self.u.grab("Press [enter] to return...")
             return (self.target_macos,self.target_mac,self.target_mlb,self.latest_default)
-        os_list = sorted(list(set(self.boards.values())),reverse=True)
+        os_list = index.os_versions()
         while True:
             lines = [""]
             lines.append("     Target macOS: {}".format(self.target_macos))
@@ -123,10 +384,9 @@ class gibMacRecovery:
                 continue
             # We have a valid menu item - let's get the OS version, and the first
             # mac model
-            for mac in self.boards:
-                if self.boards[mac].lower() == os_list[menu]:
-                    # Got it
-                    return (os_list[menu],mac,"00000000000000000","latest" if "latest" in os_list[menu].lower() else "default")
+            boards = index.boards_for_os(os_list[menu])
+            if boards:
+                return (os_list[menu],boards[0],"00000000000000000","latest" if recovery_index.is_latest(os_list[menu]) else "default")
 
     def input_mac_model(self):
         while True:
@@ -154,7 +414,7 @@ class gibMacRecovery:
                 continue
             # Got a valid format - return it and any matching macOS version
             model = "Mac-"+menu
-            macos = self.boards.get(model,"Unknown")
+            macos = self.index.os_for_board(model,"Unknown")
             return (macos,model,self.target_mlb,self.latest_default)
     
     def input_mlb(self):
@@ -181,15 +441,22 @@ class gibMacRecovery:
             return (self.target_macos,self.target_mac,mlb,self.latest_default)
 
     def select_target_recovery(self):
-        if not self.recovery:
+        # Hold onto the data for the whole screen - a background update can swap
+        # in new data while we wait on input
+        with self.lazy_lock:
+            recovery,index = self.recovery,self.index
+        if not recovery:
             self.u.head("Select Target From recovery_urls.txt")
             print("")
             print("No macOS versions found!  Make sure recovery_urls.txt is in the Scripts")
             print("directory!")
             print("")
+            if self.refreshing():
+                print("It's still being downloaded in the background - try again in a moment.")
+                print("")
             self.u.grab("Press [enter] to return...")
             return (self.target_macos,self.target_mac,self.target_mlb,self.latest_default)
-        os_list = list(self.recovery)[::-1] # Sort latest -> oldest
+        os_list = index.recovery_os_versions() # Sort latest -> oldest
         while True:
             lines = [""]
             lines.append("     Target macOS: {}".format(self.target_macos))
@@ -198,7 +465,7 @@ class gibMacRecovery:
             lines.append("          OS Type: {}".format(self.latest_default))
             lines.append("")
             for i,v in enumerate(os_list,start=1):
-                lines.append("{}. {} ({:,} total)".format(str(i).rjust(2),v,len(self.recovery[v])))
+                lines.append("{}. {} ({:,} total)".format(str(i).rjust(2),v,len(recovery[v])))
             lines.append("")
             lines.append("M. Main Menu")
             lines.append("Q. Quit")
@@ -214,19 +481,20 @@ class gibMacRecovery:
                 self.u.custom_quit()
             try:
                 menu = int(menu)-1
-                assert 0 <= menu < len(self.recovery)
+                assert 0 <= menu < len(os_list)
             except:
                 continue
             # We have a valid menu item - let's get the info needed
             macos = os_list[menu]
-            index = 0
-            if len(self.recovery[macos]) > 1:
+            entries = index.entries_for_os(macos)
+            choice = 0
+            if len(entries) > 1:
                 while True:
                     lines = [""]
-                    lines.append("{} has {:,} urls:".format(macos,len(self.recovery[macos])))
+                    lines.append("{} has {:,} urls:".format(macos,len(entries)))
                     lines.append("")
-                    for i,v in enumerate(self.recovery[macos],start=1):
-                        lines.append("{}. {} - {}".format(str(i),v["board_id"],v["mlb"]))
+                    for i,v in enumerate(entries,start=1):
+                        lines.append("{}. {} - {}".format(str(i),v.board_id,v.mlb))
                     lines.append("")
                     lines.append("M. Main Menu")
                     lines.append("Q. Quit")
@@ -242,16 +510,192 @@ class gibMacRecovery:
                         self.u.custom_quit()
                     try:
                         menu = int(menu)-1
-                        assert 0 <= menu < len(self.recovery[macos])
+                        assert 0 <= menu < len(entries)
                     except:
                         continue
-                    index = menu
+                    choice = menu
                     break            
-            model = self.recovery[macos][index]["board_id"]
-            mlb   = self.recovery[macos][index]["mlb"]
-            ld    = "latest" if "latest" in macos.lower() else "default"
+            model = entries[choice].board_id
+            mlb   = entries[choice].mlb
+            ld    = "latest" if recovery_index.is_latest(macos) else "default"
             return (macos,model,mlb,ld)
 
+    def get_macrecovery_args(self, board_id, mlb, os_type, output):
+        return [self.macrecovery_path,"-b",board_id,"-m",mlb,"-o",output,"-os",os_type,"download"]
+
+    def use_in_process(self):
+        return self.in_process and self.runner.available()
+
+    def run_macrecovery(self, board_id, mlb, os_type, output, log = None, progress = True, prefetched = None):
+        # Downloads the passed target with macrecovery.py and returns a result dict
+        # with at least the returncode and which mode was used.  In-process runs
+        # do the transfers with our Downloader (picking up from prefetched - see
+        # take_prefetch()) - otherwise we spawn the script, and if log is a path,
+        # its output is captured there instead of the console.
+        if self.use_in_process():
+            result = self.runner.download(board_id,mlb,os_type,output,progress,prefetched=prefetched)
+            result["mode"] = "in-process"
+            return result
+        import subprocess
+        args = self.get_macrecovery_args(board_id,mlb,os_type,output)
+        if log is None:
+            p = subprocess.Popen([sys.executable]+args)
+            code = p.wait()
+        else:
+            with open(log,"wb") as f:
+                p = subprocess.Popen([sys.executable]+args,stdout=f,stderr=subprocess.STDOUT)
+                code = p.wait()
+        if code == 0:
+            # Remember what landed here so a rerun can skip it
+            self.runner.write_marker(output,board_id,mlb,os_type)
+        return {"returncode":code,"mode":"subprocess"}
+
+    def update_prefetch(self):
+        # Keeps the speculative prefetch in step with the selected target - work for
+        # a target that's no longer selected is stopped and cleaned up, and the new
+        # target (if any) gets started on
+        target = (self.target_mac,self.target_mlb,self.latest_default)
+        image = self.prefetch_mode == "image" and not self.get_partial_downloads(self.output)
+        job = self.prefetch_job
+        if job and job.is_for(*target) and job.image == image and self.prefetch_mode != "off":
+            return
+        if job:
+            job.cancel()
+            self.prefetch_job = None
+        if self.prefetch_mode == "off" or not self.target_mac or not self.target_mlb or not self.use_in_process():
+            return
+        import shutil, tempfile
+        from Scripts import recovery_runner
+        if not self.prefetch_swept:
+            # Anything left from an earlier run is of no use now
+            shutil.rmtree(self.prefetch_path,ignore_errors=True)
+            self.prefetch_swept = True
+        try:
+            if not os.path.isdir(self.prefetch_path):
+                os.makedirs(self.prefetch_path)
+            staging = tempfile.mkdtemp(prefix="prefetch-",dir=self.prefetch_path)
+        except (IOError,OSError):
+            return
+        self.prefetch_job = recovery_runner.Prefetch(self.runner,target[0],target[1],target[2],staging,image).start()
+
+    def take_prefetch(self, output):
+        # Hands the prefetch for the selected target over to its download - moving
+        # what it staged into output.  Returns what runner.download() takes as
+        # prefetched, or None.
+        job,self.prefetch_job = self.prefetch_job,None
+        if not job: return None
+        if not job.is_for(self.target_mac,self.target_mlb,self.latest_default):
+            job.cancel()
+            return None
+        prefetched = job.promote(output)
+        if prefetched and time.time()-(prefetched.get("fetched") or 0) > self.prefetch_max_age:
+            # Its asset tokens have likely expired - ask for fresh ones
+            prefetched["info"] = None
+        return prefetched
+
+    def get_prefetch_status(self):
+        job = self.prefetch_job
+        if not job: return None
+        if job.thread.is_alive():
+            return "{} in the background...".format("Fetching the image" if job.image else "Fetching image info")
+        if not job.result or job.result.get("error"):
+            return "Failed ({})".format(job.result.get("error") if job.result else "no result")
+        return "{} ready".format("Image" if job.result.get("verified") else "Image info and chunklist")
+
+    def check_existing(self, board_id, mlb, os_type, output):
+        # Returns a result dict if output already holds a verified image for the
+        # target - None if it needs downloading
+        if not os.path.isdir(output): return None
+        try:
+            return self.runner.check_existing(board_id,mlb,os_type,output)
+        except Exception:
+            return None
+
+    def get_partial_downloads(self, output):
+        # Returns the names of files in output with a sidecar journal - downloads
+        # that were interrupted and can pick up where they left off
+        from Scripts import downloader
+        try:
+            names = os.listdir(output)
+        except OSError:
+            return []
+        suffix = downloader.JOURNAL_SUFFIX
+        return sorted(x[:-len(suffix)] for x in names if x.endswith(suffix) and x[:-len(suffix)] in names)
+
+    def owns_output(self, output):
+        # True if output is ours to clear - it doesn't exist yet, is empty, or holds
+        # the marker prepare_output() leaves in every folder it sets up
+        from Scripts import recovery_runner
+        if not os.path.exists(output): return True
+        if not os.path.isdir(output): return False
+        names = os.listdir(output)
+        return not names or recovery_runner.MARKER_NAME in names
+
+    def get_output_folder(self, output):
+        # Where a batch target asking for output actually downloads to - output
+        # itself if we own it, otherwise a com.apple.recovery.boot inside it.
+        # Raises ValueError if neither is ours.
+        if self.owns_output(output): return output
+        nested = os.path.join(output,os.path.basename(self.output))
+        if os.path.isdir(output) and self.owns_output(nested): return nested
+        raise ValueError("Output folder holds files gibMacRecovery didn't put there: {}".format(output))
+
+    def prepare_output(self, output, keep_partial = False):
+        # Clears out and recreates the output folder - returning a list of the
+        # steps taken so the caller can report them.  With keep_partial, any
+        # interrupted downloads are left in place to resume.  Only our own
+        # com.apple.recovery.boot and folders we own (see owns_output()) are ever
+        # cleared - anything else raises ValueError.
+        import shutil
+        from Scripts import downloader, recovery_runner
+        if output != self.output and not self.owns_output(output):
+            raise ValueError("Refusing to clear a folder gibMacRecovery didn't create: {}".format(output))
+        steps = []
+        partial = self.get_partial_downloads(output) if keep_partial else []
+        if partial:
+            steps.append("Keeping partial {} in {}...".format(", ".join(partial),os.path.basename(output)))
+            keep = partial+[x+downloader.JOURNAL_SUFFIX for x in partial]
+            for name in os.listdir(output):
+                if name in keep: continue
+                path = os.path.join(output,name)
+                if os.path.isdir(path):
+                    shutil.rmtree(path,ignore_errors=True)
+                else:
+                    os.remove(path)
+        elif os.path.exists(output):
+            steps.append("{} already exists - removing...".format(os.path.basename(output)))
+            shutil.rmtree(output,ignore_errors=True)
+        if not os.path.exists(output):
+            steps.append("Creating {}...".format(os.path.basename(output)))
+            os.makedirs(output)
+        marker = os.path.join(output,recovery_runner.MARKER_NAME)
+        if not os.path.exists(marker):
+            # Claim the folder so a rerun knows it's safe to clear - the marker is
+            # filled in once a download lands
+            with open(marker,"w") as f:
+                json.dump({},f)
+        return steps
+
+    def clear_store(self):
+        self.u.head("Clear Image Store")
+        print("")
+        count,size = self.store.usage()
+        if not count:
+            print("The image store is empty.")
+            print("")
+            self.u.grab("Press [enter] to return...")
+            return
+        print("The image store holds {:,} image{} using {}.".format(count,"" if count == 1 else "s",self.d.get_size(size)))
+        print("Images linked into output folders are left where they are.")
+        print("")
+        menu = self.u.grab("Clear it? (y/n):  ")
+        if not menu.lower() == "y": return
+        self.store.clear()
+        print("")
+        print("Cleared.")
+        print("")
+        self.u.grab("Press [enter] to return...")
+
     def download_macos(self):
         if not self.target_mac: return # wut
         self.u.head("Downloading macOS Recovery")
@@ -261,25 +705,112 @@ class gibMacRecovery:
         print("       Target MLB: {}".format(self.target_mlb))
         print("          OS Type: {}".format(self.latest_default))
         print("")
-        if os.path.exists(self.output):
-            print("{} already exists - removing...".format(os.path.basename(self.output)))
-            shutil.rmtree(self.output,ignore_errors=True)
-        if not os.path.exists(self.output):
-            print("Creating {}...".format(os.path.basename(self.output)))
-            os.mkdir(self.output)
-        args = [self.macrecovery_path,"-b",self.target_mac,"-m",self.target_mlb,"-o",self.output,"-os",self.latest_default]
-        args.append("download")
-        display_args = [os.path.basename(args[0])]+args[1:]
-        print("")
-        print("Running command:\n")
-        print(" ".join(display_args))
+        if os.path.isdir(self.output):
+            print("Checking existing {}...".format(os.path.basename(self.output)))
+            existing = self.check_existing(self.target_mac,self.target_mlb,self.latest_default,self.output)
+            if existing:
+                print("{} already holds a verified {} - skipping download.".format(
+                    os.path.basename(self.output),
+                    existing["product"] or os.path.basename(existing["image"])
+                ))
+                print("")
+                self.u.grab("Press [enter] to return...")
+                return
+        for step in self.prepare_output(self.output,keep_partial=self.use_in_process()):
+            print(step)
         print("")
-        p = subprocess.Popen([sys.executable]+args)
-        p.wait()
+        if self.use_in_process():
+            prefetched = self.take_prefetch(self.output)
+            if prefetched:
+                print("Picking up from the prefetched {}...".format("image" if prefetched.get("verified") else "image info and chunklist"))
+            print("Downloading with {}...".format(os.path.basename(self.macrecovery_path)))
+            print("")
+            result = self.run_macrecovery(self.target_mac,self.target_mlb,self.latest_default,self.output,prefetched=prefetched)
+            print("")
+            if result["returncode"] == 0 and result["store"] and result["store"].startswith("hit"):
+                print("Used stored copy of {} - {}.".format(result["product"] or "image",result["store"]))
+            elif result["returncode"] == 0:
+                print("Downloaded and verified {}.".format(result["product"] or "image"))
+            else:
+                print("Download failed: {}".format(result["error"]))
+        else:
+            args = self.get_macrecovery_args(self.target_mac,self.target_mlb,self.latest_default,self.output)
+            display_args = [os.path.basename(args[0])]+args[1:]
+            print("Running command:\n")
+            print(" ".join(display_args))
+            print("")
+            self.run_macrecovery(self.target_mac,self.target_mlb,self.latest_default,self.output)
         print("")
         self.u.grab("Press [enter] to return...")
 
+    def download_target(self, target):
+        # Downloads a single resolved batch target and returns a result dict
+        start = time.time()
+        result = dict(target)
+        try:
+            existing = self.check_existing(target["board_id"],target["mlb"],target["os_type"],target["output"])
+            if existing:
+                result.update(existing)
+                result["status"] = "ok"
+                result["elapsed"] = round(time.time()-start,3)
+                return result
+            self.prepare_output(target["output"],keep_partial=self.use_in_process())
+            result.update(self.run_macrecovery(
+                target["board_id"],
+                target["mlb"],
+                target["os_type"],
+                target["output"],
+                log=os.path.join(target["output"],"macrecovery.log"),
+                progress=False
+            ))
+            result["status"] = "ok" if result["returncode"] == 0 else "failed"
+        except Exception as e:
+            result["status"] = "failed"
+            result["error"] = str(e)
+        result["elapsed"] = round(time.time()-start,3)
+        return result
+
+    def batch_download(self, manifest, jobs = 1, output_root = None, results = None):
+        # Resolves every target in the manifest and downloads them on up to jobs
+        # workers.  One JSON object per target is written to results (a file-like
+        # object - stdout by default) as each finishes.  Returns the number of
+        # targets that didn't succeed.
+        from Scripts import batch
+        results = results or sys.stdout
+        failed = 0
+        targets = []
+        outputs = set()
+        def emit(result):
+            results.write(json.dumps(result,sort_keys=True)+"\n")
+            results.flush()
+        for i,target in enumerate(batch.load_manifest(manifest)):
+            try:
+                resolved = batch.resolve_target(target,self.index,output_root)
+                resolved["output"] = self.get_output_folder(resolved["output"])
+                if resolved["output"] in outputs:
+                    raise ValueError("Output folder is already used by another target: {}".format(resolved["output"]))
+            except ValueError as e:
+                failed += 1
+                result = dict(target)
+                result.update({"index":i,"status":"invalid","error":str(e)})
+                emit(result)
+                continue
+            outputs.add(resolved["output"])
+            resolved["index"] = i
+            targets.append(resolved)
+        for target,result in batch.run_pool(targets,self.download_target,jobs):
+            if isinstance(result,BaseException):
+                result = dict(target,status="failed",error=str(result))
+            if result.get("status") != "ok":
+                failed += 1
+            emit(result)
+        return failed
+
     def main(self):
+        # Due a check of the support files?  Say so now, but only start it once the
+        # menu's drawn so it never holds up the paint.  Once per session - after
+        # that, option 1 updates them.
+        refresh = self.refresh_thread is None and self.needs_refresh()
         self.resize()
         self.u.head()
         print("")
@@ -289,23 +820,31 @@ class gibMacRecovery:
         ))
         print("      boards.json: {}".format("Located" if os.path.exists(self.boards_path) else "NOT FOUND"))
         print("recovery_urls.txt: {}".format("Located" if os.path.exists(self.recovery_path) else "NOT FOUND"))
+        if refresh or self.refresh_status:
+            print("          Updates: {}".format(REFRESH_STARTED if refresh else self.refresh_status))
         print("")
         print("     Target macOS: {}".format(self.target_macos))
         print("  Target Board ID: {}".format(self.target_mac))
         print("       Target MLB: {}".format(self.target_mlb))
         print("          OS Type: {}".format(self.latest_default))
+        prefetch = self.get_prefetch_status()
+        if prefetch:
+            print("         Prefetch: {}".format(prefetch))
         print("")
         print("1. {} macrecovery.py, boards.json, and recovery_urls.txt".format("Update" if all((os.path.exists(x) for x in (self.recovery_path,self.macrecovery_path,self.boards_path))) else "Install"))
         print("2. Select Targets From recovery_urls.txt ({:,} available)".format(len(self.recovery)))
-        print("3. Select Targets From boards.json ({:,} available)".format(len(set(self.boards.values()))))
+        print("3. Select Targets From boards.json ({:,} available)".format(len(self.index.os_versions())))
         print("4. Input Custom Board ID")
         print("5. Input Custom MLB")
         print("6. Toggle OS Type")
         if self.target_mac and self.target_mlb:
             print("7. Download macOS Recovery For {}".format(self.target_mac))
         print("")
+        print("P. Cycle Prefetch Mode (Currently {})".format(self.prefetch_mode))
+        print("C. Clear Image Store")
         print("Q. Quit")
         print("")
+        if refresh: self.start_refresh()
         menu = self.u.grab("Please select an option:  ")
         if not menu: return
         if menu.lower() == "q": self.u.custom_quit()
@@ -322,8 +861,69 @@ class gibMacRecovery:
             self.latest_default = "latest" if self.latest_default == "default" else "default"
         elif menu == "7":
             self.download_macos()
+        elif menu.lower() == "c":
+            self.clear_store()
+        elif menu.lower() == "p":
+            self.prefetch_mode = PREFETCH_MODES[(PREFETCH_MODES.index(self.prefetch_mode)+1) % len(PREFETCH_MODES)]
+        if menu in ("2","3","4","5","6") or menu.lower() == "p":
+            # The target may have changed - get ahead on the new one
+            self.update_prefetch()
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        # Non-interactive batch mode
+        import argparse
+        from Scripts import downloader
+        parser = argparse.ArgumentParser(prog="gibMacRecovery.py",description="Downloads macOS recovery images for every target in a manifest.")
+        parser.add_argument("manifest",nargs="?",help="path to a .json or .csv manifest of targets (board_id, mlb, os_type, macos, output)")
+        parser.add_argument("-j","--jobs",type=int,default=1,help="how many targets to download at once (default: 1)")
+        parser.add_argument("-o","--output-root",help="folder to create per-target output folders in when a target doesn't set one (default: cwd)")
+        parser.add_argument("-r","--results",help="write JSON lines results here instead of stdout")
+        parser.add_argument("-u","--update",action="store_true",help="update macrecovery.py, boards.json, and recovery_urls.txt first")
+        parser.add_argument("-s","--subprocess",action="store_true",help="always run macrecovery.py as a separate process")
+        parser.add_argument("--limit-rate",type=downloader.parse_size,help="cap the combined download rate in bytes/sec - accepts K, M, and G suffixes")
+        parser.add_argument("--max-connections",type=int,help="cap the number of open connections across every download")
+        parser.add_argument("--max-per-host",type=int,help="cap the number of open connections to any one server")
+        parser.add_argument("--metrics",help="append JSON lines with timings for every connection and transfer here")
+        parser.add_argument("--mirror",help="base url of a local mirror of macrecovery.py, boards.json, and recovery_urls.txt to race against GitHub")
+        parser.add_argument("--store-limit",help="evict the least recently used stored images past this size - accepts K, M, and G suffixes, or off (default: 10G)")
+        parser.add_argument("--clear-store",action="store_true",help="remove every stored image first - the manifest is optional with this")
+        args = parser.parse_args()
+        if not args.manifest and not args.clear_store:
+            parser.error("the following arguments are required: manifest")
+        if args.store_limit and not args.store_limit.lower() in ("off","none"):
+            try:
+                downloader.parse_size(args.store_limit)
+            except ValueError:
+                parser.error("invalid --store-limit: {}".format(args.store_limit))
+        if args.clear_store:
+            # Done before anything else - building gibMacRecovery in batch mode
+            # fetches any missing support files, which clearing doesn't need
+            from Scripts import image_store
+            store = image_store.ImageStore(os.path.join(os.path.dirname(os.path.realpath(__file__)),"image_store"))
+            count,size = store.clear()
+            sys.stderr.write("Cleared {:,} stored image{} ({}).\n".format(count,"" if count == 1 else "s",downloader.get_size(size)))
+            if not args.manifest:
+                sys.exit(0)
+        scheduler = downloader.Scheduler(
+            rate=args.limit_rate,
+            max_connections=args.max_connections,
+            max_per_host=args.max_per_host
+        )
+        # The mirror is passed in rather than set after - building gibMacRecovery in
+        # batch mode fetches any missing support files
+        g = gibMacRecovery(interactive=False,scheduler=scheduler,metrics_file=args.metrics,mirror=args.mirror)
+        g.in_process = not args.subprocess
+        if args.store_limit:
+            g.store_limit = args.store_limit
+        if args.update:
+            g.update_macrecovery()
+        if args.results:
+            with open(args.results,"w") as f:
+                failed = g.batch_download(args.manifest,args.jobs,args.output_root,f)
+        else:
+            failed = g.batch_download(args.manifest,args.jobs,args.output_root)
+        sys.exit(1 if failed else 0)
     g = gibMacRecovery()
     while True:
         try: